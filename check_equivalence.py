@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Check that compiled, optimized and repacked EzStates behave exactly like the originals.
+
+Usage: python check_equivalence.py [--expressions N] [--ticks N] [--seed N] [--processes N] [path ...]
+
+Random expressions (calls with and without arguments, comparisons, 'and'/'or', register stores and loads, 'a6' and
+'b7', and constants in every encoding) are evaluated with the reference interpreter `ezstate_parser.ezevaluate` and
+checked against:
+
+    - `ezstate_compiler.compile_expression`: the same value, registers, and function calls in the same order.
+    - `ezstate_optimizer.optimize_expression`: a valid expression with the same value, function calls, and values of
+      the registers that are still live.
+
+Each .esd file in `paths` (files or directories, searched recursively) is checked as well:
+
+    - Its state graph, given to `EzState.from_graph`, packs to the bytes of the file, and loading those bytes gives an
+      EzState that packs to the same bytes again.
+    - Simulating it in differential mode (compiled against interpreted conditions) and simulating its optimized repack,
+      with the same changing inputs, give the same transitions and commands. Files with invalid expressions (such as
+      unknown opcodes) are not simulated.
+
+Every problem found is printed, and the exit code is 1 if there were any.
+"""
+
+import argparse
+from multiprocessing import Pool
+import random
+from struct import pack
+import sys
+
+from ezstate_compiler import compile_expression
+from ezstate_optimizer import optimize_expression
+from ezstate_parser import ezevaluate, validate_expression
+from ezstate_pruning import expression_comparisons
+from ezstate_simulator import EzEnvironment, EzStateSimulator
+from unpack_esd import EzState
+
+MAX_REPORTED = 10  # Problems reported for each kind of check.
+_CALL_RESULTS = (0, 1, 2, 5, 0.5)
+
+
+def random_expression(rnd, depth=0):
+    """ Packed expression (ending with 'a1') that leaves one value on the stack. Loads may read registers that the
+    expression does not store. """
+    return _random_value(rnd, depth) + rnd.choice((b'', b'\xb7', b'\xa6\xb7')) + b'\xa1'
+
+
+def _random_constant(rnd):
+    kind = rnd.random()
+    if kind < 0.4:
+        return bytes([rnd.randint(0x3f, 0x7f)])
+    if kind < 0.7:
+        return b'\x82' + pack('<i', rnd.choice((rnd.randint(-3, 70), rnd.randint(-10 ** 6, 10 ** 6))))
+    if kind < 0.85:
+        return b'\x80' + pack('<f', rnd.choice((0.0, 1.0, 2.5, -1.5)))
+    return b'\x81' + pack('<d', rnd.choice((0.0, 3.0)))
+
+
+def _random_value(rnd, depth):
+    kind = rnd.random()
+    if depth > 3 or kind < 0.3:
+        code = _random_constant(rnd)
+    elif kind < 0.4:
+        code = bytes([0x40 + rnd.randint(1, 4), 0x84])
+    elif kind < 0.5:
+        code = bytes([0x40 + rnd.randint(1, 4)]) + _random_value(rnd, depth + 1) + b'\x85'
+    elif kind < 0.55:
+        string = rnd.choice(('', 'a', 'bc')).encode('utf-16le') + b'\x00\x00'
+        code = bytes([0x40 + rnd.randint(1, 4), 0xa5]) + string + b'\x85'
+    elif kind < 0.6:
+        code = bytes([0xaf + rnd.randint(0, 2)])
+    else:
+        code = (_random_value(rnd, depth + 1) + _random_value(rnd, depth + 1)
+                + bytes([rnd.choice((0x91, 0x92, 0x93, 0x94, 0x95, 0x96, 0x98, 0x99))]))
+    suffix = rnd.random()
+    if suffix < 0.15:
+        code += bytes([0xa7 + rnd.randint(0, 3)])
+    elif suffix < 0.25:
+        code += b'\xa6'
+    elif suffix < 0.4:
+        code += b'\xb7'
+    return code
+
+
+def _run(evaluate, expression, seed):
+    """ (value, registers, calls made) of one evaluation, with call results that depend only on `seed` and the call. """
+    calls = []
+    results = {}
+
+    def call(function_index, *args):
+        key = (function_index,) + args
+        calls.append(key)
+        if key not in results:
+            results[key] = random.Random(repr((seed, key))).choice(_CALL_RESULTS)
+        return results[key]
+
+    registers = [random.Random(seed * 8 + index).choice((0, 1, 3)) for index in range(8)]
+    return evaluate(expression, call, registers), registers, calls
+
+
+def check_compiler(count, seed=0):
+    """ Compare compiled expressions with `ezevaluate` on `count` random expressions. Returns a list of problems. """
+    rnd = random.Random(seed)
+    problems = []
+    for _ in range(count):
+        expression = random_expression(rnd)
+        input_seed = rnd.randrange(1 << 30)
+        reference = _run(ezevaluate, expression, input_seed)
+        compiled = _run(lambda e, call, registers: compile_expression(e)(call, registers), expression, input_seed)
+        if compiled != reference:
+            problems.append('Compiled {} gives {}, not {}.'.format(expression.hex(), compiled, reference))
+    return problems
+
+
+def check_optimizer(count, seed=0):
+    """ Compare optimized expressions with `ezevaluate` on `count` random expressions, each with a random set of live
+    registers. Returns a list of problems. """
+    rnd = random.Random(seed)
+    problems = []
+    for _ in range(count):
+        expression = random_expression(rnd)
+        live_registers = frozenset(rnd.sample(range(8), rnd.randint(0, 8)))
+        optimized = optimize_expression(expression, live_registers)
+        try:
+            validate_expression(optimized)
+        except ValueError as e:
+            problems.append('Optimized {} is invalid: {}'.format(expression.hex(), e))
+            continue
+        input_seed = rnd.randrange(1 << 30)
+        value, registers, calls = _run(ezevaluate, expression, input_seed)
+        optimized_value, optimized_registers, optimized_calls = _run(ezevaluate, optimized, input_seed)
+        if (optimized_value != value or optimized_calls != calls
+                or any(optimized_registers[index] != registers[index] for index in live_registers)):
+            problems.append('{} optimized to {} (live registers {}) gives {}, not {}.'.format(
+                expression.hex(), optimized.hex(), sorted(live_registers),
+                (optimized_value, optimized_registers, optimized_calls), (value, registers, calls)))
+    return problems
+
+
+def _input_values(ezstate):
+    """ {(function_index, *args): values worth trying} for the calls that the conditions of `ezstate` compare with
+    constants. Elapsed time (functions 65 and 66) comes from the simulator. """
+    inputs = {}
+    stack = [condition for state in ezstate.passive_states + ezstate.active_states for condition in state.conditions]
+    while stack:
+        condition = stack.pop()
+        stack += condition.subconditions
+        for key, number in expression_comparisons(condition.expression):
+            if key[0] not in (65, 66):
+                inputs.setdefault(key, {0, 1}).update((number - 1, number, number + 1))
+    return {key: sorted(values) for key, values in inputs.items()}
+
+
+def _simulate(ezstate, inputs, ticks, seed):
+    """ (transitions, command log) of `ticks` ticks in differential mode, changing one input every few ticks. """
+    rnd = random.Random(seed)
+    environment = EzEnvironment()
+    simulator = EzStateSimulator(ezstate, environment, differential=True)
+    keys = sorted(inputs, key=repr)
+    transitions = []
+    for tick in range(ticks):
+        if keys and rnd.random() < 0.3:
+            key = rnd.choice(keys)
+            environment.set_function_value(key if len(key) > 1 else key[0], rnd.choice(inputs[key]))
+        new_state = simulator.tick()
+        if new_state is not None:
+            transitions.append((tick, new_state.active, new_state.index))
+    return transitions, environment.command_log
+
+
+def check_file(esd_path, ticks=2000, seed=0):
+    """ Check one .esd file (see module docstring). Returns (path, list of problems). """
+    problems = []
+    try:
+        with open(esd_path, 'rb') as esd_file:
+            original = esd_file.read()
+        ezstate = EzState(original, validate=False)
+        rebuilt = EzState.from_graph(ezstate.header, ezstate.state_header, ezstate.passive_states,
+                                     ezstate.active_states, ezstate.esd_name, ezstate.file_tail)
+        packed = rebuilt.to_bytes()
+        if packed != original:
+            problems.append('EzState.from_graph packs to different bytes than the file.')
+        elif EzState(packed, validate=False).to_bytes() != packed:
+            problems.append('Loading the packed bytes again packs to different bytes.')
+
+        if ezstate.validate(raise_errors=False):
+            return esd_path, problems  # Invalid expressions (such as unknown opcodes) cannot be simulated.
+        optimized = EzState(ezstate.to_bytes(optimize=True), validate=False)
+        inputs = _input_values(ezstate)
+        if _simulate(optimized, inputs, ticks, seed) != _simulate(ezstate, inputs, ticks, seed):
+            problems.append('The optimized repack makes different transitions or commands in {} ticks.'.format(ticks))
+    except Exception as e:
+        problems.append('{}: {}'.format(type(e).__name__, e))
+    return esd_path, problems
+
+
+def _check_file_arguments(arguments):
+    return check_file(*arguments)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Check compiled, optimized and repacked EzStates against originals.')
+    parser.add_argument('paths', nargs='*', help='.esd files or directories to search')
+    parser.add_argument('--expressions', type=int, default=20000, help='random expressions for each check')
+    parser.add_argument('--ticks', type=int, default=2000, help='simulated ticks for each file')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the random expressions and inputs')
+    parser.add_argument('--processes', '-j', type=int, default=None, help='number of worker processes for files')
+    args = parser.parse_args()
+
+    from validate_esd import find_esd_files
+
+    failed = False
+    for name, check in (('compiler', check_compiler), ('optimizer', check_optimizer)):
+        problems = check(args.expressions, args.seed)
+        for problem in problems[:MAX_REPORTED]:
+            print(problem)
+        print('{}: {} of {} random expressions differ.'.format(name, len(problems), args.expressions))
+        failed = failed or bool(problems)
+
+    esd_paths = find_esd_files(args.paths)
+    if esd_paths:
+        with Pool(args.processes) as pool:
+            results = pool.map(_check_file_arguments, [(path, args.ticks, args.seed) for path in esd_paths])
+        failures = [(path, problems) for path, problems in results if problems]
+        for path, problems in failures:
+            print('{}:'.format(path))
+            for problem in problems:
+                print('  {}'.format(problem))
+        print('files: {} of {} differ.'.format(len(failures), len(esd_paths)))
+        failed = failed or bool(failures)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""
+Incrementally convert (.html) and repack (.esd) many .esd files, rebuilding only what is out of date.
+
+Usage: python ezstate_build.py --output DIR [--no-html] [--no-esd] [--optimize] [--remove-unreachable]
+                               [--renumber-states] [--edit SCRIPT] [--force] [--processes N] [path ...]
+
+Outputs are written under `DIR` with the same relative paths as their sources ('talk/t100.esd' becomes
+'DIR/t100.esd.html' and 'DIR/t100.esd'). A build manifest ('DIR/ezstate_build.json') records, for every output, the
+SHA-1 hashes of its inputs: the source .esd, the edit script (if any), the build options and the tool itself (the source
+of this module and of every module in its directory that it imports, directly or indirectly). An output is rebuilt only
+if one of these has changed or if the output file has been changed or removed since it was written. Stale files are
+built in parallel.
+
+The manifest also caches the size and modification time of every hashed file, so files that have not been touched
+are not read again, and a build with nothing to do only needs to stat each file.
+
+An edit script is a Python file defining `edit(ezstate, esd_path)`, which is called on each loaded `EzState` before it
+is written.
+"""
+
+import argparse
+import ast
+from hashlib import sha1
+import json
+from multiprocessing import Pool
+import os
+import runpy
+import sys
+
+from unpack_esd import EzState
+from validate_esd import find_esd_files
+
+MANIFEST_NAME = 'ezstate_build.json'
+MANIFEST_VERSION = 1
+
+
+def find_esd_sources(paths):
+    """ List of (.esd path, output name relative to the output directory) for files and directories in `paths`. Raises
+    ValueError if two different files would have the same output name. """
+    sources = []
+    found = {}  # {output name: .esd path}
+    for path in paths:
+        for esd_path in find_esd_files([path]):
+            output_name = os.path.relpath(esd_path, path) if os.path.isdir(path) else os.path.basename(esd_path)
+            key = os.path.normcase(output_name)
+            if key in found:
+                if os.path.abspath(found[key]) == os.path.abspath(esd_path):
+                    continue  # The same file given twice.
+                raise ValueError('{} and {} would both be written to {}.'.format(found[key], esd_path, output_name))
+            found[key] = esd_path
+            sources.append((esd_path, output_name))
+    return sources
+
+
+def _file_sha1(path):
+    digest = sha1()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _stat_key(path):
+    stat = os.stat(path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+class BuildManifest(object):
+    """ Output records and cached file hashes of a build directory. """
+
+    def __init__(self, manifest_path):
+        self.manifest_path = manifest_path
+        self.outputs = {}  # {output path: {'inputs': {name: hash}, 'stat': [size, mtime_ns]}}
+        self.hashes = {}  # {file path: [size, mtime_ns, hash]}
+        if os.path.isfile(manifest_path):
+            try:
+                with open(manifest_path, encoding='utf-8') as manifest_file:
+                    data = json.load(manifest_file)
+            except ValueError:
+                data = {}  # Unreadable manifest; everything is rebuilt.
+            if data.get('version') == MANIFEST_VERSION:
+                self.outputs = data['outputs']
+                self.hashes = data['hashes']
+
+    def file_hash(self, path):
+        """ SHA-1 of a file, read only if its size or modification time differs from the cached hash. """
+        stat_key = _stat_key(path)
+        cached = self.hashes.get(path)
+        if cached is not None and cached[:2] == stat_key:
+            return cached[2]
+        file_hash = _file_sha1(path)
+        self.hashes[path] = stat_key + [file_hash]
+        return file_hash
+
+    def is_current(self, output_path, inputs):
+        record = self.outputs.get(output_path)
+        if record is None or record['inputs'] != inputs:
+            return False
+        try:
+            return _stat_key(output_path) == record['stat']
+        except OSError:
+            return False
+
+    def record(self, output_path, inputs):
+        self.outputs[output_path] = {'inputs': inputs, 'stat': _stat_key(output_path)}
+
+    def save(self):
+        temp_path = self.manifest_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as manifest_file:
+            json.dump({'version': MANIFEST_VERSION, 'outputs': self.outputs, 'hashes': self.hashes}, manifest_file,
+                      sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+
+def tool_modules():
+    """ Paths of this module and of the modules in its directory that it imports, directly or indirectly (including
+    imports inside functions). Found from the import statements rather than `sys.modules`, so that the result does not
+    depend on what else the calling program has imported. """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    pending = ['ezstate_build']
+    module_paths = {}
+    while pending:
+        module_name = pending.pop()
+        module_path = os.path.join(directory, module_name + '.py')
+        if module_name in module_paths or not os.path.isfile(module_path):
+            continue
+        module_paths[module_name] = module_path
+        with open(module_path, 'rb') as module_file:
+            tree = ast.parse(module_file.read(), module_path)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending += [alias.name.split('.')[0] for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module.split('.')[0])
+    return [module_paths[module_name] for module_name in sorted(module_paths)]
+
+
+def tool_hash(manifest):
+    """ Combined hash of the tool modules, so that changing the tool rebuilds everything. """
+    digest = sha1()
+    for module_path in tool_modules():
+        digest.update(manifest.file_hash(module_path).encode())
+    return digest.hexdigest()
+
+
+def _build_one(job):
+    """ Load, edit and write the outputs of one .esd file. Returns (source path, error message or None). """
+    esd_path, html_path, esd_output_path, edit_script, options = job
+    try:
+        ezstate = EzState(esd_path)
+        if edit_script is not None:
+            runpy.run_path(edit_script)['edit'](ezstate, esd_path)
+        if html_path is not None:
+            os.makedirs(os.path.dirname(html_path) or '.', exist_ok=True)
+            ezstate.unpack_to_html_file(html_path)
+        if esd_output_path is not None:
+            os.makedirs(os.path.dirname(esd_output_path) or '.', exist_ok=True)
+            ezstate.write(esd_output_path, **options)
+        return esd_path, None
+    except Exception as e:
+        return esd_path, '{}: {}'.format(type(e).__name__, e)
+
+
+def build_esd_files(paths, output_dir, html=True, esd=True, edit_script=None, optimize=False,
+                    remove_unreachable=False, renumber_states=False, force=False, processes=None):
+    """ Build the out-of-date .html and/or repacked .esd outputs of every .esd file in `paths` into `output_dir`.
+    Returns a dictionary with the 'built' and 'skipped' output paths, and {source path: error} for 'failed' files,
+    whose outputs are rebuilt next time. """
+    os.makedirs(output_dir, exist_ok=True)
+    manifest = BuildManifest(os.path.join(output_dir, MANIFEST_NAME))
+    options = {'optimize': optimize, 'remove_unreachable': remove_unreachable, 'renumber_states': renumber_states}
+    shared_inputs = {'tool': tool_hash(manifest), 'options': json.dumps(options, sort_keys=True)}
+    if edit_script is not None:
+        shared_inputs['edit'] = manifest.file_hash(edit_script)
+
+    jobs = []
+    job_outputs = {}  # {source path: [(output path, inputs)]}
+    skipped = []
+    for esd_path, output_name in find_esd_sources(paths):
+        output_base = os.path.join(output_dir, output_name)
+        if esd and os.path.abspath(output_base) == os.path.abspath(esd_path):
+            raise ValueError('Repacked output would overwrite its source file {}.'.format(esd_path))
+        inputs = dict(shared_inputs, source=manifest.file_hash(esd_path))
+        stale = {}
+        for enabled, output_path, kind in ((html, output_base + '.html', 'html'), (esd, output_base, 'esd')):
+            if not enabled:
+                continue
+            output_inputs = dict(inputs, kind=kind)
+            if kind == 'html':
+                del output_inputs['options']  # Packing options do not affect the HTML.
+            if force or not manifest.is_current(output_path, output_inputs):
+                stale[kind] = output_path
+                job_outputs.setdefault(esd_path, []).append((output_path, output_inputs))
+            else:
+                skipped.append(output_path)
+        if stale:
+            jobs.append((esd_path, stale.get('html'), stale.get('esd'), edit_script, options))
+
+    built = []
+    failed = {}
+    if jobs:
+        pool = None if processes == 1 or len(jobs) == 1 else Pool(processes)
+        if pool is None:
+            results = map(_build_one, jobs)
+        else:
+            results = pool.imap_unordered(_build_one, jobs, chunksize=max(1, len(jobs) // 64))
+        try:
+            for esd_path, error in results:
+                for output_path, output_inputs in job_outputs[esd_path]:
+                    if error is None:
+                        manifest.record(output_path, output_inputs)
+                        built.append(output_path)
+                    else:
+                        manifest.outputs.pop(output_path, None)
+                if error is not None:
+                    failed[esd_path] = error
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+    manifest.save()
+    return {'built': built, 'skipped': skipped, 'failed': failed}
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Incrementally convert and repack .esd files.')
+    parser.add_argument('paths', nargs='*', default=['.'], help='.esd files or directories to search')
+    parser.add_argument('--output', '-o', required=True, help='output directory (holds the build manifest)')
+    parser.add_argument('--no-html', action='store_true', help='do not write .html files')
+    parser.add_argument('--no-esd', action='store_true', help='do not write repacked .esd files')
+    parser.add_argument('--optimize', action='store_true', help='optimize expressions while repacking')
+    parser.add_argument('--remove-unreachable', action='store_true', help='leave out unreachable states')
+    parser.add_argument('--renumber-states', action='store_true', help='renumber packed states compactly')
+    parser.add_argument('--edit', default=None, help="Python script defining 'edit(ezstate, esd_path)'")
+    parser.add_argument('--force', action='store_true', help='rebuild every output')
+    parser.add_argument('--processes', '-j', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    result = build_esd_files(args.paths, args.output, html=not args.no_html, esd=not args.no_esd,
+                             edit_script=args.edit, optimize=args.optimize,
+                             remove_unreachable=args.remove_unreachable, renumber_states=args.renumber_states,
+                             force=args.force, processes=args.processes)
+    for failed_path, problem in result['failed'].items():
+        print('{}: {}'.format(failed_path, problem))
+    print('{} built, {} up to date, {} failed.'.format(
+        len(result['built']), len(result['skipped']), len(result['failed'])))
+    sys.exit(1 if result['failed'] else 0)
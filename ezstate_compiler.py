@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+"""
+Compile packed EzState expressions and state condition lists into Python functions for fast simulation.
+
+Each expression is translated once into Python source (a straight line of register stores followed by one nested
+expression) and compiled with `exec`. Function calls are made in the same order as `ezevaluate` makes them, and none
+are skipped: before a register store, an early exit ('b7'), or an 'and'/'or' whose right operand calls a function
+(which Python would otherwise short-circuit), every pending value that calls a function is computed into a temporary.
+
+The conditions of a state, including subconditions, become a single function `state_function(call, registers)` that
+returns the tuple of conditions that fire: the first true condition, then the first true subcondition of that
+condition, and so on. It returns an empty tuple if no condition is true.
+
+Compiled results must match `ezstate_parser.ezevaluate`, which `ezstate_simulator` can check in differential mode.
+"""
+
+from functools import lru_cache
+from weakref import WeakKeyDictionary
+
+from ezstate_parser import iter_instructions
+
+_COMPARISON_SOURCE = {0x91: '<=', 0x92: '>=', 0x93: '<', 0x94: '>', 0x95: '==', 0x96: '!='}
+
+_COMPILED_STATES = WeakKeyDictionary()  # {EzState: {(active, state_index): state_function}}
+
+
+class _ExpressionSource(object):
+    """ Python source for one packed expression. """
+
+    def __init__(self, statements, result, early_exit):
+        self.statements = statements  # Register stores and early exits, in bytecode order.
+        self.result = result  # Source of the final value.
+        self.early_exit = early_exit  # Uses 'return' statements ('b7'), so must be wrapped in its own function.
+
+
+def translate_expression(expression, constants, temp_prefix='t'):
+    """ Translate a packed expression into an `_ExpressionSource`. Floats and strings are appended to `constants`
+    and referenced as `K[i]`. """
+    stack = []
+    statements = []
+    early_exit = False
+    temp_count = 0
+
+    def new_temp():
+        nonlocal temp_count
+        temp_count += 1
+        return '{}{}'.format(temp_prefix, temp_count)
+
+    def flush_calls():
+        # Compute pending values with calls now, bottom of the stack first, which is bytecode order.
+        for i, value in enumerate(stack):
+            if 'call(' in value:
+                temp = new_temp()
+                statements.append('{} = {}'.format(temp, value))
+                stack[i] = temp
+
+    def constant(value):
+        constants.append(value)
+        return 'K[{}]'.format(len(constants) - 1)
+
+    for _, byte, operand, _ in iter_instructions(expression):
+        if isinstance(operand, int):
+            stack.append(str(operand))
+        elif operand is not None:
+            stack.append(constant(operand))  # Floats and strings.
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            args = stack[len(stack) - arg_count:]
+            del stack[len(stack) - arg_count:]
+            stack[-1] = 'call({})'.format(', '.join([stack[-1]] + args))
+        elif 0x91 <= byte <= 0x96:
+            right = stack.pop()
+            stack[-1] = '(1 if {} {} {} else 0)'.format(stack[-1], _COMPARISON_SOURCE[byte], right)
+        elif byte == 0x98 or byte == 0x99:
+            if 'call(' in stack[-1]:
+                flush_calls()  # The interpreter makes the right operand's calls even if the left decides the result.
+            right = stack.pop()
+            stack[-1] = '(1 if ({} {} {}) else 0)'.format(stack[-1], 'and' if byte == 0x98 else 'or', right)
+        elif 0xa7 <= byte <= 0xae:
+            # Store now, so the value is computed in bytecode order even if later operations short-circuit.
+            flush_calls()
+            temp = new_temp()
+            statements.append('registers[{}] = {} = {}'.format(byte - 0xa7, temp, stack[-1]))
+            stack[-1] = temp
+        elif 0xaf <= byte <= 0xb6:
+            temp = new_temp()
+            statements.append('{} = registers[{}]'.format(temp, byte - 0xaf))
+            stack.append(temp)
+        elif byte == 0xb7:
+            flush_calls()
+            temp = new_temp()
+            statements.append('{} = {}'.format(temp, stack[-1]))
+            statements.append('if not {0}: return {0}'.format(temp))
+            stack[-1] = temp
+            early_exit = True
+    if early_exit and statements[-1] == 'if not {0}: return {0}'.format(stack[-1]):
+        # A final 'b7' stops nothing, so the expression can still be inlined if it has no other early exits.
+        statements.pop()
+        early_exit = any(statement.startswith('if not ') for statement in statements)
+    return _ExpressionSource(statements, stack[-1], early_exit)
+
+
+def _function_source(name, expression_source):
+    lines = ['def {}(call, registers):'.format(name)]
+    lines += ['    ' + statement for statement in expression_source.statements]
+    lines.append('    return {}'.format(expression_source.result))
+    return lines
+
+
+@lru_cache(maxsize=None)
+def compile_expression(expression):
+    """ Compile one packed expression into `function(call, registers)` returning its value. Results are cached by
+    expression bytes, so identical expressions in different files share one function. """
+    constants = []
+    namespace = {'K': constants}
+    exec('\n'.join(_function_source('expression', translate_expression(bytes(expression), constants))), namespace)
+    return namespace['expression']
+
+
+def state_source(conditions, name, constants, condition_constants, counted=False):
+    """ Python source lines of a function that evaluates `conditions` (with subconditions) and returns the tuple of
+    fired conditions. Helper functions for expressions with early exits are returned first. If `counted` is True, each
+    condition also counts its evaluations in `E[slot]` and fires in `F[slot]`, where `slot` is its index in
+    `condition_constants`. """
+    helpers = []
+    body = []
+    temp_count = [0]
+
+    def emit(conditions_, indent, fired):
+        for condition in conditions_:
+            condition_constants.append(condition)
+            slot = len(condition_constants) - 1
+            path = fired + ['C[{}]'.format(slot)]
+            temp_count[0] += 1
+            expression_source = translate_expression(
+                bytes(condition.expression), constants, temp_prefix='t{}_'.format(temp_count[0]))
+            if expression_source.early_exit:
+                helper_name = '{}_e{}'.format(name, temp_count[0])
+                helpers.extend(_function_source(helper_name, expression_source))
+                test = '{}(call, registers)'.format(helper_name)
+            else:
+                body.extend(indent + statement for statement in expression_source.statements)
+                test = expression_source.result
+            if counted:
+                body.append('{}E[{}] += 1'.format(indent, slot))
+            body.append('{}if {}:'.format(indent, test))
+            if counted:
+                body.append('{}    F[{}] += 1'.format(indent, slot))
+            if condition.subconditions:
+                emit(condition.subconditions, indent + '    ', path)
+            body.append('{}    return ({},)'.format(indent, ', '.join(path)))
+
+    emit(conditions, '    ', [])
+    return helpers + ['def {}(call, registers):'.format(name)] + body + ['    return ()']
+
+
+def compile_states(states, counters=None):
+    """ Compile each state's conditions into one function. Returns {(active, state_index): state_function}.
+
+    If `counters` is given, it is called with the list of all conditions (states in order, each state's conditions
+    depth-first) and must return two arrays (evaluations, fires) of at least that length. The compiled functions then
+    count each condition's evaluations and fires at its position in that list.
+    """
+    constants = []
+    condition_constants = []
+    lines = []
+    names = {}
+    for i, state in enumerate(states):
+        name = '_state_{}'.format(i)
+        names[(state.active, state.index)] = name
+        lines += state_source(state.conditions, name, constants, condition_constants, counted=counters is not None)
+    namespace = {'K': constants, 'C': condition_constants}
+    if counters is not None:
+        namespace['E'], namespace['F'] = counters(condition_constants)
+    exec(compile('\n'.join(lines), '<ezstate>', 'exec'), namespace)
+    return {key: namespace[name] for key, name in names.items()}
+
+
+def get_compiled_states(ezstate):
+    """ Compiled state functions of `ezstate`, compiled on first use and cached for as long as it exists. Call
+    `clear_compiled_states` after editing its states. """
+    try:
+        return _COMPILED_STATES[ezstate]
+    except KeyError:
+        compiled = _COMPILED_STATES[ezstate] = compile_states(ezstate.passive_states + ezstate.active_states)
+        return compiled
+
+
+def clear_compiled_states(ezstate):
+    _COMPILED_STATES.pop(ezstate, None)
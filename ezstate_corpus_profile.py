@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Count opcodes, function calls, commands and expression lengths over a whole folder of .esd files.
+
+Usage: python ezstate_corpus_profile.py [path ...] [--json OUTPUT] [--top N] [--processes N]
+
+Each file's tables are read with `ezstate_patch.EzStatePatcher` (without building the state graph), and every condition
+and command argument expression is decoded once with `ezstate_parser.iter_instructions`, without rendering it. Every
+table row counts, so an expression shared by several rows is counted once for each. Files are profiled in parallel and
+the counts are merged. The JSON report holds:
+
+    opcodes                     {opcode (hex): count}
+    functions                   {function index: count} of calls with a constant function index
+    dynamic_function_calls      calls whose function index is computed
+    call_arg_counts             {number of arguments: count}
+    commands                    {command index: count} of command table rows
+    expression_lengths          {'condition' or 'arg': {length in bytes: count}}
+    unknown_opcodes             {opcode (hex): count} of opcodes outside the known instruction set (such as 83 and
+                                88-90), after which the rest of that expression cannot be decoded
+    unknown_opcode_examples     the first few places they occur, as (path, kind, table row offset, opcode offset)
+    top_opcodes, top_functions, top_commands    the `--top` most frequent, with names
+
+A short text summary is printed as well.
+"""
+
+import argparse
+from collections import Counter
+import json
+from multiprocessing import Pool
+import sys
+
+from command_names import COMMAND_NAMES
+from ezstate_parser import OPCODE_STACK_EFFECTS, comparison_lookup, function_lookup, iter_instructions
+from ezstate_patch import EzStatePatcher
+
+KNOWN_OPCODES = frozenset(OPCODE_STACK_EFFECTS) | {0xa1}
+MAX_UNKNOWN_EXAMPLES = 20
+_COMPARISON_NAMES = {0x91: '<=', 0x92: '>=', 0x93: '<', 0x94: '>', 0x95: '==', 0x96: '!='}
+
+
+def opcode_name(opcode):
+    """ Short description of an opcode for reports. """
+    if 0x3f <= opcode <= 0x7f:
+        return 'push {}'.format(opcode - 64)
+    if 0x84 <= opcode <= 0x87:
+        return 'call ({} args)'.format(opcode - 0x84)
+    if opcode in comparison_lookup:
+        return _COMPARISON_NAMES[opcode]
+    if 0xa7 <= opcode <= 0xae:
+        return 'store register {}'.format(opcode - 0xa7)
+    if 0xaf <= opcode <= 0xb6:
+        return 'load register {}'.format(opcode - 0xaf)
+    return {0x80: 'push float', 0x81: 'push double', 0x82: 'push int', 0x98: 'and', 0x99: 'or', 0xa1: 'end',
+            0xa5: 'push string', 0xa6: 'a6', 0xb7: 'b7 (stop if false)'}.get(opcode, 'unknown')
+
+
+class CorpusProfile(object):
+    """ Counts over any number of files. Profiles of separate files can be combined with `merge`. """
+
+    def __init__(self):
+        self.files = 0
+        self.failed = {}  # {path: error}
+        self.opcodes = [0] * 256
+        self.functions = Counter()
+        self.dynamic_function_calls = 0
+        self.call_arg_counts = Counter()
+        self.commands = Counter()
+        self.expression_lengths = {'condition': Counter(), 'arg': Counter()}
+        self.unknown_opcode_examples = []
+
+    def add_expression(self, expression, kind, location=None):
+        """ Count one packed expression. `kind` is 'condition' or 'arg'. `location` (path, row offset) is used for
+        unknown opcode examples. """
+        opcodes = self.opcodes
+        self.expression_lengths[kind][len(expression)] += 1
+        constants = []  # Stack of integer constants, or None for other values.
+        offset = 0
+        try:
+            for _, opcode, operand, end in iter_instructions(expression):
+                opcodes[opcode] += 1
+                if isinstance(operand, int):
+                    constants.append(operand)
+                elif operand is not None:
+                    constants.append(None)  # Floats and strings are not function indices.
+                elif 0x84 <= opcode <= 0x87:
+                    arg_count = opcode - 0x84
+                    self.call_arg_counts[arg_count] += 1
+                    if len(constants) > arg_count:
+                        del constants[len(constants) - arg_count:]
+                        function_index = constants[-1]
+                        constants[-1] = None
+                    else:
+                        function_index = None
+                        constants = [None]
+                    if function_index is None:
+                        self.dynamic_function_calls += 1
+                    else:
+                        self.functions[function_index] += 1
+                elif 0xaf <= opcode <= 0xb6:
+                    constants.append(None)
+                elif opcode in comparison_lookup or opcode == 0x98 or opcode == 0x99:
+                    # Comparisons and 'and'/'or' replace two values with one.
+                    if constants:
+                        constants.pop()
+                    if constants:
+                        constants[-1] = None
+                offset = end
+        except ValueError:
+            # An unknown opcode (whose operand size is not known) or a truncated operand ends decoding.
+            opcode = expression[offset]
+            opcodes[opcode] += 1
+            if opcode not in KNOWN_OPCODES and len(self.unknown_opcode_examples) < MAX_UNKNOWN_EXAMPLES:
+                path, row_offset = location or (None, None)
+                self.unknown_opcode_examples.append((path, kind, row_offset, offset))
+
+    def add_file(self, esd_path):
+        """ Count every condition, command and command argument of one file. Files that cannot be read are recorded in
+        `failed`. """
+        try:
+            patcher = EzStatePatcher(esd_path)
+        except Exception as e:
+            self.failed[esd_path] = '{}: {}'.format(type(e).__name__, e)
+            return
+        self.files += 1
+        for row_offset in patcher.conditions:
+            self.add_expression(patcher.expression(('condition', row_offset)), 'condition', (esd_path, row_offset))
+        for index, _, _ in patcher.commands.values():
+            self.commands[index] += 1
+        for row_offset in patcher.command_args:
+            self.add_expression(patcher.expression(('arg', row_offset)), 'arg', (esd_path, row_offset))
+
+    def merge(self, other):
+        self.files += other.files
+        self.failed.update(other.failed)
+        self.opcodes = [count + other_count for count, other_count in zip(self.opcodes, other.opcodes)]
+        self.functions.update(other.functions)
+        self.dynamic_function_calls += other.dynamic_function_calls
+        self.call_arg_counts.update(other.call_arg_counts)
+        self.commands.update(other.commands)
+        for kind, lengths in other.expression_lengths.items():
+            self.expression_lengths[kind].update(lengths)
+        room = MAX_UNKNOWN_EXAMPLES - len(self.unknown_opcode_examples)
+        self.unknown_opcode_examples += other.unknown_opcode_examples[:max(room, 0)]
+
+    @property
+    def unknown_opcodes(self):
+        return {opcode: count for opcode, count in enumerate(self.opcodes) if count and opcode not in KNOWN_OPCODES}
+
+    def to_json(self, top=20):
+        """ Report dictionary (see module docstring). """
+        opcode_counts = Counter({opcode: count for opcode, count in enumerate(self.opcodes) if count})
+        return {
+            'files': self.files,
+            'failed': self.failed,
+            'opcodes': {'{:02x}'.format(opcode): count for opcode, count in sorted(opcode_counts.items())},
+            'functions': {str(index): count for index, count in sorted(self.functions.items())},
+            'dynamic_function_calls': self.dynamic_function_calls,
+            'call_arg_counts': {str(count): calls for count, calls in sorted(self.call_arg_counts.items())},
+            'commands': {str(index): count for index, count in sorted(self.commands.items())},
+            'expression_lengths': {kind: {str(length): count for length, count in sorted(lengths.items())}
+                                   for kind, lengths in self.expression_lengths.items()},
+            'unknown_opcodes': {'{:02x}'.format(opcode): count for opcode, count in self.unknown_opcodes.items()},
+            'unknown_opcode_examples': self.unknown_opcode_examples,
+            'top_opcodes': [{'opcode': '{:02x}'.format(opcode), 'name': opcode_name(opcode), 'count': count}
+                            for opcode, count in opcode_counts.most_common(top)],
+            'top_functions': [{'index': index, 'name': function_lookup.get(index), 'count': count}
+                              for index, count in self.functions.most_common(top)],
+            'top_commands': [{'index': index, 'name': (COMMAND_NAMES.get(index) or [None])[0], 'count': count}
+                             for index, count in self.commands.most_common(top)],
+        }
+
+    def text_report(self, top=10):
+        total_opcodes = sum(self.opcodes) or 1
+        lines = ['{} file(s) profiled, {} failed.'.format(self.files, len(self.failed))]
+        for kind, lengths in self.expression_lengths.items():
+            count = sum(lengths.values())
+            if not count:
+                continue
+            ordered = sorted(lengths.elements())
+            lines.append('{} {} expressions: mean {:.1f} bytes, median {}, 95th percentile {}, longest {}.'.format(
+                count, kind, sum(ordered) / count, ordered[count // 2], ordered[min(count - 1, count * 95 // 100)],
+                ordered[-1]))
+        lines.append('Top opcodes:')
+        for opcode, count in Counter({opcode: count for opcode, count in enumerate(self.opcodes)}).most_common(top):
+            if count:
+                lines.append('  {:02x} {:<22} {:>10} {:5.1f}%'.format(opcode, opcode_name(opcode), count,
+                                                                    100 * count / total_opcodes))
+        total_calls = sum(self.functions.values()) + self.dynamic_function_calls or 1
+        lines.append('Top functions ({} calls with a computed function index):'.format(self.dynamic_function_calls))
+        for index, count in self.functions.most_common(top):
+            lines.append('  {:>4} {:<40} {:>10} {:5.1f}%'.format(
+                index, function_lookup.get(index, ''), count, 100 * count / total_calls))
+        total_commands = sum(self.commands.values()) or 1
+        lines.append('Top commands:')
+        for index, count in self.commands.most_common(top):
+            lines.append('  {:>4} {:<40} {:>10} {:5.1f}%'.format(
+                index, (COMMAND_NAMES.get(index) or [''])[0], count, 100 * count / total_commands))
+        unknown = self.unknown_opcodes
+        if unknown:
+            lines.append('Unknown opcodes: {}'.format(', '.join(
+                '{:02x} x{}'.format(opcode, count) for opcode, count in sorted(unknown.items()))))
+        else:
+            lines.append('No unknown opcodes.')
+        return '\n'.join(lines)
+
+
+def profile_esd_file(esd_path):
+    profile = CorpusProfile()
+    profile.add_file(esd_path)
+    return profile
+
+
+def profile_esd_files(paths, processes=None):
+    """ Combined `CorpusProfile` of every .esd file in `paths`, profiled in parallel. """
+    from validate_esd import find_esd_files
+
+    esd_paths = find_esd_files(paths)
+    profile = CorpusProfile()
+    with Pool(processes) as pool:
+        for file_profile in pool.imap_unordered(profile_esd_file, esd_paths, chunksize=max(1, len(esd_paths) // 64)):
+            profile.merge(file_profile)
+    return profile
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Profile opcode, function and command frequencies of .esd files.')
+    parser.add_argument('paths', nargs='*', default=['.'], help='.esd files or directories to search')
+    parser.add_argument('--json', default=None, help='file to write the JSON report to')
+    parser.add_argument('--top', type=int, default=10, help='number of entries in top-N tables')
+    parser.add_argument('--processes', '-j', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    result = profile_esd_files(args.paths, args.processes)
+    if args.json is not None:
+        with open(args.json, 'w', encoding='utf-8') as json_file:
+            json.dump(result.to_json(args.top), json_file, indent=1)
+    print(result.text_report(args.top))
+    for failed_path, problem in result.failed.items():
+        print('{}: {}'.format(failed_path, problem))
+    sys.exit(1 if result.failed else 0)
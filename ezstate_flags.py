@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Compact event flag storage for simulations, shared by any number of simulated EzStates.
+
+Event flag IDs are sparse (mostly eight-digit numbers such as 11005000, in clusters), so `EventFlagStore` keeps one bit
+per flag in pages of `PAGE_FLAGS` consecutive IDs, and only allocates the pages that hold a set flag. A million flags in
+a few hundred clusters take a few hundred kilobytes.
+
+    store = EventFlagStore()
+    store.set(11005000, 1)
+    store.get_many([11005000, 11005001])  # [1, 0], or a NumPy array if NumPy is installed.
+    store.set_many(flag_ids, values)  # For example, one flag for each of a batch of instances.
+
+`snapshot()` returns a new store that shares all pages with this one. A page is only copied when one of the two stores
+first writes to it, so snapshots cost one dictionary copy, and `restore(snapshot)` rolls a store back to one.
+
+Pass a store to `EzEnvironment(event_flags=...)` (see `ezstate_simulator`) to have GetEventFlagValue (function 64)
+read it and SetEventState (command 11) write it, so that the scripts of every environment sharing it see each other's
+flags. Each change is reported to the store's `listeners` as a flag ID, which keeps incremental simulators and
+`ezstate_scheduler` up to date.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+PAGE_BITS = 12
+PAGE_FLAGS = 1 << PAGE_BITS  # Flags per page.
+PAGE_SIZE = PAGE_FLAGS // 8  # Bytes per page.
+_PAGE_MASK = PAGE_FLAGS - 1
+_EMPTY_PAGE = bytes(PAGE_SIZE)
+
+
+class EventFlagStore(object):
+
+    def __init__(self, flags=None):
+        """ `flags` can be an iterable of flag IDs to set. """
+        self.pages = {}  # {flag ID >> PAGE_BITS: bytearray of PAGE_SIZE bytes}
+        self._owned = set()  # Pages that no snapshot shares, which can be written in place.
+        self.listeners = []  # Called with each flag ID whose value changes.
+        if flags is not None:
+            self.set_many(list(flags), 1)
+
+    def _writable_page(self, page_number):
+        if page_number in self._owned:
+            return self.pages[page_number]
+        page = self.pages[page_number] = bytearray(self.pages.get(page_number, _EMPTY_PAGE))
+        self._owned.add(page_number)
+        return page
+
+    def get(self, flag_id):
+        """ 1 if the flag is set, else 0. """
+        page = self.pages.get(flag_id >> PAGE_BITS)
+        if page is None:
+            return 0
+        bit = flag_id & _PAGE_MASK
+        return (page[bit >> 3] >> (bit & 7)) & 1
+
+    __getitem__ = get
+
+    def set(self, flag_id, value=1):
+        """ Set (or clear, if `value` is false) a flag. Returns True if its value changed. """
+        if flag_id < 0:
+            raise ValueError('Event flag IDs cannot be negative: {}'.format(flag_id))
+        bit = flag_id & _PAGE_MASK
+        mask = 1 << (bit & 7)
+        page_number = flag_id >> PAGE_BITS
+        current = self.pages.get(page_number)
+        if current is not None and bool(current[bit >> 3] & mask) == bool(value):
+            return False
+        if current is None and not value:
+            return False
+        page = self._writable_page(page_number)
+        if value:
+            page[bit >> 3] |= mask
+        else:
+            page[bit >> 3] &= ~mask
+        for listener in self.listeners:
+            listener(flag_id)
+        return True
+
+    __setitem__ = set
+
+    def get_many(self, flag_ids):
+        """ Values of a batch of flags, as a NumPy uint8 array if NumPy is installed, or else as a list. """
+        if numpy is None:
+            get = self.get
+            return [get(flag_id) for flag_id in flag_ids]
+        flag_ids = numpy.asarray(flag_ids, dtype=numpy.int64)
+        page_numbers, byte_indices = self._byte_indices(flag_ids)
+        data = numpy.frombuffer(b''.join(self.pages.get(page_number, _EMPTY_PAGE) for page_number in page_numbers),
+                                dtype=numpy.uint8)
+        return (data[byte_indices] >> (flag_ids & 7).astype(numpy.uint8)) & 1
+
+    @staticmethod
+    def _byte_indices(flag_ids):
+        """ (sorted distinct page numbers of `flag_ids`, index of each flag's byte in those pages joined together). """
+        all_page_numbers = flag_ids >> PAGE_BITS
+        page_numbers = numpy.unique(all_page_numbers)
+        byte_indices = numpy.searchsorted(page_numbers, all_page_numbers) * PAGE_SIZE + ((flag_ids & _PAGE_MASK) >> 3)
+        return page_numbers.tolist(), byte_indices
+
+    def set_many(self, flag_ids, values=1):
+        """ Set a batch of flags to `values` (one value for all, or one per flag). If a flag is given more than once,
+        the last value wins. Returns the flag IDs whose values changed, which have also been passed to the
+        listeners. """
+        if isinstance(values, (int, bool)):
+            values = [values] * len(flag_ids)
+        # The last value given for a flag wins, and only flags whose final value differs from their current one change.
+        if numpy is None or len(flag_ids) < 64:
+            set_ = self.set
+            return [flag_id for flag_id, value in dict(zip(flag_ids, values)).items() if set_(flag_id, value)]
+        flag_ids = numpy.asarray(flag_ids, dtype=numpy.int64)
+        values = numpy.asarray(values).astype(bool)
+        if len(flag_ids) and flag_ids.min() < 0:
+            raise ValueError('Event flag IDs cannot be negative.')
+        flag_ids, first = numpy.unique(flag_ids[::-1], return_index=True)
+        values = values[::-1][first]
+        changed = flag_ids[self.get_many(flag_ids).astype(bool) != values]
+        page_numbers, byte_indices = self._byte_indices(changed)
+        data = numpy.frombuffer(bytearray(b''.join(self.pages.get(page_number, _EMPTY_PAGE)
+                                                   for page_number in page_numbers)), dtype=numpy.uint8)
+        # Flip each changed bit once (several flags can share a byte, so the flips are accumulated).
+        numpy.bitwise_xor.at(data, byte_indices, (1 << (changed & 7)).astype(numpy.uint8))
+        for i, page_number in enumerate(page_numbers):
+            self.pages[page_number] = bytearray(data[i * PAGE_SIZE:(i + 1) * PAGE_SIZE].tobytes())
+            self._owned.add(page_number)
+        changed = changed.tolist()
+        for listener in self.listeners:
+            for flag_id in changed:
+                listener(flag_id)
+        return changed
+
+    def __iter__(self):
+        """ Set flag IDs, in order. """
+        for page_number in sorted(self.pages):
+            page = self.pages[page_number]
+            base = page_number << PAGE_BITS
+            for byte_index, byte in enumerate(page):
+                while byte:
+                    low_bit = byte & -byte
+                    yield base + (byte_index << 3) + low_bit.bit_length() - 1
+                    byte ^= low_bit
+
+    def __len__(self):
+        """ Number of set flags. """
+        return sum(bin(int.from_bytes(page, 'little')).count('1') for page in self.pages.values())
+
+    def snapshot(self):
+        """ Copy of the current flags that shares pages with this store until either one writes to them. Listeners
+        are not copied. """
+        copy = EventFlagStore()
+        copy.pages = dict(self.pages)
+        self._owned.clear()  # Pages are now shared, so the next write to each one copies it first.
+        return copy
+
+    def changed_flags(self, other):
+        """ Flag IDs whose values differ between this store and `other`. """
+        changed = []
+        for page_number in set(self.pages) | set(other.pages):
+            page = self.pages.get(page_number, _EMPTY_PAGE)
+            other_page = other.pages.get(page_number, _EMPTY_PAGE)
+            if page is other_page or page == other_page:
+                continue
+            difference = int.from_bytes(page, 'little') ^ int.from_bytes(other_page, 'little')
+            base = page_number << PAGE_BITS
+            while difference:
+                low_bit = difference & -difference
+                changed.append(base + low_bit.bit_length() - 1)
+                difference ^= low_bit
+        return sorted(changed)
+
+    def restore(self, snapshot):
+        """ Return to the flags of `snapshot` (which stays unchanged), telling the listeners about every flag that
+        changes. """
+        changed = self.changed_flags(snapshot) if self.listeners else ()
+        self.pages = dict(snapshot.pages)
+        self._owned = set()
+        snapshot._owned.clear()
+        for listener in self.listeners:
+            for flag_id in changed:
+                listener(flag_id)
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Share identical expressions, commands and conditions between many loaded EzStates.
+
+Talk ESDs are largely built from the same templates, so loading a whole directory repeats the same expression bytes
+and the same `Command` and `Condition` trees many times. Pass one `EzInternPool` to every `EzState` (or use
+`load_ezstates`) and each distinct expression, command and condition (including its commands and subconditions) is
+stored once, however many states and files use it:
+
+    ezstates = load_ezstates(['talk'])
+
+Interned objects are shared, so they must be treated as read-only: editing a condition of one state would edit it in
+every state and file that shares it. Copy it first (`copy.deepcopy`) to change it. A shared command or condition keeps
+the `offset` it was first loaded from. Packing is unaffected, as `pack_esd` already packs identical conditions once.
+"""
+
+from collections import OrderedDict
+
+from unpack_esd import Command, Condition, EzState
+from validate_esd import find_esd_files
+
+
+class EzInternPool(object):
+
+    def __init__(self):
+        self.expressions = {}  # {expression: expression}
+        self.commands = {}  # {(unknown, index, args, indent): Command}
+        # {(next_state_index, expression, active, indent, command ids, subcondition ids): Condition}
+        self.conditions = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self.expressions) + len(self.commands) + len(self.conditions)
+
+    def expression(self, expression):
+        self.lookups += 1
+        interned = self.expressions.setdefault(expression, expression)
+        if interned is not expression:
+            self.hits += 1
+        return interned
+
+    def command(self, unknown, index, args=(), indent=0, offset=None):
+        """ Shared `Command` with these fields. `args` must already be interned. """
+        key = (unknown, index, tuple(args), indent)
+        self.lookups += 1
+        try:
+            command = self.commands[key]
+            self.hits += 1
+        except KeyError:
+            command = self.commands[key] = Command(unknown, index, list(args), indent=indent, offset=offset)
+        return command
+
+    def condition(self, next_state_index, expression, commands, subconditions, active, indent, offset):
+        """ Shared `Condition` with these fields. `expression`, `commands` and `subconditions` must already be
+        interned. """
+        key = (next_state_index, expression, active, indent, tuple(map(id, commands)), tuple(map(id, subconditions)))
+        self.lookups += 1
+        try:
+            condition = self.conditions[key]
+            self.hits += 1
+        except KeyError:
+            condition = self.conditions[key] = Condition(
+                next_state_index, expression, commands, subconditions, active=active, print_indent=indent,
+                offset=offset)
+        return condition
+
+    def stats(self):
+        return {'expressions': len(self.expressions), 'commands': len(self.commands),
+                'conditions': len(self.conditions), 'lookups': self.lookups, 'hits': self.hits}
+
+
+def load_ezstates(paths, intern_pool=None, validate=True):
+    """ Load every .esd file in `paths` (files or directories, searched recursively) with one shared intern pool
+    (a new one if `intern_pool` is None). Returns {path: EzState}. """
+    if intern_pool is None:
+        intern_pool = EzInternPool()
+    return OrderedDict((esd_path, EzState(esd_path, validate=validate, intern_pool=intern_pool))
+                       for esd_path in find_esd_files(paths))
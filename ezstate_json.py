@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+Export an EzState to JSON and import it back, one state at a time.
+
+The JSON representation is JSON Lines: one object per line, so that neither side has to hold the whole document.
+
+The first line describes the file:
+
+    {"type": "ezstate", "format_version": 1, "state_table_count": 1 or 2, "esd_name": "..." or null,
+     "file_tail": "<hex>", "header": {...}, "state_header": {...}}
+
+`header` and `state_header` hold the fields of `HEADER` and `SINGLE_STATE_HEADER`/`DOUBLE_STATE_HEADER` as read from
+the file. String fields ('version') are hex, and multi-value fields are lists. Offsets and sizes in them are
+recalculated when packing, so they only need to be present.
+
+Every following line is one state, in the order of the packed state tables (passive states, then active states):
+
+    {"type": "state", "index": 3, "active": false,
+     "enter_commands": [COMMAND, ...], "exit_commands": [...], "unknown_commands": [...],
+     "conditions": [CONDITION, ...]}
+
+    COMMAND = {"unknown": 1, "index": 11, "args": ["<hex>", ...]}
+    CONDITION = {"next_state": 4 or -1, "active": false, "expression": "<hex>",
+                 "commands": [COMMAND, ...], "subconditions": [CONDITION, ...]}
+
+Expressions are the raw packed bytes in hex. With `decoded=True`, commands also get "name" and "decoded_args", and
+conditions "decoded", rendered by `ezparse`; these are ignored on import.
+
+Importing an export gives an EzState that packs to exactly the same bytes as the original. To check many files:
+
+    python ezstate_json.py check [path ...]
+    python ezstate_json.py export FILE.esd FILE.jsonl [--decoded]
+    python ezstate_json.py import FILE.jsonl FILE.esd
+"""
+
+import argparse
+import io
+import json
+import sys
+
+from command_names import COMMAND_NAMES
+from ezstate_parser import ezparse, reset_registers
+from unpack_esd import Command, Condition, DOUBLE_STATE_HEADER, EzState, HEADER, SINGLE_STATE_HEADER, State
+
+FORMAT_VERSION = 1
+
+
+def _header_to_json(ez_struct, header):
+    fields = {}
+    for name, fmt in ez_struct.items():
+        value = header[name]
+        if fmt.endswith('s'):
+            value = value.hex()
+        elif isinstance(value, tuple):
+            value = list(value)
+        fields[name] = value
+    return fields
+
+
+def _header_from_json(ez_struct, fields):
+    header = {}
+    for name, fmt in ez_struct.items():
+        value = fields[name]
+        if fmt.endswith('s'):
+            value = bytes.fromhex(value)
+        elif isinstance(value, list):
+            value = tuple(value)
+        header[name] = value
+    return header
+
+
+def _state_header_struct(state_table_count):
+    return DOUBLE_STATE_HEADER if state_table_count == 2 else SINGLE_STATE_HEADER
+
+
+def command_to_json(command, decoded=False):
+    record = {'unknown': command.unknown, 'index': command.index, 'args': [bytes(arg).hex() for arg in command.args]}
+    if decoded:
+        names = COMMAND_NAMES.get(command.index)
+        record['name'] = names[0] if names else 'command_{}'.format(command.index)
+        record['decoded_args'] = [ezparse(bytes(arg)) for arg in command.args]
+    return record
+
+
+def condition_to_json(condition, decoded=False):
+    record = {'next_state': condition.next_state_index, 'active': bool(condition.active),
+              'expression': bytes(condition.expression).hex()}
+    if decoded:
+        record['decoded'] = ezparse(bytes(condition.expression))
+    record['commands'] = [command_to_json(command, decoded) for command in condition.commands]
+    record['subconditions'] = [condition_to_json(subcondition, decoded) for subcondition in condition.subconditions]
+    return record
+
+
+def state_to_json(state, decoded=False):
+    if decoded:
+        reset_registers()  # Register names are shared by the conditions of a state, as in HTML output.
+    return {
+        'type': 'state',
+        'index': state.index,
+        'active': bool(state.active),
+        'enter_commands': [command_to_json(command, decoded) for command in state.enter_commands],
+        'exit_commands': [command_to_json(command, decoded) for command in state.exit_commands],
+        'unknown_commands': [command_to_json(command, decoded) for command in state.unknown_commands],
+        'conditions': [condition_to_json(condition, decoded) for condition in state.conditions],
+    }
+
+
+def command_from_json(record, indent=0):
+    return Command(record['unknown'], record['index'], [bytes.fromhex(arg) for arg in record['args']], indent=indent)
+
+
+def condition_from_json(record, indent=0):
+    commands = [command_from_json(command, indent + 4) for command in record['commands']]
+    subconditions = [condition_from_json(subcondition, indent + 4) for subcondition in record['subconditions']]
+    # Loaded conditions use tuples for no commands or subconditions, so keep to that for equal output.
+    return Condition(record['next_state'], bytes.fromhex(record['expression']), commands or (), subconditions or (),
+                     active=record['active'], print_indent=indent)
+
+
+def state_from_json(record):
+    return State(record['index'], [condition_from_json(condition) for condition in record['conditions']],
+                 [command_from_json(command) for command in record['enter_commands']],
+                 [command_from_json(command) for command in record['exit_commands']],
+                 [command_from_json(command) for command in record['unknown_commands']],
+                 active=record['active'])
+
+
+def export_ezstate_json(ezstate, output, decoded=False):
+    """ Write `ezstate` to a text stream or file path as JSON Lines, one state at a time. Returns the number of states
+    written. """
+    if not hasattr(output, 'write'):
+        with open(output, 'w', encoding='utf-8') as output_file:
+            return export_ezstate_json(ezstate, output_file, decoded)
+    output.write(json.dumps({
+        'type': 'ezstate',
+        'format_version': FORMAT_VERSION,
+        'state_table_count': ezstate.state_table_count,
+        'esd_name': ezstate.esd_name,
+        'file_tail': bytes(ezstate.file_tail).hex(),
+        'header': _header_to_json(HEADER, ezstate.header),
+        'state_header': _header_to_json(_state_header_struct(ezstate.state_table_count), ezstate.state_header),
+    }, ensure_ascii=False) + '\n')
+    count = 0
+    for state in ezstate.passive_states + ezstate.active_states:
+        output.write(json.dumps(state_to_json(state, decoded), ensure_ascii=False) + '\n')
+        count += 1
+    return count
+
+
+def iter_ezstate_json(source):
+    """ Yield the file record (a dictionary), then each `State`, from a JSON Lines text stream or file path. """
+    if not hasattr(source, 'read'):
+        with open(source, encoding='utf-8') as source_file:
+            yield from iter_ezstate_json(source_file)
+        return
+    file_record = None
+    for line_number, line in enumerate(source, start=1):
+        if not line.strip():
+            continue
+        record = json.loads(line)
+        if file_record is None:
+            if record.get('type') != 'ezstate' or record.get('format_version') != FORMAT_VERSION:
+                raise ValueError('Line {} is not an EzState JSON file record (format version {}).'.format(
+                    line_number, FORMAT_VERSION))
+            file_record = record
+            yield record
+        elif record.get('type') == 'state':
+            yield state_from_json(record)
+        else:
+            raise ValueError('Line {}: unexpected record type {}.'.format(line_number, record.get('type')))
+    if file_record is None:
+        raise ValueError('EzState JSON is empty.')
+
+
+def import_ezstate_json(source):
+    """ EzState read from JSON Lines written by `export_ezstate_json` (a text stream or file path). """
+    records = iter_ezstate_json(source)
+    file_record = next(records)
+    passive_states = []
+    active_states = []
+    for state in records:
+        (active_states if state.active else passive_states).append(state)
+    state_table_count = file_record['state_table_count']
+    header = _header_from_json(HEADER, file_record['header'])
+    header['state_table_count'] = state_table_count
+    state_header = _header_from_json(_state_header_struct(state_table_count), file_record['state_header'])
+    return EzState.from_graph(header, state_header, passive_states, active_states, file_record['esd_name'],
+                              bytes.fromhex(file_record['file_tail']))
+
+
+def check_round_trip(esd_path):
+    """ Export and import one file in memory. Returns None if it packs to the bytes of the original file, or a
+    description that also says whether it matches a repack of the original. """
+    try:
+        with open(esd_path, 'rb') as esd_file:
+            original = esd_file.read()
+        ezstate = EzState(original)
+        buffer = io.StringIO()
+        export_ezstate_json(ezstate, buffer, decoded=True)
+        buffer.seek(0)
+        round_trip = import_ezstate_json(buffer).to_bytes()
+        if round_trip != original:
+            if round_trip == ezstate.to_bytes():
+                return ('JSON round trip packs to different bytes than the file, but to the same bytes as repacking '
+                        'it without JSON.')
+            return 'JSON round trip packs to different bytes than the file and than repacking it without JSON.'
+    except Exception as e:
+        return '{}: {}'.format(type(e).__name__, e)
+    return None
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Convert .esd files to and from JSON Lines.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    export_parser = commands.add_parser('export', help='write an .esd file as JSON Lines')
+    export_parser.add_argument('esd_path')
+    export_parser.add_argument('json_path')
+    export_parser.add_argument('--decoded', action='store_true', help='include rendered expressions')
+    import_parser = commands.add_parser('import', help='pack JSON Lines into an .esd file')
+    import_parser.add_argument('json_path')
+    import_parser.add_argument('esd_path')
+    check_parser = commands.add_parser('check', help='check that .esd files survive a JSON round trip')
+    check_parser.add_argument('paths', nargs='*', default=['.'])
+    args = parser.parse_args()
+
+    if args.command == 'export':
+        export_ezstate_json(EzState(args.esd_path), args.json_path, args.decoded)
+    elif args.command == 'import':
+        import_ezstate_json(args.json_path).write(args.esd_path)
+    else:
+        from multiprocessing import Pool
+        from validate_esd import find_esd_files
+
+        esd_paths = find_esd_files(args.paths)
+        with Pool() as pool:
+            problems = pool.map(check_round_trip, esd_paths, chunksize=max(1, len(esd_paths) // 64))
+        failures = [(path, problem) for path, problem in zip(esd_paths, problems) if problem is not None]
+        for path, problem in failures:
+            print('{}: {}'.format(path, problem))
+        print('{} of {} file(s) failed.'.format(len(failures), len(esd_paths)))
+        sys.exit(1 if failures else 0)
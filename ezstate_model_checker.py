@@ -0,0 +1,479 @@
+# -*- coding: utf-8 -*-
+"""
+Explicit-state model checking of EzState state machines.
+
+`EzStateModelChecker` explores every (state, registers, tracked flags) combination that an `EzState` can reach,
+breadth-first, under the tick semantics of `ezstate_simulator`: the fired conditions of the current state run their
+commands, and a transition runs the exit commands of the old state and the enter commands of the new one.
+
+The environment is abstracted into a bounded domain of values for each function call:
+
+    - Event flags in `tracked_flags` are part of the model state. GetEventFlagValue (function 64) reads them, and
+      SetEventState (command 11) sets them. By default, the flags that the file both reads and sets with constant
+      flag IDs are tracked, and they all start at 0 (or as given by `initial_flags`).
+    - Any other call can return any value in its domain, chosen afresh every tick (a call gives the same value
+      throughout one tick). Domains can be given in `domains`, by (function_index, *args) or by function index.
+      Otherwise, a call's domain has one value for each range of results that its comparisons with constants in the
+      file can tell apart (see `ezstate_pruning.expression_comparisons`), or (0, 1) if it is never compared. Elapsed
+      time (functions 65 and 66) is treated the same way, so the model allows any timer result in any tick.
+
+Only the calls that a tick actually makes are branched on (calls after a 'b7' stop, or in conditions after the one
+that fired, are not made), so most states have few successors. Registers are reset every tick, as in the simulator,
+unless `persistent_registers` is True, in which case they carry over and become part of the model state.
+
+Visited states are kept in a dictionary of parent links. With `hash_compaction=True`, states are stored as their
+64-bit hashes rather than in full, which uses much less memory at a tiny risk of treating two states as one.
+Counterexample traces are rebuilt from the parent links by replaying the path. Budgets are checked before each
+breadth-first level: exploration stops there (with `ModelCheckResult.complete` False) once `max_states` states have
+been visited, or once the estimated memory use of the visited set and frontier passes `memory_budget` bytes. With
+`processes`, each level is expanded by a process pool, which pays off when single ticks are expensive (many calls
+per state) rather than for small scripts.
+
+    checker = EzStateModelChecker(EzState('t100000.esd'))
+    result = checker.check_invariant(lambda s: s.index != 30 or s.flags[11005000])  # State 30 only after the flag.
+    result = checker.check_always_reachable(lambda s: s.index == 0)  # The menu can always be closed.
+    print(result.report())
+
+    python ezstate_model_checker.py FILE.esd [--find STATE | --only-after-flag STATE FLAG | --always-reachable STATE]
+
+exits with 0 if the property holds (or the state is found), 1 if it is violated, and 2 if the budget ran out first.
+"""
+
+import argparse
+from multiprocessing import Pool
+import sys
+
+from command_names import COMMAND_NAMES
+from ezstate_compiler import compile_expression, get_compiled_states
+from ezstate_parser import expression_calls, ezevaluate, function_lookup
+from ezstate_pruning import expression_comparisons
+
+GET_EVENT_FLAG_VALUE = 64
+SET_EVENT_STATE = 11
+DEFAULT_DOMAIN = (0, 1)
+ZERO_REGISTERS = (0,) * 8
+_VISITED_ENTRY_BYTES = 100  # Estimated cost of one dictionary entry of the visited set, excluding its state.
+
+
+class ModelState(object):
+    """ Readable view of a model state: `active`, `index`, `registers` and `flags` ({flag ID: 0 or 1}). """
+
+    def __init__(self, model_state, tracked_flags):
+        self.active, self.index, self.registers, flag_values = model_state
+        self.flags = dict(zip(tracked_flags, flag_values))
+
+    @property
+    def state_key(self):
+        return self.active, self.index
+
+    def __repr__(self):
+        set_flags = [flag for flag, value in self.flags.items() if value]
+        return '<ModelState: {} state {}, flags set: {}>'.format(
+            'active' if self.active else 'passive', self.index, set_flags or 'none')
+
+
+class TraceStep(object):
+    """ One tick of a counterexample trace: the calls that the tick made (as ((function_index, *args), value)
+    pairs), the commands it ran (as (command_index, args) pairs), and the `ModelState` it led to. The first step
+    of a trace is the entry into the first state. """
+
+    def __init__(self, inputs, commands, state):
+        self.inputs = inputs
+        self.commands = commands
+        self.state = state
+
+    def __str__(self):
+        inputs = ', '.join('{}({}) = {}'.format(function_lookup.get(key[0], 'f{}'.format(key[0])),
+                                                ', '.join(str(arg) for arg in key[1:]), value)
+                           for key, value in self.inputs)
+        commands = ', '.join('{}({})'.format(COMMAND_NAMES[index][0] if COMMAND_NAMES.get(index)
+                                             else 'command_{}'.format(index), ', '.join(str(arg) for arg in args))
+                             for index, args in self.commands)
+        return '{}{}-> {}'.format('inputs: {}; '.format(inputs) if inputs else '',
+                                  'commands: {}; '.format(commands) if commands else '', self.state)
+
+
+class ModelCheckResult(object):
+
+    def __init__(self, holds, counterexample, states_visited, transitions, depth, complete, description):
+        self.holds = holds  # Only proven if `complete`: a search stopped by its budget decides nothing.
+        self.counterexample = counterexample  # List of `TraceStep`s, or None.
+        self.states_visited = states_visited
+        self.transitions = transitions
+        self.depth = depth
+        self.complete = complete
+        self.description = description
+
+    def report(self):
+        if not self.complete:
+            verdict = 'Unknown, as the state or memory budget ran out first: {}'.format(self.description)
+        elif self.holds:
+            verdict = 'Holds: {}'.format(self.description)
+        else:
+            verdict = 'Violated: {}'.format(self.description)
+        lines = [verdict, '{} states, {} transitions, depth {}.'.format(
+            self.states_visited, self.transitions, self.depth)]
+        for tick, step in enumerate(self.counterexample or ()):
+            lines.append('  {}: {}'.format(tick, step))
+        return '\n'.join(lines)
+
+
+def _constant_value(expression):
+    """ Value of an argument expression that makes no calls and loads no registers, or None. """
+    def no_call(*_):
+        raise LookupError
+
+    try:
+        return ezevaluate(expression, no_call, [None] * 8)
+    except (LookupError, TypeError, ValueError):
+        return None
+
+
+def _domain(thresholds):
+    """ One value from each range of results that comparisons with `thresholds` can tell apart. """
+    thresholds = sorted(set(thresholds))
+    integers = all(isinstance(threshold, int) for threshold in thresholds)
+    values = [thresholds[0] - 1]
+    for low, high in zip(thresholds, thresholds[1:]):
+        values.append(low)
+        if not integers:
+            values.append((low + high) / 2)
+        elif high - low > 1:
+            values.append(low + 1)
+    values += [thresholds[-1], thresholds[-1] + 1]
+    return tuple(values)
+
+
+class EzStateModelChecker(object):
+
+    def __init__(self, ezstate, tracked_flags=None, extra_tracked_flags=(), initial_flags=None, domains=None,
+                 entry_state_index=0, persistent_registers=False, hash_compaction=False, max_states=None,
+                 memory_budget=None, max_branches=1 << 16, processes=None):
+        self.ezstate = ezstate
+        self.states = {(state.active, state.index): state for state in ezstate.passive_states + ezstate.active_states}
+        self.entry_state_index = entry_state_index
+        self.persistent_registers = persistent_registers
+        self.hash_compaction = hash_compaction
+        self.max_states = max_states
+        self.memory_budget = memory_budget
+        self.max_branches = max_branches  # Most input combinations tried for one tick of one model state.
+        self.processes = processes
+        self.domains = dict(domains or {})
+
+        read_flags = set()
+        set_flags = set()
+        thresholds = {}  # {(function_index, *args) or function_index: set of constants compared with its result}
+        for state in self.states.values():
+            commands = state.enter_commands + state.exit_commands + state.unknown_commands
+            conditions = list(state.conditions)
+            while conditions:
+                condition = conditions.pop()
+                try:
+                    calls = expression_calls(condition.expression)
+                except ValueError:
+                    calls = ()  # Unknown opcode.
+                for call in calls:
+                    if call[0] == GET_EVENT_FLAG_VALUE and len(call) == 2 and call[1] is not None:
+                        read_flags.add(call[1])
+                for key, number in expression_comparisons(condition.expression):
+                    thresholds.setdefault(key, set()).add(number)
+                    thresholds.setdefault(key[0], set()).add(number)
+                commands += condition.commands
+                conditions += condition.subconditions
+            for command in commands:
+                if command.index == SET_EVENT_STATE and command.args:
+                    flag = _constant_value(command.args[0])
+                    if flag is not None:
+                        set_flags.add(flag)
+        if tracked_flags is None:
+            tracked_flags = read_flags & set_flags
+        self.tracked_flags = tuple(sorted(set(tracked_flags) | set(extra_tracked_flags)))
+        self._flag_slots = {flag: slot for slot, flag in enumerate(self.tracked_flags)}
+        self.initial_flags = tuple(1 if (initial_flags or {}).get(flag) else 0 for flag in self.tracked_flags)
+        self._thresholds = {key: _domain(numbers) for key, numbers in thresholds.items()}
+        self._state_functions = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_state_functions'] = None  # Compiled functions are compiled again in each worker process.
+        return state
+
+    def domain(self, key):
+        """ Values that the call `key` ((function_index, *args)) can return in any tick. """
+        for domain_key in (key, key[0]):
+            if domain_key in self.domains:
+                return tuple(self.domains[domain_key])
+        for domain_key in (key, key[0]):
+            if domain_key in self._thresholds:
+                return self._thresholds[domain_key]
+        return DEFAULT_DOMAIN
+
+    def view(self, model_state):
+        return ModelState(model_state, self.tracked_flags)
+
+    def _state_key_hash(self, model_state):
+        return hash(model_state) if self.hash_compaction else model_state
+
+    def _tick_outcomes(self, model_state):
+        """ {successor model state: (inputs, commands)} for every input combination of one tick. A model state of None
+        stands for the reset before the first tick. """
+        if self._state_functions is None:
+            self._state_functions = get_compiled_states(self.ezstate)
+        outcomes = {}
+        prefix = []  # Index into the domain of each call, in the order the calls are made.
+        branches = 0
+        while True:
+            branches += 1
+            if branches > self.max_branches:
+                raise RuntimeError('More than {} input combinations in one tick of {}.'.format(
+                    self.max_branches, model_state))
+            choices = []  # (call key, domain size, index)
+            tick_values = {}
+            flags = list(self.initial_flags if model_state is None else model_state[3])
+
+            def call(function_index, *args):
+                if function_index == GET_EVENT_FLAG_VALUE and args and args[0] in self._flag_slots:
+                    return flags[self._flag_slots[args[0]]]
+                key = (function_index,) + args
+                try:
+                    return tick_values[key]
+                except KeyError:
+                    pass
+                domain = self.domain(key)
+                index = prefix[len(choices)] if len(choices) < len(prefix) else 0
+                choices.append((key, len(domain), index))
+                value = tick_values[key] = domain[index]
+                return value
+
+            commands = []
+
+            def run_commands(commands_):
+                for command in commands_:
+                    args = tuple(compile_expression(arg)(call, [0] * 8) for arg in command.args)
+                    commands.append((command.index, args))
+                    if command.index == SET_EVENT_STATE and args and args[0] in self._flag_slots:
+                        flags[self._flag_slots[args[0]]] = 1 if (args[1] if len(args) > 1 else 1) else 0
+
+            registers = ZERO_REGISTERS
+            if model_state is None:
+                entry_key = (False, self.entry_state_index)
+                state = self.states[entry_key] if entry_key in self.states else self.ezstate.passive_states[0]
+                run_commands(state.enter_commands)
+                state_key = (state.active, state.index)
+            else:
+                state = self.states[model_state[:2]]
+                registers = list(model_state[2] if self.persistent_registers else ZERO_REGISTERS)
+                fired = self._state_functions[model_state[:2]](call, registers)
+                next_condition = None
+                for condition in fired:
+                    run_commands(condition.commands)
+                    if condition.next_state_index != -1:
+                        next_condition = condition
+                state_key = model_state[:2]
+                if next_condition is not None:
+                    run_commands(state.exit_commands)
+                    state_key = (bool(next_condition.active), next_condition.next_state_index)
+                    if state_key in self.states:  # Otherwise a missing state, which has no further ticks.
+                        run_commands(self.states[state_key].enter_commands)
+                registers = tuple(registers) if self.persistent_registers else ZERO_REGISTERS
+            successor = state_key + (registers, tuple(flags))
+            if successor not in outcomes:
+                outcomes[successor] = (tuple((key, self.domain(key)[index]) for key, _, index in choices), commands)
+
+            # Move to the next combination of the calls made, as in counting with mixed bases.
+            prefix = [index for _, _, index in choices]
+            while prefix and prefix[-1] + 1 >= choices[len(prefix) - 1][1]:
+                prefix.pop()
+            if not prefix:
+                return outcomes
+            prefix[-1] += 1
+
+    def successors(self, model_state):
+        """ Model states reachable in one tick from `model_state` (a tuple of (active, index, registers, flag
+        values)), or the initial model states if it is None. """
+        if model_state is not None and model_state[:2] not in self.states:
+            return []
+        return list(self._tick_outcomes(model_state))
+
+    def _state_size(self, model_state):
+        size = sys.getsizeof(model_state) + sys.getsizeof(model_state[2]) + sys.getsizeof(model_state[3])
+        return size + 8 * (len(model_state[2]) + len(model_state[3]))
+
+    def explore(self, stop=None, predecessors=None):
+        """ Breadth-first search of the reachable model states. If `stop(model_state)` returns True for a state,
+        the search ends there. Returns (visited {state or hash: parent state or hash, in breadth-first order}, the
+        state that stopped the search or None, transitions, depth, complete). If `predecessors` is a dictionary, it
+        is filled with {state or hash: [every state or hash with a transition to it]}. """
+        visited = {}
+        frontier = []
+        for initial in self.successors(None):
+            key = self._state_key_hash(initial)
+            if key not in visited:
+                visited[key] = None
+                frontier.append(initial)
+                if stop is not None and stop(initial):
+                    return visited, initial, 0, 0, False
+        transitions = 0
+        depth = 0
+        state_size = None
+        pool = None
+        if self.processes is not None and self.processes > 1:
+            pool = Pool(self.processes, _initialise_worker, (self,))
+        try:
+            while frontier:
+                if state_size is None:
+                    state_size = self._state_size(frontier[0])
+                entry_size = _VISITED_ENTRY_BYTES + (0 if self.hash_compaction else state_size)
+                if ((self.max_states is not None and len(visited) >= self.max_states) or
+                        (self.memory_budget is not None and
+                         len(visited) * entry_size + len(frontier) * state_size > self.memory_budget)):
+                    return visited, None, transitions, depth, False
+                depth += 1
+                if pool is None:
+                    expanded = map(self.successors, frontier)
+                else:
+                    expanded = pool.imap(_expand_in_worker, _chunks(frontier, max(1, len(frontier) // 64)))
+                    expanded = (successors for chunk in expanded for successors in chunk)
+                next_frontier = []
+                for parent, successors in zip(frontier, expanded):
+                    parent_key = self._state_key_hash(parent)
+                    for successor in successors:
+                        transitions += 1
+                        key = self._state_key_hash(successor)
+                        if predecessors is not None:
+                            predecessors.setdefault(key, []).append(parent_key)
+                        if key in visited:
+                            continue
+                        visited[key] = parent_key
+                        next_frontier.append(successor)
+                        if stop is not None and stop(successor):
+                            return visited, successor, transitions, depth, False
+                frontier = next_frontier
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        return visited, None, transitions, depth, True
+
+    def trace(self, visited, model_state):
+        """ Counterexample trace (list of `TraceStep`s) from the entry to `model_state`, rebuilt from the parent links
+        of `visited` by replaying the path. """
+        path = []
+        key = self._state_key_hash(model_state)
+        while key is not None:
+            path.append(key)
+            key = visited[key]
+        path.reverse()
+        steps = []
+        current = None
+        for key in path:
+            for successor, (inputs, commands) in self._tick_outcomes(current).items():
+                if self._state_key_hash(successor) == key:
+                    steps.append(TraceStep(inputs, commands, self.view(successor)))
+                    current = successor
+                    break
+            else:
+                raise RuntimeError('Could not replay the path to {} (hash collision?).'.format(model_state))
+        return steps
+
+    def _result(self, holds, visited, bad_state, transitions, depth, complete, description):
+        counterexample = None if bad_state is None else self.trace(visited, bad_state)
+        return ModelCheckResult(holds, counterexample, len(visited), transitions, depth, complete, description)
+
+    def check_invariant(self, invariant, description='invariant'):
+        """ Check that `invariant(ModelState)` is true in every reachable model state. The counterexample is a
+        shortest trace to a state where it is false. """
+        visited, bad_state, transitions, depth, complete = self.explore(
+            lambda model_state: not invariant(self.view(model_state)))
+        return self._result(bad_state is None, visited, bad_state, transitions, depth,
+                            complete or bad_state is not None, description)
+
+    def find_state(self, predicate, description='target'):
+        """ Search for a reachable model state where `predicate(ModelState)` is true. `holds` is True if one was found,
+        and the shortest trace to it is given as `counterexample` (here, a witness). If none was found before the budget
+        ran out, `complete` is False and the answer is unknown. """
+        result = self.check_invariant(lambda model_state: not predicate(model_state), description)
+        result.holds = not result.holds
+        return result
+
+    def check_always_reachable(self, target, description='target always reachable'):
+        """ Check that from every reachable model state, some model state where `target(ModelState)` is true can still
+        be reached. The counterexample is a shortest trace to a state from which it cannot. Needs the whole reachable
+        state graph, so the predecessors of every state are kept until the search ends. """
+        if self.hash_compaction:
+            raise ValueError('Checking that a target is always reachable needs full states (hash_compaction=False).')
+        predecessors = {}
+        visited, _, transitions, depth, complete = self.explore(predecessors=predecessors)
+        can_reach = set()
+        stack = [model_state for model_state in visited if target(self.view(model_state))]
+        while stack:
+            model_state = stack.pop()
+            if model_state in can_reach:
+                continue
+            can_reach.add(model_state)
+            stack += predecessors.get(model_state, ())
+        if complete:
+            # Visited states are in breadth-first order, so this gives a shortest trace.
+            for model_state in visited:
+                if model_state not in can_reach:
+                    return self._result(False, visited, model_state, transitions, depth, True, description)
+        # An incomplete search cannot show that the target is unreachable, as it may lie beyond the budget.
+        return self._result(True, visited, None, transitions, depth, complete, description)
+
+
+_WORKER_CHECKER = None
+
+
+def _initialise_worker(checker):
+    global _WORKER_CHECKER
+    _WORKER_CHECKER = checker
+
+
+def _expand_in_worker(model_states):
+    return [_WORKER_CHECKER.successors(model_state) for model_state in model_states]
+
+
+def _chunks(items, size):
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Model check an .esd file.')
+    parser.add_argument('esd_path')
+    prop = parser.add_mutually_exclusive_group()
+    prop.add_argument('--find', type=int, default=None, metavar='STATE', help='find a trace to a passive state')
+    prop.add_argument('--only-after-flag', type=int, nargs=2, default=None, metavar=('STATE', 'FLAG'),
+                      help='check that a passive state is only reached while an event flag is set')
+    prop.add_argument('--always-reachable', type=int, default=None, metavar='STATE',
+                      help='check that a passive state can be reached again from every reachable state')
+    parser.add_argument('--flag', type=int, action='append', default=None, help='event flag to track (repeatable)')
+    parser.add_argument('--max-states', type=int, default=None, help='stop after visiting this many states')
+    parser.add_argument('--memory-budget', type=float, default=None, help='stop at this estimated memory use (MB)')
+    parser.add_argument('--hash-compaction', action='store_true', help='store visited states as 64-bit hashes')
+    parser.add_argument('--processes', '-j', type=int, default=None, help='expand each level with a process pool')
+    args = parser.parse_args()
+
+    from unpack_esd import EzState
+
+    checker_ = EzStateModelChecker(
+        EzState(args.esd_path), tracked_flags=args.flag,
+        extra_tracked_flags=() if args.only_after_flag is None else (args.only_after_flag[1],),
+        hash_compaction=args.hash_compaction,
+        max_states=args.max_states, processes=args.processes,
+        memory_budget=None if args.memory_budget is None else int(args.memory_budget * (1 << 20)))
+    if args.find is not None:
+        result_ = checker_.find_state(lambda s: not s.active and s.index == args.find,
+                                      'passive state {} is reachable'.format(args.find))
+    elif args.only_after_flag is not None:
+        target_state, flag_id = args.only_after_flag
+        result_ = checker_.check_invariant(
+            lambda s: s.active or s.index != target_state or s.flags[flag_id],
+            'passive state {} is only reached while flag {} is set'.format(target_state, flag_id))
+    elif args.always_reachable is not None:
+        result_ = checker_.check_always_reachable(lambda s: not s.active and s.index == args.always_reachable,
+                                                  'passive state {} is always reachable'.format(args.always_reachable))
+    else:
+        result_ = checker_.check_invariant(lambda s: True, 'exploration')
+    print(result_.report())
+    sys.exit(2 if not result_.complete else 0 if result_.holds else 1)
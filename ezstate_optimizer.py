@@ -0,0 +1,199 @@
+# -*- coding: utf-8 -*-
+"""
+Shorten packed EzState expressions without changing what they evaluate to.
+
+`optimize_expression` applies these rewrites:
+
+    - '82' integers from -1 to 63 are written in the one-byte form (3f-7f).
+    - Comparisons and 'and'/'or' of two numeric constants are replaced by their result (40 or 41).
+    - Stores to registers that are never loaded in the state are removed.
+    - 'a6' is removed if no 'b7' follows it, and 'b7' is removed where it cannot stop anything: at the end of the
+      expression, straight after another 'b7' on the same value, or after a true constant. This holds under either of
+      the hypotheses for these bytes described in `ezstate_parser.ezparse`.
+    - After a 'b7' on a false constant, the rest of the expression is dropped, since evaluation always stops there.
+
+Register stores are only removed from condition expressions. Command argument expressions keep all of their stores,
+as it is not known whether the game evaluates them with the registers of the state's conditions. Expressions with
+unknown opcodes are left unchanged.
+
+Use `EzState.write(..., optimize=True)` (or `pack_esd(optimize=True)`) to optimize while repacking, or run this module
+to report the bytes saved for many files:
+
+    python ezstate_optimizer.py [--output DIR] [path ...]
+"""
+
+import argparse
+import os
+from struct import pack
+
+from ezstate_parser import comparison_lookup, iter_instructions
+
+ALL_REGISTERS = frozenset(range(8))
+
+_NOT_CONSTANT = object()
+
+
+def _decode(expression):
+    """ List of (opcode, instruction bytes, constant value or _NOT_CONSTANT). Raises ValueError on unknown opcodes. """
+    return [(byte, bytes(expression[offset:end]), _NOT_CONSTANT if operand is None else operand)
+            for offset, byte, operand, end in iter_instructions(expression)]
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _constant_bytes(value):
+    if isinstance(value, int) and -1 <= value <= 63:
+        return bytes([value + 64])
+    return b'\x82' + pack('<i', value)
+
+
+def optimize_expression(expression, live_registers=ALL_REGISTERS):
+    """ Optimized copy of a packed expression (see module docstring). Stores to registers that are not in
+    `live_registers` (or loaded by the expression itself) are removed. """
+    try:
+        instructions = _decode(expression)
+    except ValueError:
+        return bytes(expression)  # The stack effects of unknown opcodes are not known, so nothing can be rewritten.
+    live_registers = set(live_registers)
+    live_registers.update(instruction[0] - 0xaf for instruction in instructions if 0xaf <= instruction[0] <= 0xb6)
+    last_b7 = max((i for i, instruction in enumerate(instructions) if instruction[0] == 0xb7), default=-1)
+    output = []  # Instruction bytes.
+    stack = []  # (index in `output` where the value's instructions begin, constant value or _NOT_CONSTANT)
+    checked = False  # The value on top of the stack has already passed a 'b7'.
+
+    for i, (byte, code, value) in enumerate(instructions):
+        if byte == 0xa1:
+            break
+        if value is not _NOT_CONSTANT or byte == 0xa5:
+            stack.append((len(output), value if byte != 0xa5 else _NOT_CONSTANT))
+            output.append(_constant_bytes(value) if byte == 0x82 else code)
+            checked = False
+        elif 0x84 <= byte <= 0x87:
+            del stack[len(stack) - (byte - 0x84):]
+            stack[-1] = (stack[-1][0], _NOT_CONSTANT)
+            output.append(code)
+            checked = False
+        elif 0x91 <= byte <= 0x96 or byte == 0x98 or byte == 0x99:
+            right = stack.pop()
+            left = stack[-1]
+            if (_is_number(left[1]) and _is_number(right[1])
+                    and len(output) - left[0] == 2):  # Nothing but the two constants to remove.
+                if byte == 0x98:
+                    result = 1 if left[1] and right[1] else 0
+                elif byte == 0x99:
+                    result = 1 if left[1] or right[1] else 0
+                else:
+                    result = 1 if comparison_lookup[byte](left[1], right[1]) else 0
+                del output[left[0]:]
+                output.append(_constant_bytes(result))
+                stack[-1] = (left[0], result)
+            else:
+                output.append(code)
+                stack[-1] = (left[0], _NOT_CONSTANT)
+            checked = False
+        elif byte == 0xa6:
+            if i < last_b7:
+                output.append(code)  # Still removed at the end if the 'b7' after it is.
+        elif 0xa7 <= byte <= 0xae:
+            if byte - 0xa7 in live_registers:
+                output.append(code)
+        elif 0xaf <= byte <= 0xb6:
+            stack.append((len(output), _NOT_CONSTANT))
+            output.append(code)
+            checked = False
+        elif byte == 0xb7:
+            top = stack[-1][1]
+            if _is_number(top) and not top:
+                break  # Always stops here, with this false value.
+            if checked or _is_number(top):
+                continue
+            output.append(code)
+            checked = True
+
+    # Trailing 'b7' stops nothing, and 'a6' does nothing without a later 'b7'.
+    while output and output[-1] in (b'\xb7', b'\xa6'):
+        output.pop()
+    last_b7 = max((i for i, code in enumerate(output) if code == b'\xb7'), default=-1)
+    output = output[:last_b7 + 1] + [code for code in output[last_b7 + 1:] if code != b'\xa6']
+    output.append(b'\xa1')
+    return b''.join(output)
+
+
+def _loaded_registers(expression):
+    try:
+        instructions = _decode(expression)
+    except ValueError:
+        return set(ALL_REGISTERS)  # May load any register.
+    return {instruction[0] - 0xaf for instruction in instructions if 0xaf <= instruction[0] <= 0xb6}
+
+
+def _state_expressions(state):
+    """ (condition expressions, command argument expressions) of a state, including subconditions. """
+    conditions = []
+    args = [arg for commands in (state.enter_commands, state.exit_commands, state.unknown_commands)
+            for command in commands for arg in command.args]
+    stack = list(state.conditions)
+    while stack:
+        condition = stack.pop()
+        conditions.append(condition.expression)
+        args += [arg for command in condition.commands for arg in command.args]
+        stack += condition.subconditions
+    return conditions, args
+
+
+def optimize_ezstate_expressions(ezstate):
+    """ Returns ({condition expression: optimized}, {argument expression: optimized}) for every distinct expression.
+    A register store in a condition expression is kept if any state that uses the expression loads that register. """
+    live_registers = {}  # {condition expression: registers loaded by any state that uses it}
+    arg_expressions = set()
+    for state in ezstate.passive_states + ezstate.active_states:
+        conditions, args = _state_expressions(state)
+        arg_expressions.update(args)
+        loaded = set()
+        for expression in conditions + args:
+            loaded |= _loaded_registers(expression)
+        for expression in conditions:
+            live_registers.setdefault(expression, set()).update(loaded)
+    condition_map = {expression: optimize_expression(expression, live) for expression, live in live_registers.items()}
+    arg_map = {expression: optimize_expression(expression) for expression in arg_expressions}
+    return condition_map, arg_map
+
+
+def optimize_esd_file(esd_path, output_path=None):
+    """ Repack an .esd file with optimized expressions and write it to `output_path` (if given). Returns a report
+    dictionary of bytes saved. """
+    from unpack_esd import EzState
+
+    with open(esd_path, 'rb') as esd_file:
+        original = esd_file.read()
+    ezstate = EzState(original)
+    tables = ezstate.pack_esd(optimize=True)
+    optimized = ezstate.to_bytes(tables)
+    if output_path is not None:
+        with open(output_path, 'wb') as output_file:
+            output_file.write(optimized)
+    report = dict(tables['optimization'])
+    report.update(path=esd_path, original_size=len(original), optimized_size=len(optimized))
+    return report
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Report (and optionally write) optimized .esd files.')
+    parser.add_argument('paths', nargs='*', default=['.'], help='.esd files or directories to search')
+    parser.add_argument('--output', '-o', default=None, help='directory to write optimized files to')
+    args = parser.parse_args()
+
+    from validate_esd import find_esd_files
+
+    total_saved = 0
+    for path in find_esd_files(args.paths):
+        output = None if args.output is None else os.path.join(args.output, os.path.basename(path))
+        result = optimize_esd_file(path, output)
+        total_saved += result['original_size'] - result['optimized_size']
+        print('{}: {} condition and {} argument expression bytes saved, {} -> {} bytes'.format(
+            path, result['condition_bytes_saved'], result['arg_bytes_saved'], result['original_size'],
+            result['optimized_size']))
+    print('{} bytes saved in total.'.format(total_saved))
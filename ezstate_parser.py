@@ -3,7 +3,8 @@
 @author: grimrhapsody
 """
 
-from struct import unpack
+import operator
+from struct import pack, unpack, unpack_from
 
 
 REGISTERS = [''] * 8
@@ -101,6 +102,95 @@ function_lookup = {
 }
 
 
+# Validation table: opcode -> (operand size, values required on stack, stack change). Operand size -1 is a
+# null-terminated UTF-16LE string. Opcodes missing from the table are unknown (including 83 and 88-90).
+OPCODE_STACK_EFFECTS = {0x80: (4, 0, 1), 0x81: (8, 0, 1), 0x82: (4, 0, 1), 0xa5: (-1, 0, 1),
+                        0x84: (0, 1, 0), 0x85: (0, 2, -1), 0x86: (0, 3, -2), 0x87: (0, 4, -3),
+                        0x98: (0, 2, -1), 0x99: (0, 2, -1), 0xa6: (0, 1, 0), 0xb7: (0, 1, 0)}
+OPCODE_STACK_EFFECTS.update({byte: (0, 0, 1) for byte in range(0x3f, 0x80)})  # small integers
+OPCODE_STACK_EFFECTS.update({byte: (0, 2, -1) for byte in range(0x91, 0x97)})  # comparisons
+OPCODE_STACK_EFFECTS.update({byte: (0, 1, 0) for byte in range(0xa7, 0xaf)})  # register stores
+OPCODE_STACK_EFFECTS.update({byte: (0, 0, 1) for byte in range(0xaf, 0xb7)})  # register loads
+_OPCODE_TABLE = [OPCODE_STACK_EFFECTS.get(byte) for byte in range(256)]
+_OPERAND_FORMATS = {0x80: '<f', 0x81: '<d', 0x82: '<i'}
+_OPERAND_SIZES = [effect and effect[0] for effect in _OPCODE_TABLE]
+_SMALL_INTEGERS = [byte - 64 if 0x3f <= byte <= 0x7f else None for byte in range(256)]
+
+
+def iter_instructions(expression):
+    """ Decode a packed expression into (offset, opcode, operand, end) tuples, up to and including its 'a1'.
+
+    `operand` is the constant an instruction pushes (an int, float or str), or None for instructions that push no
+    constant, and `end` is the offset of the next instruction. Operand sizes are taken from `OPCODE_STACK_EFFECTS`.
+    Raises ValueError on an unknown opcode, or an operand that runs past the end of the expression.
+    """
+    sizes = _OPERAND_SIZES
+    size = len(expression)
+    offset = 0
+    while offset < size:
+        byte = expression[offset]
+        end = offset + 1
+        operand_size = sizes[byte]
+        if operand_size == 0:
+            yield offset, byte, _SMALL_INTEGERS[byte], end
+        elif operand_size is None:
+            if byte == 0xa1:
+                yield offset, byte, None, end
+                return
+            raise ValueError('Unknown opcode {:02x} at byte {}: {}'.format(byte, offset, bytes(expression).hex()))
+        elif operand_size > 0:
+            end += operand_size
+            if end > size:
+                raise ValueError('Opcode {:02x} operand runs past end of expression: {}'.format(
+                    byte, bytes(expression).hex()))
+            yield offset, byte, unpack_from(_OPERAND_FORMATS[byte], expression, offset + 1)[0], end
+        else:
+            while True:
+                if end + 2 > size:
+                    raise ValueError('Unterminated string in expression: {}'.format(bytes(expression).hex()))
+                end += 2
+                if expression[end - 2] == 0 and expression[end - 1] == 0:
+                    break
+            yield offset, byte, bytes(expression[offset + 1:end - 2]).decode('utf-16le'), end
+        offset = end
+
+
+def validate_expression(expression, registers=None):
+    """ Check a packed expression in one pass without rendering it. Raises ValueError on the first problem.
+
+    Checks that every opcode is known, operands are complete, the stack holds enough values for each call, comparison
+    and logical operation, and the expression ends with a single 'a1'. If `registers` is given, it should be a set of
+    register indices stored earlier in the same state's conditions; it is updated with this expression's stores, and
+    loading a register that has not been stored is an error.
+    """
+    table = _OPCODE_TABLE
+    size = len(expression)
+    if size == 0 or expression[-1] != 0xa1:
+        raise ValueError('Expression does not end with a1: {}'.format(bytes(expression).hex()))
+    depth = 0
+    for offset, byte, _, end in iter_instructions(expression):
+        if byte == 0xa1:
+            if offset != size - 1:
+                raise ValueError('Expression ends early at byte {}: {}'.format(offset, bytes(expression).hex()))
+            break
+        if end > size - 1:
+            raise ValueError('Opcode {:02x} operand runs past end of expression: {}'.format(
+                byte, bytes(expression).hex()))
+        _, required, change = table[byte]
+        if depth < required:
+            raise ValueError('Opcode {:02x} at byte {} needs {} value(s) but stack has {}: {}'.format(
+                byte, offset, required, depth, bytes(expression).hex()))
+        if registers is not None and 0xa7 <= byte <= 0xb6:
+            if byte <= 0xae:
+                registers.add(byte - 0xa7)
+            elif byte - 0xaf not in registers:
+                raise ValueError('Register {} is loaded at byte {} before it is stored: {}'.format(
+                    byte - 0xaf, offset, bytes(expression).hex()))
+        depth += change
+    if depth < 1:
+        raise ValueError('Expression leaves no value on the stack: {}'.format(bytes(expression).hex()))
+
+
 def ezparse(input_line, full_brackets=False):
     """ input_line can be a bytes object, or a list of hex byte strings. """
     if isinstance(input_line, bytes):
@@ -250,3 +340,240 @@ def ezparse(input_line, full_brackets=False):
                 output_line.append(marker)
 
     return ' '.join(output_line)
+
+
+comparison_lookup = {
+    0x91: operator.le,
+    0x92: operator.ge,
+    0x93: operator.lt,
+    0x94: operator.gt,
+    0x95: operator.eq,
+    0x96: operator.ne,
+}
+
+
+def ezevaluate(expression, call, registers):
+    """ Evaluate a packed expression with a plain stack interpreter and return its final value.
+
+    `call(function_index, *args)` supplies function results, and `registers` is a list of eight values shared by the
+    conditions of one state evaluation. Comparisons and logical operations give 1 or 0. Following the hypotheses
+    described in `ezparse`, 'b7' stops evaluation (returning the false value) if the previous value is false, and 'a6'
+    has no effect on the result. Compiled expressions (see `ezstate_compiler`) must give the same results.
+    """
+    stack = []
+    for _, byte, operand, _ in iter_instructions(expression):
+        if operand is not None:
+            stack.append(operand)
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            args = stack[len(stack) - arg_count:]
+            del stack[len(stack) - arg_count:]
+            stack[-1] = call(stack[-1], *args)
+        elif 0x91 <= byte <= 0x96:
+            right = stack.pop()
+            stack[-1] = 1 if comparison_lookup[byte](stack[-1], right) else 0
+        elif byte == 0x98:
+            right = stack.pop()
+            stack[-1] = 1 if stack[-1] and right else 0
+        elif byte == 0x99:
+            right = stack.pop()
+            stack[-1] = 1 if stack[-1] or right else 0
+        elif byte == 0xa6:
+            pass
+        elif 0xa7 <= byte <= 0xae:
+            registers[byte - 0xa7] = stack[-1]
+        elif 0xaf <= byte <= 0xb6:
+            stack.append(registers[byte - 0xaf])
+        elif byte == 0xb7:
+            if not stack[-1]:
+                return stack[-1]
+    return stack[-1]
+
+
+class _Unknown(object):
+    """ Stack value that is not known before evaluation (a function result, comparison, or register). """
+
+
+def expression_calls(expression):
+    """ Static set of the function calls an expression may make, as (function_index, *args) tuples. Calls whose
+    function index or arguments are not constants (for example, nested calls or register loads) are given as
+    (function_index, None) or (None,), meaning the expression may read any such call.
+    """
+    unknown = _Unknown()
+    calls = set()
+    stack = []
+    for _, byte, operand, _ in iter_instructions(expression):
+        if operand is not None:
+            stack.append(operand)
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            args = tuple(stack[len(stack) - arg_count:])
+            del stack[len(stack) - arg_count:]
+            if stack[-1] is unknown:
+                calls.add((None,))
+            elif any(arg is unknown for arg in args):
+                calls.add((stack[-1], None))
+            else:
+                calls.add((stack[-1],) + args)
+            stack[-1] = unknown
+        elif 0x91 <= byte <= 0x99 and byte != 0x97:
+            stack.pop()
+            stack[-1] = unknown
+        elif byte == 0xa6 or byte == 0xb7 or 0xa7 <= byte <= 0xae:
+            pass
+        elif 0xaf <= byte <= 0xb6:
+            stack.append(unknown)
+    return calls
+
+
+class _ElapsedTime(object):
+    """ Result of an elapsed time call (function 65 or 66) during static analysis. """
+
+    def __init__(self, function_index):
+        self.function_index = function_index
+
+
+def expression_timers(expression, timer_functions=(65, 66)):
+    """ Comparisons between the results of `timer_functions` (by default, elapsed frames and time in the current state)
+    and constants, as (function_index, comparison_opcode, constant, function_on_left) tuples. Returns None if a timer
+    result is used in any other way, as its effect on the expression then cannot be predicted from these comparisons.
+    """
+    unknown = _Unknown()
+    timers = []
+    stack = []
+    for _, byte, operand, _ in iter_instructions(expression):
+        if operand is not None:
+            stack.append(operand)
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            args = stack[len(stack) - arg_count:]
+            del stack[len(stack) - arg_count:]
+            if any(isinstance(value, _ElapsedTime) for value in args + [stack[-1]]):
+                return None
+            stack[-1] = _ElapsedTime(stack[-1]) if stack[-1] in timer_functions else unknown
+        elif 0x91 <= byte <= 0x96:
+            left, right = stack[-2], stack.pop()
+            if isinstance(left, _ElapsedTime) or isinstance(right, _ElapsedTime):
+                timer, constant = (left, right) if isinstance(left, _ElapsedTime) else (right, left)
+                if not isinstance(constant, (int, float)) or isinstance(constant, bool):
+                    return None
+                timers.append((timer.function_index, byte, constant, timer is left))
+            stack[-1] = unknown
+        elif byte == 0x98 or byte == 0x99:
+            if isinstance(stack[-1], _ElapsedTime) or isinstance(stack[-2], _ElapsedTime):
+                return None
+            stack.pop()
+            stack[-1] = unknown
+        elif byte == 0xa6:
+            pass
+        elif 0xa7 <= byte <= 0xae or byte == 0xb7:
+            if isinstance(stack[-1], _ElapsedTime):
+                return None
+        elif 0xaf <= byte <= 0xb6:
+            stack.append(unknown)
+    if stack and isinstance(stack[-1], _ElapsedTime):
+        return None
+    return timers
+
+
+def expression_literals(expression):
+    """ Constants pushed by an expression (numbers and strings), in order, except function indices of calls. """
+    literals = []
+    stack = []  # Index in `literals` of each stack value that is a constant, or None.
+    for _, byte, operand, _ in iter_instructions(expression):
+        if operand is not None:
+            stack.append(len(literals))
+            literals.append(operand)
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            del stack[len(stack) - arg_count:]
+            if stack[-1] is not None:
+                literals[stack[-1]] = None  # Function index.
+            stack[-1] = None
+        elif 0x91 <= byte <= 0x99 and byte != 0x97:
+            stack.pop()
+            stack[-1] = None
+        elif 0xaf <= byte <= 0xb6:
+            stack.append(None)
+    return [value for value in literals if value is not None]
+
+
+def _constant_bytes(value, opcode):
+    """ Encoding of a new numeric constant that replaces one with `opcode`, the same size as before if that holds the
+    value exactly. Raises ValueError for integers that do not fit in 32 bits. """
+    if opcode == 0x81:
+        return b'\x81' + pack('<d', value)
+    if isinstance(value, float) or opcode == 0x80:
+        try:
+            single = pack('<f', value)
+        except OverflowError:
+            single = None
+        if single is not None and unpack('<f', single)[0] == value:
+            return b'\x80' + single
+        if isinstance(value, float):
+            return b'\x81' + pack('<d', value)
+    if not -2 ** 31 <= value < 2 ** 31:
+        raise ValueError('Integer constant {} does not fit in 32 bits'.format(value))
+    if opcode == 0x82 or not -1 <= value <= 63:
+        return b'\x82' + pack('<i', value)
+    return bytes([value + 64])
+
+
+def replace_expression_constants(expression, substitutions, function_index=None):
+    """ Copy of an expression with its numeric constants replaced according to `substitutions` ({old: new}), and the
+    number of constants replaced. Function indices are never replaced. If `function_index` is given, only constants
+    that are arguments of calls to that function, or that are compared with the result of such a call, are replaced.
+
+    A replaced constant keeps its encoding if the new value allows it, so the expression only changes size if a
+    one-byte integer (-1 to 63) is replaced by a larger integer or a float, or if a single-precision float is replaced
+    by a value it cannot hold exactly (which is written as a 32-bit integer or a double instead).
+    """
+    matched_call = object()  # Result of a call to `function_index`.
+    codes = []  # Bytes of each instruction.
+    values = {}  # {index in `codes`: value} of numeric constants.
+    candidates = set()  # Indices in `codes` of constants that may be replaced.
+    stack = []  # Index in `codes` of each stack value that is a numeric constant, `matched_call`, or None.
+    for start, byte, operand, end in iter_instructions(expression):
+        if byte == 0xa5:
+            stack.append(None)
+        elif operand is not None:
+            values[len(codes)] = operand
+            stack.append(len(codes))
+            if function_index is None:
+                candidates.add(len(codes))
+        elif 0x84 <= byte <= 0x87:
+            arg_count = byte - 0x84
+            args = stack[len(stack) - arg_count:]
+            del stack[len(stack) - arg_count:]
+            called = None
+            if isinstance(stack[-1], int):
+                called = values[stack[-1]]
+                candidates.discard(stack[-1])  # Function index.
+            if function_index is not None and called == function_index:
+                candidates.update(arg for arg in args if isinstance(arg, int))
+                stack[-1] = matched_call
+            else:
+                stack[-1] = None
+        elif 0x91 <= byte <= 0x96:
+            left, right = stack[-2], stack.pop()
+            if left is matched_call and isinstance(right, int):
+                candidates.add(right)
+            elif right is matched_call and isinstance(left, int):
+                candidates.add(left)
+            stack[-1] = None
+        elif byte == 0x98 or byte == 0x99:
+            stack.pop()
+            stack[-1] = None
+        elif byte == 0xa1:
+            codes.append(bytes(expression[start:]))
+            break
+        elif 0xaf <= byte <= 0xb6:
+            stack.append(None)
+        codes.append(bytes(expression[start:end]))
+
+    replaced = 0
+    for index in sorted(candidates):
+        if values[index] in substitutions:
+            codes[index] = _constant_bytes(substitutions[values[index]], codes[index][0])
+            replaced += 1
+    return b''.join(codes), replaced
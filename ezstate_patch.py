@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""
+Mechanical edits of packed .esd files, made directly on their bytes.
+
+`EzStatePatcher` reads only the tables of a file, not the state graph, and replaces numeric constants in command
+argument and condition expressions:
+
+    patcher = EzStatePatcher('t100000.esd')
+    patcher.replace_command_args(11, {11005000: 11005010}, arg_positions=[0])  # Event flags set by SetEventState.
+    patcher.replace_condition_constants({11005000: 11005010}, function_index=64)  # GetEventFlagValue tests.
+    patcher.write('t100000.esd')
+
+Replaced constants keep their encoding where possible (see `ezstate_parser.replace_expression_constants`), so most
+edits leave every expression the same size and are written over the old bytes. The file is only rebuilt with
+`EzState` and repacked if an expression changes size, or if its bytes are shared by a table row that the edit does not
+apply to (packed files can point several rows at the same expression).
+
+Patches can also be given as a list of dictionaries (as loaded from a JSON file) and applied to many files at once:
+
+    {"command": 11, "args": [0], "replace": {"11005000": 11005010}}   (command arguments)
+    {"function": 64, "replace": {"11005000": 11005010}}               (condition constants)
+
+    python ezstate_patch.py PATCHES.json (--output DIR | --in-place) [path ...]
+"""
+
+import argparse
+import json
+from multiprocessing import Pool
+import os
+import sys
+
+from ezstate_parser import replace_expression_constants
+from unpack_esd import (COMMAND, COMMAND_ARG, CONDITION, CONDITION_POINTER, DOUBLE_STATE_HEADER, EzState, HEADER,
+                        SINGLE_STATE_HEADER, STATE)
+
+# Little-endian row structs of the tables this module reads and patches.
+CONDITION_ROW = CONDITION.schema.struct
+COMMAND_ROW = COMMAND.schema.struct
+COMMAND_ARG_ROW = COMMAND_ARG.schema.struct
+
+
+class EzStatePatcher(object):
+
+    def __init__(self, esd_source):
+        """ `esd_source` can be a file path or a bytes-like object. """
+        if isinstance(esd_source, (str, os.PathLike)):
+            self.input_path = esd_source
+            with open(esd_source, 'rb') as esd_file:
+                self.data = bytearray(esd_file.read())
+        else:
+            self.input_path = None
+            self.data = bytearray(esd_source)
+        header = HEADER.unpack(bytes(self.data[:HEADER.size]))[-HEADER.size]
+        if header['state_table_count'] == 2:
+            table_offset = DOUBLE_STATE_HEADER.size
+        else:
+            table_offset = SINGLE_STATE_HEADER.size
+        table_offset += header['state_row_count'] * STATE.size
+
+        # Offsets are relative to the end of the header, as in `EzState`.
+        self.conditions = {}  # {condition row offset: (expression offset, expression size)}
+        for i, row in enumerate(CONDITION_ROW.iter_unpack(self._table(table_offset, CONDITION_ROW,
+                                                                      header['condition_row_count']))):
+            self.conditions[table_offset + i * CONDITION_ROW.size] = row[5:7]
+        table_offset += header['condition_row_count'] * CONDITION_ROW.size
+        self.commands = {}  # {command row offset: (index, args offset, args count)}
+        for i, row in enumerate(COMMAND_ROW.iter_unpack(self._table(table_offset, COMMAND_ROW,
+                                                                    header['command_row_count']))):
+            self.commands[table_offset + i * COMMAND_ROW.size] = row[1:4]
+        table_offset += header['command_row_count'] * COMMAND_ROW.size
+        self.command_args = {}  # {command arg row offset: (expression offset, expression size)}
+        for i, row in enumerate(COMMAND_ARG_ROW.iter_unpack(self._table(table_offset, COMMAND_ARG_ROW,
+                                                                        header['command_arg_row_count']))):
+            self.command_args[table_offset + i * COMMAND_ARG_ROW.size] = row
+        table_offset += header['command_arg_row_count'] * COMMAND_ARG_ROW.size
+        if table_offset + header['condition_pointers_count'] * CONDITION_POINTER.size > len(self.data) - HEADER.size:
+            raise ValueError('EzState tables extend past the end of the file.')
+
+        self.edits = {}  # {('condition' or 'arg', row offset): new expression}
+
+    def _table(self, table_offset, row_struct, count):
+        start = HEADER.size + table_offset
+        return self.data[start:start + count * row_struct.size]
+
+    def _region(self, key):
+        return (self.conditions if key[0] == 'condition' else self.command_args)[key[1]]
+
+    def expression(self, key):
+        """ Current (possibly edited) expression of a ('condition' or 'arg', row offset) key. """
+        try:
+            return self.edits[key]
+        except KeyError:
+            offset, size = self._region(key)
+            return bytes(self.data[HEADER.size + offset:HEADER.size + offset + size])
+
+    def _replace(self, key, substitutions, function_index):
+        expression, replaced = replace_expression_constants(self.expression(key), substitutions, function_index)
+        if replaced:
+            self.edits[key] = expression
+        return replaced
+
+    def replace_command_args(self, command_index, substitutions, arg_positions=None, function_index=None):
+        """ Replace constants in the arguments of commands with index `command_index` (or of all commands, if it is
+        None), optionally only at `arg_positions` or in calls to `function_index`. Returns the number replaced. """
+        replaced = 0
+        for index, args_offset, args_count in self.commands.values():
+            if args_offset == -1 or (command_index is not None and index != command_index):
+                continue
+            for position in range(args_count):
+                if arg_positions is None or position in arg_positions:
+                    key = ('arg', args_offset + position * COMMAND_ARG_ROW.size)
+                    replaced += self._replace(key, substitutions, function_index)
+        return replaced
+
+    def replace_condition_constants(self, substitutions, function_index=None):
+        """ Replace constants in condition expressions, optionally only those passed to or compared with the result of
+        `function_index`. Returns the number replaced. """
+        replaced = 0
+        for row_offset in self.conditions:
+            replaced += self._replace(('condition', row_offset), substitutions, function_index)
+        return replaced
+
+    def _plan(self):
+        """ Split edits into ({(offset, size): expression} to write in place, {key: expression} needing a repack). """
+        region_keys = {}  # {(offset, size): keys of every row using it}
+        for kind, table in (('condition', self.conditions), ('arg', self.command_args)):
+            for row_offset, region in table.items():
+                region_keys.setdefault(region, []).append((kind, row_offset))
+        overlapping = set()
+        end = previous = None
+        for region in sorted(region_keys):
+            if end is not None and region[0] < end:
+                overlapping.update((previous, region))
+            if end is None or region[0] + region[1] > end:
+                end, previous = region[0] + region[1], region
+        in_place = {}
+        repack = {}
+        for key, expression in self.edits.items():
+            region = self._region(key)
+            if (len(expression) == region[1] and region not in overlapping
+                    and all(self.edits.get(other_key) == expression for other_key in region_keys[region])):
+                in_place[region] = expression
+            else:
+                repack[key] = expression
+        return in_place, repack
+
+    @property
+    def needs_repack(self):
+        return bool(self._plan()[1])
+
+    def to_bytes(self):
+        """ Patched file. """
+        in_place, repack = self._plan()
+        data = bytearray(self.data)
+        for (offset, size), expression in in_place.items():
+            data[HEADER.size + offset:HEADER.size + offset + size] = expression
+        if not repack:
+            return bytes(data)
+
+        ezstate = EzState(bytes(data))
+
+        def patch_commands(commands):
+            for command in commands:
+                if command.offset is None or not command.args:
+                    continue
+                args_offset = self.commands[command.offset][1]
+                for position in range(len(command.args)):
+                    key = ('arg', args_offset + position * COMMAND_ARG_ROW.size)
+                    if key in repack:
+                        command.args[position] = repack[key]
+
+        def patch_conditions(conditions):
+            for condition in conditions:
+                if ('condition', condition.offset) in repack:
+                    condition.expression = repack[('condition', condition.offset)]
+                patch_commands(condition.commands)
+                patch_conditions(condition.subconditions)
+
+        for state in ezstate.passive_states + ezstate.active_states:
+            patch_commands(state.enter_commands)
+            patch_commands(state.exit_commands)
+            patch_commands(state.unknown_commands)
+            patch_conditions(state.conditions)
+        return ezstate.to_bytes()
+
+    def write(self, file_name):
+        """ Write the patched file to `file_name`, which can also be a writable binary stream. """
+        data = self.to_bytes()
+        if hasattr(file_name, 'write'):
+            file_name.write(data)
+        else:
+            with open(file_name, 'wb') as file:
+                file.write(data)
+
+
+def _number(key):
+    """ Substitution key from a JSON object key. """
+    try:
+        return int(key)
+    except ValueError:
+        return float(key)
+
+
+def apply_patches(patcher, patches):
+    """ Apply a list of patch dictionaries (see module docstring). Returns the number of constants replaced. """
+    replaced = 0
+    for patch in patches:
+        substitutions = {_number(old): new for old, new in patch['replace'].items()}
+        if 'command' in patch:
+            replaced += patcher.replace_command_args(patch['command'], substitutions, patch.get('args'),
+                                                     patch.get('function'))
+        else:
+            replaced += patcher.replace_condition_constants(substitutions, patch.get('function'))
+    return replaced
+
+
+def patch_esd_file(job):
+    """ Patch one file. Returns (path, constants replaced, whether it was repacked, error message or None). """
+    esd_path, output_path, patches = job
+    try:
+        patcher = EzStatePatcher(esd_path)
+        replaced = apply_patches(patcher, patches)
+        repacked = False
+        if replaced:
+            repacked = patcher.needs_repack
+            patcher.write(output_path)
+        elif output_path != esd_path:
+            patcher.write(output_path)
+        return esd_path, replaced, repacked, None
+    except Exception as e:
+        return esd_path, 0, False, '{}: {}'.format(type(e).__name__, e)
+
+
+def patch_esd_files(paths, patches, output_dir=None, processes=None):
+    """ Apply `patches` to every .esd file in `paths` in parallel, writing to `output_dir` (with the same file names),
+    or over the original files if `output_dir` is None. Files without matches are not rewritten in place. Returns a list
+    of (path, constants replaced, repacked, error) results. """
+    from validate_esd import find_esd_files
+
+    esd_paths = find_esd_files(paths)
+    if output_dir is not None:
+        os.makedirs(output_dir, exist_ok=True)
+    jobs = [(esd_path, esd_path if output_dir is None else os.path.join(output_dir, os.path.basename(esd_path)),
+             patches) for esd_path in esd_paths]
+    with Pool(processes) as pool:
+        return pool.map(patch_esd_file, jobs, chunksize=max(1, len(jobs) // 64))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Replace constants in many .esd files.')
+    parser.add_argument('patches', help='JSON file with a list of patches')
+    parser.add_argument('paths', nargs='*', default=['.'], help='.esd files or directories to search')
+    destination = parser.add_mutually_exclusive_group(required=True)
+    destination.add_argument('--output', '-o', default=None, help='directory to write patched files to')
+    destination.add_argument('--in-place', action='store_true', help='overwrite the original files')
+    parser.add_argument('--processes', '-j', type=int, default=None, help='number of worker processes')
+    args = parser.parse_args()
+
+    with open(args.patches, encoding='utf-8') as patches_file:
+        patch_list = json.load(patches_file)
+    results = patch_esd_files(args.paths, patch_list, args.output, args.processes)
+    failures = 0
+    for result_path, result_replaced, result_repacked, result_error in results:
+        if result_error is not None:
+            failures += 1
+            print('{}: {}'.format(result_path, result_error))
+        elif result_replaced:
+            print('{}: {} constant(s) replaced{}'.format(
+                result_path, result_replaced, ' (repacked)' if result_repacked else ''))
+    print('{} constant(s) replaced in {} file(s).'.format(
+        sum(result[1] for result in results), sum(1 for result in results if result[1])))
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+Coverage and time profiling of simulated EzStates.
+
+An `EzStateProfiler` compiles its own instrumented copy of an EzState's conditions (see `ezstate_compiler`) that counts
+evaluations and fires of every condition into preallocated arrays. Pass it to one or more `EzStateSimulator` instances
+of the same EzState to also count state visits, ticks and evaluation time per state, and command runs by index.
+
+Example:
+
+    profiler = EzStateProfiler(ezstate)
+    EzStateSimulator(ezstate, environment, profiler=profiler).run(100000)
+    print(profiler.text_report())
+    profiler.write_report('t100000.esd.profile.json')
+    profiler.write_annotated_html()  # 't100000.esd.profile.html'
+"""
+
+from array import array
+import json
+from time import perf_counter_ns
+
+from command_names import COMMAND_NAMES
+from ezstate_compiler import compile_states
+from unpack_esd import Condition
+
+
+def _counters(size):
+    return array('Q', bytes(8 * size))
+
+
+class EzStateProfiler(object):
+
+    def __init__(self, ezstate, timed=True):
+        self.ezstate = ezstate
+        self.timed = timed
+        self.states = ezstate.passive_states + ezstate.active_states
+        self.state_slots = {(state.active, state.index): i for i, state in enumerate(self.states)}
+        self.state_visits = _counters(len(self.states))
+        self.state_ticks = _counters(len(self.states))
+        self.state_time_ns = _counters(len(self.states))
+
+        # Condition slots, in the order the compiler numbers them (each state's conditions depth-first). The same
+        # condition object can appear in several places (shared within a file or by an intern pool), so slots are
+        # keyed by where the condition is rather than by the object.
+        self.conditions = []
+        self.condition_states = []  # state slot of each condition
+        self.condition_paths = []  # positions in the state's conditions, then in each parent's subconditions
+        for state_slot, state in enumerate(self.states):
+            self._add_conditions(state.conditions, state_slot, ())
+        self.condition_depths = [len(path) - 1 for path in self.condition_paths]  # 0 for a state's own conditions
+        self.condition_slots = {(state_slot, path): slot for slot, (state_slot, path)
+                                in enumerate(zip(self.condition_states, self.condition_paths))}
+        self.condition_evaluations = _counters(len(self.conditions))
+        self.condition_fires = _counters(len(self.conditions))
+        self.state_functions = compile_states(
+            self.states, counters=lambda conditions: (self.condition_evaluations, self.condition_fires))
+
+        command_indices = [command.index for state in self.states for command in self._all_commands(state)]
+        self.command_runs = _counters(max(command_indices, default=-1) + 1)
+
+    def _add_conditions(self, conditions, state_slot, parent_path):
+        for position, condition in enumerate(conditions):
+            path = parent_path + (position,)
+            self.conditions.append(condition)
+            self.condition_states.append(state_slot)
+            self.condition_paths.append(path)
+            self._add_conditions(condition.subconditions, state_slot, path)
+
+    def _all_commands(self, state):
+        commands = list(state.enter_commands) + list(state.exit_commands) + list(state.unknown_commands)
+        stack = list(state.conditions)
+        while stack:
+            condition = stack.pop()
+            commands += condition.commands
+            stack += condition.subconditions
+        return commands
+
+    def reset(self):
+        for counters in (self.state_visits, self.state_ticks, self.state_time_ns, self.condition_evaluations,
+                         self.condition_fires, self.command_runs):
+            counters[:] = _counters(len(counters))
+
+    def record_visit(self, state):
+        self.state_visits[self.state_slots[(state.active, state.index)]] += 1
+
+    def record_commands(self, commands):
+        command_runs = self.command_runs
+        for command in commands:
+            command_runs[command.index] += 1
+
+    def profile_tick(self, simulator):
+        """ Run one tick of `simulator` and record it against its current state. """
+        slot = self.state_slots[(simulator.state.active, simulator.state.index)]
+        if self.timed:
+            start = perf_counter_ns()
+            new_state = simulator.step()
+            self.state_time_ns[slot] += perf_counter_ns() - start
+        else:
+            new_state = simulator.step()
+        self.state_ticks[slot] += 1
+        if new_state is not None:
+            self.state_visits[self.state_slots[(new_state.active, new_state.index)]] += 1
+        return new_state
+
+    def hot_states(self, count=10):
+        """ Slots of the `count` states with the most evaluation time (or ticks, if untimed). """
+        weights = self.state_time_ns if self.timed else self.state_ticks
+        ranked = sorted(range(len(self.states)), key=lambda slot: weights[slot], reverse=True)
+        return [slot for slot in ranked[:count] if weights[slot]]
+
+    def report(self, hot_count=10):
+        """ Profile as a JSON-compatible dictionary. """
+        states = []
+        for slot, state in enumerate(self.states):
+            states.append({
+                'index': state.index,
+                'active': state.active,
+                'visits': self.state_visits[slot],
+                'ticks': self.state_ticks[slot],
+                'time_ms': self.state_time_ns[slot] / 1e6,
+                'conditions': [],
+            })
+        for slot, condition in enumerate(self.conditions):
+            states[self.condition_states[slot]]['conditions'].append({
+                'offset': condition.offset,
+                'depth': self.condition_depths[slot],
+                'next_state_index': condition.next_state_index,
+                'evaluations': self.condition_evaluations[slot],
+                'fires': self.condition_fires[slot],
+            })
+        commands = [{'index': index, 'name': COMMAND_NAMES.get(index, ['function_{}'.format(index)])[0], 'runs': runs}
+                    for index, runs in enumerate(self.command_runs) if runs]
+        return {
+            'ticks': sum(self.state_ticks),
+            'states': states,
+            'commands': sorted(commands, key=lambda c: c['runs'], reverse=True),
+            'hot_states': [self.states[slot].index for slot in self.hot_states(hot_count)],
+            'unvisited_states': [state['index'] for state in states if not state['visits']],
+            'never_fired_conditions': [
+                {'state_index': self.states[self.condition_states[slot]].index, 'offset': condition.offset}
+                for slot, condition in enumerate(self.conditions) if not self.condition_fires[slot]],
+        }
+
+    def write_report(self, output_path=None, hot_count=10):
+        if output_path is None:
+            output_path = self._default_path('.profile.json')
+        with open(output_path, 'w') as output_file:
+            json.dump(self.report(hot_count), output_file, indent=1)
+
+    def text_report(self, hot_count=10):
+        report = self.report(hot_count)
+        states_by_index = {(state['active'], state['index']): state for state in report['states']}
+        lines = ['Ticks: {}'.format(report['ticks']),
+                 'States visited: {} / {}'.format(len(self.states) - len(report['unvisited_states']), len(self.states)),
+                 'Conditions fired: {} / {}'.format(
+                     len(self.conditions) - len(report['never_fired_conditions']), len(self.conditions)),
+                 '', 'Hot states:']
+        for slot in self.hot_states(hot_count):
+            state = states_by_index[(self.states[slot].active, self.states[slot].index)]
+            lines.append('  State {}: {} ticks, {} visits, {:.3f} ms'.format(
+                state['index'], state['ticks'], state['visits'], state['time_ms']))
+        lines += ['', 'Commands:']
+        lines += ['  {} ({}): {}'.format(c['name'], c['index'], c['runs']) for c in report['commands']]
+        if report['unvisited_states']:
+            lines += ['', 'Unvisited states: {}'.format(', '.join(str(i) for i in report['unvisited_states']))]
+        return '\n'.join(lines)
+
+    def annotator(self, hot_count=10):
+        """ Returns an `annotate` function for `EzState.to_html` that shows hit counts for each state and condition,
+        with states shaded by time (or ticks) and the `hot_count` hottest states labelled. """
+        weights = self.state_time_ns if self.timed else self.state_ticks
+        max_weight = max(max(weights, default=0), 1)
+        hot_slots = set(self.hot_states(hot_count))
+        # A state is rendered before its conditions, which follow depth-first in slot order, so each condition is
+        # matched to the next slot of the state last rendered.
+        state_condition_slots = [[] for _ in self.states]
+        for condition_slot, state_slot in enumerate(self.condition_states):
+            state_condition_slots[state_slot].append(condition_slot)
+        next_slots = iter(())
+
+        def annotate(state_or_condition):
+            nonlocal next_slots
+            if isinstance(state_or_condition, Condition):
+                condition_slot = next(next_slots, None)
+                if condition_slot is None or self.conditions[condition_slot] is not state_or_condition:
+                    return ''
+                evaluations = self.condition_evaluations[condition_slot]
+                fires = self.condition_fires[condition_slot]
+                color = 'gray' if not evaluations else ('red' if not fires else 'green')
+                return ('<br><div style="color:{};font-size:12px;margin-left:{}px">[evaluated {}, fired {}]'
+                        '</div>'.format(color, 20 * (2 + self.condition_depths[condition_slot]), evaluations, fires))
+            state = state_or_condition
+            slot = self.state_slots[(state.active, state.index)]
+            next_slots = iter(state_condition_slots[slot])
+            shade = int(255 - 155 * weights[slot] / max_weight)
+            return ('<div style="background-color:rgb(255,{shade},{shade});padding:4px">{visits} visits, {ticks} '
+                    'ticks, {time:.3f} ms{label}</div>'.format(
+                        shade=shade, visits=self.state_visits[slot], ticks=self.state_ticks[slot],
+                        time=self.state_time_ns[slot] / 1e6, label=' HOT' if slot in hot_slots else ''))
+
+        return annotate
+
+    def write_annotated_html(self, output_path=None, hot_count=10):
+        if output_path is None:
+            output_path = self._default_path('.profile.html')
+        self.ezstate.unpack_to_html_file(output_path, annotate=self.annotator(hot_count))
+
+    def _default_path(self, suffix):
+        if self.ezstate.input_path is None:
+            raise ValueError('An output path is required for an EzState that was not loaded from a file.')
+        return str(self.ezstate.input_path) + suffix
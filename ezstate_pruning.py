@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+"""
+Find (and optionally remove) conditions that can never fire.
+
+`expression_truth` decides statically whether a condition expression is always true, never true, or depends on its
+environment. The expression is read as a formula over comparisons of function results (and registers) with constants,
+joined by 'and', 'or' and 'b7' checks. Calls with the same constant arguments are the same unknown value, as they are
+within one tick of `ezstate_simulator`. The formula is expanded into alternatives (up to `MAX_TERMS` of them), and each
+alternative is checked by intersecting the ranges it allows for every unknown value, so that for example
+'f15(1) > 3 and f15(1) < 2' is never true and 'f15(1) >= 2 or f15(1) < 5' is always true. Function results are assumed
+to be numbers. Anything the analysis cannot follow (calls with computed arguments, comparisons of two different calls,
+strings compared with ordering operators) is an independent unknown, so the answers are never wrong, only sometimes
+'unknown' (None).
+
+`find_dead_transitions` applies this to every condition list of an `EzState`, following the simulator's order: a
+condition that is never true never fires, and conditions after an always-true condition in the same list are never
+evaluated. In both cases, none of their subconditions or commands can run either. `prune_dead_transitions` removes
+them, except for never-true conditions that store registers, since later conditions of the state may load those.
+
+    python ezstate_pruning.py [--output DIR] [path ...]
+
+reports the dead transitions of each file, and with `--output`, writes the pruned files.
+"""
+
+import argparse
+import os
+from math import inf, isnan
+
+from ezstate_parser import comparison_lookup, iter_instructions
+
+MAX_TERMS = 256
+
+# Comparison opcode with its result negated, and with its two sides swapped.
+NEGATED_COMPARISONS = {0x91: 0x94, 0x92: 0x93, 0x93: 0x92, 0x94: 0x91, 0x95: 0x96, 0x96: 0x95}
+SWAPPED_COMPARISONS = {0x91: 0x92, 0x92: 0x91, 0x93: 0x94, 0x94: 0x93, 0x95: 0x95, 0x96: 0x96}
+
+# Formulas are True, False, ('compare', key, opcode, number) for 'unknown value `key` <opcode> number',
+# ('opaque', id, polarity) for an independent unknown truth value, or ('and' or 'or', (formula, ...)).
+
+
+def _negate(formula):
+    if formula is True or formula is False:
+        return not formula
+    kind = formula[0]
+    if kind == 'compare':
+        return 'compare', formula[1], NEGATED_COMPARISONS[formula[2]], formula[3]
+    if kind == 'opaque':
+        return 'opaque', formula[1], not formula[2]
+    return 'or' if kind == 'and' else 'and', tuple(_negate(part) for part in formula[1])
+
+
+def _join(kind, formulas):
+    """ 'and' or 'or' of formulas, simplifying constant parts. """
+    absorbing = kind == 'or'  # True absorbs 'or', False absorbs 'and'.
+    parts = []
+    for formula in formulas:
+        if formula is absorbing:
+            return absorbing
+        if formula is not (not absorbing):
+            parts.append(formula)
+    if not parts:
+        return not absorbing
+    return parts[0] if len(parts) == 1 else (kind, tuple(parts))
+
+
+def _compare_formula(key, opcode, number):
+    if isnan(number):
+        return opcode == 0x96
+    return 'compare', key, opcode, number
+
+
+class _SymbolicExpression(object):
+    """ Decoded condition expression, as a formula for 'the expression is true'. """
+
+    def __init__(self, expression):
+        self.stores_registers = False
+        self._opaque_count = 0
+        checks = []  # Values checked by 'b7', which all have to be true for evaluation to reach the end.
+        registers = {}
+        stack = []
+        for _, byte, operand, _ in iter_instructions(expression):
+            if byte == 0xa5:
+                stack.append(('string', operand))
+            elif operand is not None:
+                stack.append(('number', operand))
+            elif 0x84 <= byte <= 0x87:
+                arg_count = byte - 0x84
+                args = stack[len(stack) - arg_count:]
+                del stack[len(stack) - arg_count:]
+                if stack[-1][0] == 'number' and all(arg[0] in ('number', 'string') for arg in args):
+                    stack[-1] = ('unknown', ('call', stack[-1][1]) + tuple(arg[1] for arg in args))
+                else:
+                    stack[-1] = self._new_unknown()
+            elif 0x91 <= byte <= 0x96:
+                right = stack.pop()
+                stack[-1] = ('formula', self._compare(stack[-1], byte, right))
+            elif byte == 0x98 or byte == 0x99:
+                right = stack.pop()
+                stack[-1] = ('formula', _join('and' if byte == 0x98 else 'or',
+                                              (self._truth(stack[-1]), self._truth(right))))
+            elif 0xa7 <= byte <= 0xae:
+                registers[byte - 0xa7] = stack[-1]
+                self.stores_registers = True
+            elif 0xaf <= byte <= 0xb6:
+                # Registers not stored earlier in this expression hold values from earlier conditions of the state.
+                stack.append(registers.setdefault(byte - 0xaf, ('unknown', ('register', byte - 0xaf))))
+            elif byte == 0xb7:
+                checks.append(self._truth(stack[-1]))
+        self.formula = _join('and', checks + [self._truth(stack[-1])])
+
+    def _new_unknown(self):
+        self._opaque_count += 1
+        return 'unknown', ('opaque', self._opaque_count)
+
+    def _new_opaque(self):
+        self._opaque_count += 1
+        return 'opaque', self._opaque_count, True
+
+    @staticmethod
+    def _truth(value):
+        kind = value[0]
+        if kind == 'formula':
+            return value[1]
+        if kind == 'unknown':
+            return _compare_formula(value[1], 0x96, 0)
+        return bool(value[1])
+
+    @staticmethod
+    def _cases(value):
+        """ (case value, formula under which the value is that case) pairs. Formulas are 1 or 0. """
+        if value[0] == 'formula':
+            return (('number', 1), value[1]), (('number', 0), _negate(value[1]))
+        return (value, True),
+
+    def _compare_cases(self, left, opcode, right):
+        if left[0] == 'unknown' and right[0] == 'unknown':
+            if left[1] == right[1]:
+                return opcode in (0x91, 0x92, 0x95)
+            return self._new_opaque()
+        if left[0] != 'unknown' and right[0] == 'unknown':
+            left, opcode, right = right, SWAPPED_COMPARISONS[opcode], left
+        if left[0] == 'unknown':
+            if right[0] == 'number':
+                return _compare_formula(left[1], opcode, right[1])
+            return self._new_opaque()  # Function result compared with a string.
+        if left[0] == right[0]:
+            return bool(comparison_lookup[opcode](left[1], right[1]))
+        if opcode in (0x95, 0x96):
+            return opcode == 0x96  # A string is never equal to a number.
+        return self._new_opaque()
+
+    def _compare(self, left, opcode, right):
+        alternatives = []
+        for left_case, left_formula in self._cases(left):
+            for right_case, right_formula in self._cases(right):
+                alternatives.append(_join('and', (left_formula, right_formula,
+                                                  self._compare_cases(left_case, opcode, right_case))))
+        return _join('or', alternatives)
+
+
+def _terms(formula):
+    """ Formula as a list of alternatives, each a list of 'compare' and 'opaque' parts that must all hold. Returns None
+    if there would be more than `MAX_TERMS` alternatives. """
+    if formula is True:
+        return [[]]
+    if formula is False:
+        return []
+    kind = formula[0]
+    if kind == 'or':
+        terms = []
+        for part in formula[1]:
+            part_terms = _terms(part)
+            if part_terms is None:
+                return None
+            terms += part_terms
+            if len(terms) > MAX_TERMS:
+                return None
+        return terms
+    if kind == 'and':
+        terms = [[]]
+        for part in formula[1]:
+            part_terms = _terms(part)
+            if part_terms is None or len(terms) * len(part_terms) > MAX_TERMS:
+                return None
+            terms = [term + part_term for term in terms for part_term in part_terms]
+        return terms
+    return [[formula]]
+
+
+def _term_satisfiable(term):
+    """ Whether every part of an alternative can hold at once (treating unknown values as any real number). """
+    polarities = {}
+    comparisons = {}
+    for part in term:
+        if part[0] == 'opaque':
+            if polarities.setdefault(part[1], part[2]) != part[2]:
+                return False
+        else:
+            comparisons.setdefault(part[1], []).append(part[2:])
+    for constraints in comparisons.values():
+        low, low_strict, high, high_strict = -inf, False, inf, False
+        equal = set()
+        not_equal = set()
+        for opcode, number in constraints:
+            if opcode == 0x95:
+                equal.add(number)
+            elif opcode == 0x96:
+                not_equal.add(number)
+            elif opcode in (0x91, 0x93):  # <=, <
+                if number < high or (number == high and opcode == 0x93):
+                    high, high_strict = number, opcode == 0x93
+            elif number > low or (number == low and opcode == 0x94):  # >=, >
+                low, low_strict = number, opcode == 0x94
+        if equal:
+            if len(equal) > 1:
+                return False
+            value = equal.pop()
+            if (value in not_equal or value < low or (value == low and low_strict) or value > high
+                    or (value == high and high_strict)):
+                return False
+        elif low > high or (low == high and (low_strict or high_strict or low in not_equal)):
+            return False
+    return True
+
+
+def _satisfiable(formula):
+    """ True, False, or None if the formula is too large to decide. """
+    terms = _terms(formula)
+    if terms is None:
+        return None
+    return any(_term_satisfiable(term) for term in terms)
+
+
+def _analyse(expression):
+    """ (expression_truth, whether the expression stores any registers). """
+    try:
+        symbolic = _SymbolicExpression(expression)
+    except ValueError:
+        return None, True  # Unknown opcode.
+    if _satisfiable(symbolic.formula) is False:
+        return False, symbolic.stores_registers
+    if _satisfiable(_negate(symbolic.formula)) is False:
+        return True, symbolic.stores_registers
+    return None, symbolic.stores_registers
+
+
+def expression_truth(expression):
+    """ True if a packed condition expression is true whatever its function calls return, False if it can never be
+    true, and None otherwise (or if it cannot be analysed). """
+    return _analyse(expression)[0]
+
+
+def expression_comparisons(expression):
+    """ Set of ((function_index, *args), number) pairs for every comparison of a function result with a constant in a
+    packed expression, including the implied comparison with 0 of a result used as a truth value. Only calls with
+    constant arguments are included. Returns an empty set if the expression cannot be analysed. """
+    try:
+        formulas = [_SymbolicExpression(expression).formula]
+    except ValueError:
+        return set()
+    comparisons = set()
+    while formulas:
+        formula = formulas.pop()
+        if formula is True or formula is False or formula[0] == 'opaque':
+            continue
+        if formula[0] == 'compare':
+            if formula[1][0] == 'call':
+                comparisons.add((formula[1][1:], formula[3]))
+        else:
+            formulas += formula[1]
+    return comparisons
+
+
+class DeadTransition(object):
+    """ A condition that can never fire, found by `find_dead_transitions`. `path` gives the position of the condition
+    in the state's condition list, followed by its position in each subcondition list down to it. """
+
+    def __init__(self, state, path, condition, reason, removable):
+        self.state = state
+        self.path = path
+        self.condition = condition
+        self.reason = reason
+        self.removable = removable
+
+    def __repr__(self):
+        return '<DeadTransition: {} state {}, condition {} -> {} ({}{})>'.format(
+            'active' if self.state.active else 'passive', self.state.index, '.'.join(str(i) for i in self.path),
+            self.condition.next_state_index, self.reason, '' if self.removable else ', stores registers')
+
+
+def _walk_conditions(state, conditions, path, analysed, dead, remove):
+    """ Record the dead conditions in `conditions` and their subconditions. Returns the conditions to keep. """
+    kept = []
+    always_true = False
+    for i, condition in enumerate(conditions):
+        if always_true:
+            dead.append(DeadTransition(state, path + (i,), condition, 'after an always-true condition', True))
+            if not remove:
+                kept.append(condition)
+            continue
+        try:
+            truth, stores_registers = analysed[condition.expression]
+        except KeyError:
+            truth, stores_registers = analysed[condition.expression] = _analyse(condition.expression)
+        if truth is False:
+            dead.append(DeadTransition(state, path + (i,), condition, 'never true', not stores_registers))
+            if not remove or stores_registers:
+                kept.append(condition)
+            continue
+        always_true = truth is True
+        if condition.subconditions:
+            subconditions = _walk_conditions(state, condition.subconditions, path + (i,), analysed, dead, remove)
+            if len(subconditions) != len(condition.subconditions):
+                # Loaded conditions use tuples for no subconditions.
+                condition.subconditions = subconditions or ()
+        kept.append(condition)
+    return kept
+
+
+def find_dead_transitions(ezstate, remove=False):
+    """ List of `DeadTransition`s of every state of `ezstate`. With `remove=True`, the removable ones are also taken
+    out of their condition lists (see `prune_dead_transitions`). """
+    analysed = {}  # {expression: (truth, stores registers)}
+    dead = []
+    for state in ezstate.passive_states + ezstate.active_states:
+        conditions = _walk_conditions(state, state.conditions, (), analysed, dead, remove)
+        if len(conditions) != len(state.conditions):
+            state.conditions = conditions
+    return dead
+
+
+def prune_dead_transitions(ezstate):
+    """ Remove every removable dead transition from `ezstate` in place. Returns the list of `DeadTransition`s found,
+    including those that were kept because they store registers. Conditions can be shared by several states, and are
+    pruned in the same way in each. """
+    return find_dead_transitions(ezstate, remove=True)
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Report (and optionally remove) conditions that can never fire.')
+    parser.add_argument('paths', nargs='*', default=['.'], help='.esd files or directories to search')
+    parser.add_argument('--output', '-o', default=None, help='directory to write pruned files to')
+    args = parser.parse_args()
+
+    from unpack_esd import EzState
+    from validate_esd import find_esd_files
+
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+    total_dead = total_removed = 0
+    for path in find_esd_files(args.paths):
+        try:
+            ezstate = EzState(path)
+        except ValueError as e:
+            print('{}: {}'.format(path, e))
+            continue
+        dead_transitions = find_dead_transitions(ezstate, remove=args.output is not None)
+        for dead_transition in dead_transitions:
+            print('{}: {}'.format(path, dead_transition))
+        total_dead += len(dead_transitions)
+        if args.output is not None:
+            total_removed += sum(1 for dead_transition in dead_transitions if dead_transition.removable)
+            ezstate.write(os.path.join(args.output, os.path.basename(path)))
+    print('{} dead transition(s) found, {} removed.'.format(total_dead, total_removed))
@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+"""
+Step many simulated EzState instances, without touching instances that are only waiting.
+
+`EzStateScheduler` takes simulators created with `incremental=True` (see `ezstate_simulator`). After each tick, an
+idle simulator is parked: it is not stepped again until an input its current state reads changes (reported by the
+environment's `listeners`), or until its `wake_frame` is reached, which is tracked on a heap of wake ticks. Parked
+simulators catch up on the ticks they missed with `EzStateSimulator.skip` when they wake, so results are identical to
+calling `tick()` on every simulator in order every tick, including an instance seeing a change made by the commands of
+an earlier instance in the same tick.
+
+`run(ticks)` jumps straight over ticks in which every instance is parked. `run_realtime` runs ticks against the
+asyncio event loop clock at `frame_rate` ticks per second, and sleeps while every instance is parked until the next
+wake tick or until an environment input changes.
+"""
+
+import asyncio
+from functools import partial
+from heapq import heapify, heappop, heappush
+from math import isfinite
+
+
+class EzStateScheduler(object):
+
+    def __init__(self, simulators):
+        self.simulators = list(simulators)
+        for simulator in self.simulators:
+            if not simulator.incremental:
+                raise ValueError('Scheduled simulators must be created with incremental=True.')
+        self.tick_count = max((simulator.tick_count for simulator in self.simulators), default=0)
+        self._next = set(range(len(self.simulators)))  # Instances to step next tick.
+        self._current = None  # Heap of instances still to step in the running tick.
+        self._running = -1
+        self._parked = [False] * len(self.simulators)
+        self._generations = [0] * len(self.simulators)  # Invalidates the timer of an instance that woke early.
+        self._timers = []  # Heap of (wake_tick, instance, generation).
+        self._wakeup = None
+        for i, simulator in enumerate(self.simulators):
+            simulator.environment.listeners.append(partial(self._input_changed, i))
+
+    @property
+    def parked_count(self):
+        return sum(self._parked)
+
+    def close(self):
+        """ Stop listening to the environments of the simulators. """
+        for simulator in self.simulators:
+            simulator.environment.listeners[:] = [
+                listener for listener in simulator.environment.listeners
+                if not (isinstance(listener, partial) and listener.func.__self__ is self)]
+
+    def _input_changed(self, i, _key):
+        if self._parked[i]:
+            self._wake(i)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _wake(self, i):
+        self._parked[i] = False
+        self._generations[i] += 1
+        if self._current is not None and i > self._running:
+            heappush(self._current, i)  # Still to come in this tick.
+        else:
+            self._next.add(i)
+
+    def _park(self, i):
+        simulator = self.simulators[i]
+        self._parked[i] = True
+        if isfinite(simulator.wake_frame):
+            wake_tick = simulator.tick_count + simulator.wake_frame - simulator.elapsed_frames
+            heappush(self._timers, (wake_tick, i, self._generations[i]))
+
+    def _next_timer_tick(self):
+        """ Tick of the earliest valid timer, or None. """
+        timers = self._timers
+        while timers:
+            wake_tick, i, generation = timers[0]
+            if self._parked[i] and generation == self._generations[i]:
+                return wake_tick
+            heappop(timers)
+        return None
+
+    def synchronize(self):
+        """ Bring the tick and elapsed frame counts of parked simulators up to date. """
+        for i, simulator in enumerate(self.simulators):
+            if simulator.tick_count < self.tick_count:
+                simulator.skip(self.tick_count - simulator.tick_count)
+
+    def tick(self):
+        """ Step every instance that is not parked once. Returns the number of state changes. """
+        tick = self.tick_count
+        while True:
+            wake_tick = self._next_timer_tick()
+            if wake_tick is None or wake_tick > tick:
+                break
+            _, i, _ = heappop(self._timers)
+            self._wake(i)
+        current = self._current = list(self._next)
+        heapify(current)
+        self._next = set()
+        changes = 0
+        simulators = self.simulators
+        try:
+            while current:
+                i = self._running = heappop(current)
+                simulator = simulators[i]
+                if simulator.tick_count < tick:
+                    simulator.skip(tick - simulator.tick_count)
+                if simulator.tick() is not None:
+                    changes += 1
+                if simulator.idle:
+                    self._park(i)
+                else:
+                    self._next.add(i)
+        finally:
+            self._current = None
+            self._running = -1
+        self.tick_count += 1
+        return changes
+
+    def run(self, ticks):
+        """ Run `ticks` ticks. Returns the number of state changes. """
+        changes = 0
+        end_tick = self.tick_count + ticks
+        while self.tick_count < end_tick:
+            if not self._next:
+                wake_tick = self._next_timer_tick()
+                self.tick_count = end_tick if wake_tick is None else max(self.tick_count, min(wake_tick, end_tick))
+                if self.tick_count == end_tick:
+                    break
+            changes += self.tick()
+        return changes
+
+    async def run_realtime(self, ticks=None, frame_rate=30):
+        """ Run `ticks` ticks (or forever) at `frame_rate` ticks per second of the event loop clock. While every
+        instance is parked, sleep until the next wake tick or until an environment input changes. Returns the number
+        of state changes. """
+        loop = asyncio.get_running_loop()
+        start_time = loop.time() - self.tick_count / frame_rate
+        end_tick = None if ticks is None else self.tick_count + ticks
+        self._wakeup = asyncio.Event()
+        changes = 0
+        try:
+            while end_tick is None or self.tick_count < end_tick:
+                wake_tick = self._next_timer_tick()
+                if not self._next and (wake_tick is None or wake_tick > self.tick_count):
+                    if end_tick is not None:
+                        wake_tick = end_tick if wake_tick is None else min(wake_tick, end_tick)
+                    self._wakeup.clear()
+                    timeout = None if wake_tick is None else max(0.0, start_time + wake_tick / frame_rate - loop.time())
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout)
+                    except asyncio.TimeoutError:
+                        pass
+                    now_tick = int((loop.time() - start_time) * frame_rate)
+                    if wake_tick is not None:
+                        now_tick = min(now_tick, wake_tick)
+                    self.tick_count = max(self.tick_count, now_tick)
+                    if self.tick_count == end_tick:
+                        break
+                    continue
+                delay = start_time + self.tick_count / frame_rate - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                changes += self.tick()
+        finally:
+            self._wakeup = None
+        return changes
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+"""
+Local server that keeps loaded EzStates in memory and answers queries about them.
+
+Usage: python ezstate_server.py [--root DIR] [--port PORT | --socket PATH]
+
+Requests are HTTP GETs, with the .esd file given as a path relative to the server root (files outside the root are
+refused). Answers are JSON, except for rendered states:
+
+    /state?path=t100000.esd&index=3[&active=1]          HTML of one state (as in `EzState.to_html`)
+    /states?path=t100000.esd                            indices of the passive and active states
+    /transitions?path=t100000.esd&index=3[&active=1]    conditions of other states that lead to state 3
+    /calls?path=t100000.esd&function=64                 states that call function 64 (an index or name from
+                                                        `function_lookup`) in a condition or command argument
+    /cache                                              files currently loaded
+
+A loaded file is kept until its size or modification time changes, at which point it is hashed, and reloaded if its
+contents have changed. Rendered states and the transition and call indices of a file are built when first needed and
+kept with it. Requests are handled on separate threads, so any number of clients can query at once. Loaded EzStates are
+only read, and rendering (which uses the register names shared by `ezparse`) is done under a lock.
+
+With `--socket`, the server listens on a Unix socket instead of a TCP port, for example with
+'curl --unix-socket PATH http://localhost/states?path=t100000.esd'.
+"""
+
+import argparse
+from hashlib import sha1
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import socketserver
+import threading
+from urllib.parse import parse_qs, urlparse
+
+from ezstate_parser import expression_calls, ezparse, function_lookup
+from unpack_esd import EzState
+
+FUNCTION_INDICES = {name: index for index, name in function_lookup.items()}
+
+
+class LoadedEzState(object):
+    """ One loaded file, with the renderings and indices built from it so far. """
+
+    def __init__(self, esd_path, stat_key, file_hash, data):
+        self.esd_path = esd_path
+        self.stat_key = stat_key
+        self.file_hash = file_hash
+        self.ezstate = EzState(data)
+        self.states = {(state.active, state.index): state
+                       for state in self.ezstate.passive_states + self.ezstate.active_states}
+        self.fragments = {}  # {(active, index): HTML}
+        self.index_lock = threading.Lock()
+        self._transitions = None
+        self._calls = None
+
+    def transitions(self):
+        """ {(active, next state index): [(active, state index, condition)]}, built on first use. """
+        with self.index_lock:
+            if self._transitions is None:
+                transitions = {}
+                for key, state in self.states.items():
+                    conditions = list(state.conditions)
+                    while conditions:
+                        condition = conditions.pop()
+                        if condition.next_state_index != -1:
+                            transitions.setdefault((bool(condition.active), condition.next_state_index), []).append(
+                                key + (condition,))
+                        conditions += condition.subconditions
+                self._transitions = transitions
+            return self._transitions
+
+    def calls(self):
+        """ {function index: set of (active, state index)}, built on first use. """
+        with self.index_lock:
+            if self._calls is None:
+                calls = {}
+                for key, state in self.states.items():
+                    expressions = []
+                    commands = state.enter_commands + state.exit_commands + state.unknown_commands
+                    conditions = list(state.conditions)
+                    while conditions:
+                        condition = conditions.pop()
+                        expressions.append(condition.expression)
+                        commands += condition.commands
+                        conditions += condition.subconditions
+                    expressions += [arg for command in commands for arg in command.args]
+                    for expression in expressions:
+                        try:
+                            function_calls = expression_calls(expression)
+                        except ValueError:
+                            continue  # Unknown opcode.
+                        for call in function_calls:
+                            calls.setdefault(call[0], set()).add(key)
+                self._calls = calls
+            return self._calls
+
+
+class EzStateCache(object):
+    """ Thread-safe cache of `LoadedEzState`s by path, invalidated when file contents change. """
+
+    def __init__(self):
+        self.loaded = {}  # {path: LoadedEzState}
+        self.lock = threading.Lock()
+        self.render_lock = threading.Lock()
+        self._path_locks = {}
+
+    def get(self, esd_path):
+        stat = os.stat(esd_path)
+        stat_key = (stat.st_size, stat.st_mtime_ns)
+        loaded = self.loaded.get(esd_path)
+        if loaded is not None and loaded.stat_key == stat_key:
+            return loaded
+        with self.lock:
+            path_lock = self._path_locks.setdefault(esd_path, threading.Lock())
+        with path_lock:  # Only one thread loads a given file.
+            loaded = self.loaded.get(esd_path)
+            if loaded is not None and loaded.stat_key == stat_key:
+                return loaded
+            with open(esd_path, 'rb') as esd_file:
+                data = esd_file.read()
+            file_hash = sha1(data).hexdigest()
+            if loaded is not None and loaded.file_hash == file_hash:
+                loaded.stat_key = stat_key  # Touched, but unchanged.
+                return loaded
+            loaded = LoadedEzState(esd_path, stat_key, file_hash, data)
+            with self.lock:
+                self.loaded[esd_path] = loaded
+            return loaded
+
+    def render_state(self, loaded, key):
+        try:
+            return loaded.fragments[key]
+        except KeyError:
+            pass
+        state = loaded.states[key]
+        with self.render_lock:
+            fragment = loaded.fragments[key] = state.__str__()
+        return fragment
+
+
+class EzStateRequestHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format_string, *args):
+        pass  # Quiet; Unix socket clients have no address to log.
+
+    def _send(self, status, body):
+        """ Send a string as HTML, or anything else as JSON. """
+        content_type = 'text/html' if isinstance(body, str) else 'application/json'
+        body = (body if isinstance(body, str) else json.dumps(body)).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type + '; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        handler = getattr(self, 'query_' + url.path.strip('/'), None)
+        if handler is None:
+            self._send(404, {'error': 'Unknown query {}.'.format(url.path)})
+            return
+        try:
+            self._send(200, handler(query))
+        except (KeyError, ValueError) as e:
+            self._send(400, {'error': '{}: {}'.format(type(e).__name__, e)})
+        except OSError as e:
+            self._send(404, {'error': str(e)})
+
+    def _loaded(self, query):
+        root = self.server.root
+        esd_path = os.path.realpath(os.path.join(root, query['path']))
+        if os.path.commonpath((root, esd_path)) != root:
+            raise ValueError('Path {} is outside the server root.'.format(query['path']))
+        return self.server.cache.get(esd_path)
+
+    @staticmethod
+    def _state_key(query):
+        return query.get('active', '0') not in ('0', 'false', ''), int(query['index'])
+
+    def query_cache(self, _query):
+        return [{'path': os.path.relpath(loaded.esd_path, self.server.root), 'hash': loaded.file_hash,
+                 'rendered_states': len(loaded.fragments)} for loaded in list(self.server.cache.loaded.values())]
+
+    def query_states(self, query):
+        loaded = self._loaded(query)
+        return {'passive': [state.index for state in loaded.ezstate.passive_states],
+                'active': [state.index for state in loaded.ezstate.active_states]}
+
+    def query_state(self, query):
+        loaded = self._loaded(query)
+        key = self._state_key(query)
+        if key not in loaded.states:
+            raise KeyError('No state {}.'.format(key[1]))
+        return self.server.cache.render_state(loaded, key)
+
+    def query_transitions(self, query):
+        loaded = self._loaded(query)
+        sources = loaded.transitions().get(self._state_key(query), [])
+        with self.server.cache.render_lock:
+            return [{'state': index, 'active': active, 'condition_offset': condition.offset,
+                     'expression': ezparse(condition.expression)} for active, index, condition in sources]
+
+    def query_calls(self, query):
+        loaded = self._loaded(query)
+        function = query['function']
+        function_index = int(function) if function.lstrip('-').isdigit() else FUNCTION_INDICES[function]
+        states = loaded.calls().get(function_index, set())
+        return [{'state': index, 'active': active} for active, index in sorted(states)]
+
+
+class EzStateServer(ThreadingHTTPServer):
+
+    def __init__(self, address, root='.'):
+        super().__init__(address, EzStateRequestHandler)
+        self.root = os.path.realpath(root)
+        self.cache = EzStateCache()
+
+
+class EzStateUnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, socket_path, root='.'):
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        super().__init__(socket_path, EzStateRequestHandler)
+        self.root = os.path.realpath(root)
+        self.cache = EzStateCache()
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Serve queries about .esd files.')
+    parser.add_argument('--root', default='.', help='directory that request paths are relative to')
+    parser.add_argument('--port', type=int, default=8765, help='TCP port on localhost')
+    parser.add_argument('--socket', default=None, help='Unix socket path to listen on instead of a port')
+    args = parser.parse_args()
+
+    if args.socket is not None:
+        server = EzStateUnixServer(args.socket, args.root)
+        print('Serving {} on {}'.format(server.root, args.socket))
+    else:
+        server = EzStateServer(('127.0.0.1', args.port), args.root)
+        print('Serving {} on http://127.0.0.1:{}'.format(server.root, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
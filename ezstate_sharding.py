@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""
+Simulate many EzState instances at once, sharded across worker processes.
+
+The coordinator (`ShardedSimulation`) keeps the state of every instance in `multiprocessing.shared_memory` arrays:
+
+    state_indices   current state index (int32, one per instance)
+    active          1 if the current state is in the second ('active') state table (int8, one per instance)
+    elapsed_frames  frames spent in the current state (int32, one per instance)
+    registers       registers from the last evaluation of the current state (float64, eight per instance; NaN if a
+                    register holds a string)
+    inputs          environment function results (float64, `input_count` per instance, indexed by function index)
+
+Each worker owns a contiguous shard of instances and steps them `ticks_per_sync` ticks per batch, reading `inputs`
+live and writing the other arrays back at the end of the batch. Between batches the coordinator may change any array
+(for example, to move an instance to another state). Commands in `report_commands` are sent back as events
+(tick, instance, command_index, args) and merged in (tick, instance) order.
+
+SetEventState (command 11) is always sent back, whether or not it is in `report_commands`. Workers do not apply it
+themselves: the coordinator applies the merged events to its `event_flags` in order, and every instance sees the result
+through GetEventFlagValue (function 64) from the next batch. All instances read the same flags within a batch, so
+results do not depend on the number of processes or where the shard boundaries fall.
+"""
+
+from math import nan
+from multiprocessing import Pipe, Process, cpu_count
+from multiprocessing.shared_memory import SharedMemory
+import os
+
+from ezstate_simulator import EzEnvironment, EzStateSimulator
+from unpack_esd import EzState
+
+# (name, typecode, values per instance); 'inputs' width is set by `input_count`.
+SHARED_ARRAYS = (
+    ('state_indices', 'i', 1),
+    ('active', 'b', 1),
+    ('elapsed_frames', 'i', 1),
+    ('registers', 'd', 8),
+    ('inputs', 'd', None),
+)
+
+
+class _Shard(object):
+    """ Values shared by all instances in one worker. """
+
+    def __init__(self, report_commands):
+        self.tick = 0
+        self.event_flags = {}  # As of the start of the batch.
+        self.events = []
+        self.report_commands = None if report_commands is None else frozenset(report_commands)
+
+
+class SharedEnvironment(EzEnvironment):
+    """ Environment that reads function results from one instance's row of the shared `inputs` array. Functions with
+    arguments read the same slot as the function without arguments, except GetEventFlagValue (64), which reads the
+    shard's event flags. """
+
+    def __init__(self, shard, instance, inputs, input_count):
+        super().__init__(log_commands=False)
+        self.shard = shard
+        self.instance = instance
+        self.inputs = inputs
+        self.input_count = input_count
+        self.base = instance * input_count
+        self.command_handlers = {}
+
+    def call(self, function_index, *args):
+        if function_index == 65:
+            return self.elapsed_frames
+        if function_index == 66:
+            return self.elapsed_frames / self.frame_rate
+        if function_index == 64 and args:
+            return self.shard.event_flags.get(args[0], 0)
+        if 0 <= function_index < self.input_count:
+            return self.inputs[self.base + function_index]
+        return self.default
+
+    def tracks_calls(self, calls):
+        return False  # Shared inputs change without `set_function_value`.
+
+    def run_command(self, command_index, args):
+        shard = self.shard
+        # Event flags are only changed by the coordinator, between batches.
+        if command_index == 11 or shard.report_commands is None or command_index in shard.report_commands:
+            shard.events.append((shard.tick, self.instance, command_index, args))
+
+
+def _attach_arrays(shared_memories, instance_count, input_count):
+    """ Typed views of the shared memory blocks. Returns ({name: array}, all views to release before closing). """
+    arrays = {}
+    views = []
+    for (name, typecode, width), shared_memory in zip(SHARED_ARRAYS, shared_memories):
+        width = input_count if width is None else width
+        # Blocks may be rounded up to a whole page, so the typed view is cut to size.
+        full_view = shared_memory.buf.cast(typecode)
+        arrays[name] = full_view[:instance_count * width]
+        views += [arrays[name], full_view]
+    return arrays, views
+
+
+def _release_views(views):
+    for view in views:
+        view.release()
+
+
+def _run_shard(connection, shared_names, instance_count, input_count, first_instance, esd_sources, report_commands,
+               entry_state_index):
+    """ Worker process loop. Sends ('events', events) after setting up and after each batch, or ('error', description)
+    once if anything fails, and then stops. """
+    shared_memories = [SharedMemory(name=name) for name in shared_names]
+    arrays, views = _attach_arrays(shared_memories, instance_count, input_count)
+    state_indices, active = arrays['state_indices'], arrays['active']
+    elapsed_frames, registers = arrays['elapsed_frames'], arrays['registers']
+    shard = _Shard(report_commands)
+    simulators = []
+
+    def write_back():
+        for instance, simulator in enumerate(simulators, start=first_instance):
+            state_indices[instance] = simulator.state.index
+            active[instance] = 1 if simulator.state.active else 0
+            elapsed_frames[instance] = simulator.elapsed_frames
+            for r, value in enumerate(simulator.registers):
+                registers[8 * instance + r] = value if isinstance(value, (int, float)) else nan
+
+    try:
+        ezstates = {}
+        for instance, esd_source in enumerate(esd_sources, start=first_instance):
+            key = os.fspath(esd_source) if isinstance(esd_source, os.PathLike) else esd_source
+            if key not in ezstates:
+                ezstates[key] = EzState(esd_source)
+            environment = SharedEnvironment(shard, instance, arrays['inputs'], input_count)
+            simulators.append(EzStateSimulator(ezstates[key], environment, entry_state_index=entry_state_index))
+        write_back()
+        connection.send(('events', shard.events))
+        shard.events = []
+
+        while True:
+            message = connection.recv()
+            if message[0] == 'close':
+                break
+            _, first_tick, ticks, flag_updates = message
+            shard.event_flags.update(flag_updates)
+            # Pick up any changes the coordinator made between batches.
+            for instance, simulator in enumerate(simulators, start=first_instance):
+                key = (bool(active[instance]), state_indices[instance])
+                if (simulator.state.active, simulator.state.index) != key:
+                    simulator.state = simulator.states[key]
+                simulator.elapsed_frames = elapsed_frames[instance]
+            for tick in range(first_tick, first_tick + ticks):
+                shard.tick = tick
+                for simulator in simulators:
+                    simulator.tick()
+            write_back()
+            connection.send(('events', shard.events))
+            shard.events = []
+    except Exception as e:
+        connection.send(('error', '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        del state_indices, active, elapsed_frames, registers, arrays, simulators
+        _release_views(views)
+        for shared_memory in shared_memories:
+            shared_memory.close()
+
+
+class ShardedSimulation(object):
+    """ Coordinator for simulating one EzState instance per entry in `esd_sources` (file paths or ESD bytes; each
+    distinct source is loaded once per worker). Use as a context manager, or call `close()`, to stop the workers and
+    free the shared memory. """
+
+    def __init__(self, esd_sources, processes=None, input_count=72, ticks_per_sync=1, report_commands=(11,),
+                 entry_state_index=0):
+        self.instance_count = len(esd_sources)
+        self.input_count = input_count
+        self.ticks_per_sync = ticks_per_sync
+        self.tick_count = 0
+        self.report_commands = None if report_commands is None else frozenset(report_commands)
+        self.event_flags = {}
+        self._flag_updates = {}
+        self._shared_memories = []
+        for name, typecode, width in SHARED_ARRAYS:
+            width = input_count if width is None else width
+            size = max(1, self.instance_count * width * memoryview(b'').cast(typecode).itemsize)
+            self._shared_memories.append(SharedMemory(create=True, size=size))
+        self.arrays, self._views = _attach_arrays(self._shared_memories, self.instance_count, input_count)
+        for i in range(len(self.arrays['inputs'])):
+            self.arrays['inputs'][i] = 0.0
+
+        processes = min(processes or cpu_count(), max(1, self.instance_count))
+        shard_size = -(-self.instance_count // processes)  # ceiling division
+        self._workers = []
+        try:
+            for first_instance in range(0, self.instance_count, shard_size):
+                parent_connection, child_connection = Pipe()
+                process = Process(
+                    target=_run_shard, daemon=True,
+                    args=(child_connection, [m.name for m in self._shared_memories], self.instance_count,
+                          input_count, first_instance, esd_sources[first_instance:first_instance + shard_size],
+                          report_commands, entry_state_index))
+                process.start()
+                # Only the worker keeps this end open, so `recv` raises EOFError if the worker dies.
+                child_connection.close()
+                self._workers.append((process, parent_connection))
+            # Enter commands of the entry states.
+            self.initial_events = self._merge_events(self._receive_events())
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    @property
+    def state_indices(self):
+        return self.arrays['state_indices']
+
+    @property
+    def inputs(self):
+        return self.arrays['inputs']
+
+    def set_input(self, instance, function_index, value):
+        self.arrays['inputs'][instance * self.input_count + function_index] = value
+
+    def get_registers(self, instance):
+        return list(self.arrays['registers'][8 * instance:8 * instance + 8])
+
+    def _receive_events(self):
+        """ Events from every worker. Raises a RuntimeError if a worker failed or stopped. """
+        shard_events = []
+        errors = []
+        for process, connection in self._workers:
+            try:
+                kind, content = connection.recv()
+            except (EOFError, OSError):
+                process.join()
+                kind, content = 'error', 'worker process exited with code {}'.format(process.exitcode)
+            if kind == 'error':
+                errors.append(content)
+            else:
+                shard_events.append(content)
+        if errors:
+            raise RuntimeError('Simulation worker failed: ' + '; '.join(errors))
+        return shard_events
+
+    def _merge_events(self, shard_events):
+        """ Apply event flag changes in (tick, instance) order, and return the events in `report_commands`. """
+        events = sorted((event for events in shard_events for event in events), key=lambda e: (e[0], e[1]))
+        for _, _, command_index, args in events:
+            if command_index == 11 and args:
+                value = 1 if len(args) < 2 or args[1] else 0
+                self.event_flags[args[0]] = value
+                self._flag_updates[args[0]] = value
+        if self.report_commands is None:
+            return events
+        return [event for event in events if event[2] in self.report_commands]
+
+    def run(self, ticks, event_handler=None):
+        """ Step every instance `ticks` times. Merged events of each batch are passed to `event_handler` if given;
+        otherwise all events are returned. """
+        all_events = []
+        remaining = ticks
+        while remaining > 0:
+            batch_ticks = min(self.ticks_per_sync, remaining)
+            flag_updates, self._flag_updates = self._flag_updates, {}
+            for _, connection in self._workers:
+                try:
+                    connection.send(('run', self.tick_count, batch_ticks, flag_updates))
+                except OSError:
+                    pass  # The worker has stopped, which `_receive_events` reports.
+            events = self._merge_events(self._receive_events())
+            self.tick_count += batch_ticks
+            remaining -= batch_ticks
+            if event_handler is not None:
+                event_handler(events)
+            else:
+                all_events += events
+        return None if event_handler is not None else all_events
+
+    def close(self):
+        if self._workers is None:
+            return
+        for process, connection in self._workers:
+            try:
+                connection.send(('close',))
+            except (BrokenPipeError, OSError):
+                pass
+        for process, connection in self._workers:
+            process.join()
+            connection.close()
+        self._workers = None
+        self.arrays = {}
+        _release_views(self._views)
+        self._views = []
+        for shared_memory in self._shared_memories:
+            shared_memory.close()
+            shared_memory.unlink()
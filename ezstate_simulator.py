@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+"""
+Step an EzState through its states against a simulated environment.
+
+Each tick, the conditions of the current state are evaluated in order (with a fresh set of eight registers). The first
+true condition fires, and then the first true subcondition of that condition, and so on. The commands of every fired
+condition run in that order. If any fired condition has a next state (the deepest one wins), the exit commands of the
+current state run, the state changes, and the enter commands of the new state run.
+
+Conditions are evaluated by compiled functions from `ezstate_compiler` by default. `compiled=False` uses the reference
+interpreter `ezevaluate`, and `differential=True` runs both and raises a RuntimeError if they ever disagree (so
+environment functions must return the same values when called twice in one tick). Pass an `EzStateProfiler` (see
+`ezstate_profiler`) to count state visits, condition evaluations and command runs, and an `EzStateTracer` (see
+`ezstate_trace`) to record transitions, commands and environment inputs to a trace log.
+
+With `incremental=True`, a state in which no condition fired is not evaluated again until one of the function calls
+its conditions read (found statically by `ezstate_parser.expression_calls`) may give a different result. Function
+results must then be changed through `EzEnvironment.set_function_value`. If the conditions only use elapsed time
+(functions 65 and 66) in comparisons with constants (see `ezstate_parser.expression_timers`), the state is also
+evaluated again at the first frame where one of those comparisons changes (`wake_frame`). States that read callable
+function values, calls with non-constant arguments, or elapsed time in any other way are evaluated every tick.
+`ezstate_scheduler.EzStateScheduler` uses this to avoid stepping idle simulators at all.
+"""
+
+from functools import lru_cache
+from math import floor, inf, isfinite
+
+from ezstate_compiler import compile_expression, get_compiled_states
+from ezstate_parser import comparison_lookup, expression_calls, expression_timers, ezevaluate
+
+VOLATILE_FUNCTIONS = (65, 66)  # Elapsed frames and time, which change every tick.
+
+
+class EzEnvironment(object):
+    """ Function results and command handling for one simulated EzState instance.
+
+    `function_values` maps a function index, or a tuple of (function_index, *args), to a value or to a callable that
+    takes the function arguments. Functions that are not listed return `default`. Functions 65 and 66 (elapsed frames
+    and time in the current state) are supplied by the simulator through `elapsed_frames`.
+
+    `version` counts changes made through `set_function_value`, and `value_versions` gives the version of the last
+    change to each `function_values` key, so that incremental simulators can tell which inputs have changed.
+
+    Commands are passed to `command_handlers[command_index](*args)` if a handler exists, and appended to `command_log`
+    as (command_index, args) if `log_commands` is True. By default, SetEventState (command 11) updates the value
+    returned by GetEventFlagValue (function 64) for that flag.
+
+    If `event_flags` is an `ezstate_flags.EventFlagStore`, GetEventFlagValue reads it and SetEventState writes it
+    instead, so environments sharing one store see each other's flags. Changes made through the store by any of them
+    are recorded as changes to (64, flag_id) in every environment that shares it.
+    """
+
+    def __init__(self, function_values=None, default=0, frame_rate=30, log_commands=True, event_flags=None):
+        self.function_values = {} if function_values is None else function_values
+        self.default = default
+        self.frame_rate = frame_rate
+        self.elapsed_frames = 0
+        self.version = 0
+        self.value_versions = {}
+        self.listeners = []  # Called with each key changed through `set_function_value` or the event flag store.
+        self.log_commands = log_commands
+        self.command_log = []
+        self.command_handlers = {11: self.set_event_state}
+        self.event_flags = event_flags
+        if event_flags is not None:
+            event_flags.listeners.append(self._event_flag_changed)
+
+    def call(self, function_index, *args):
+        if function_index == 65:
+            return self.elapsed_frames
+        if function_index == 66:
+            return self.elapsed_frames / self.frame_rate
+        if function_index == 64 and self.event_flags is not None and args:
+            return self.event_flags.get(int(args[0]))
+        values = self.function_values
+        if args:
+            value = values.get((function_index,) + args, values.get(function_index, self.default))
+        else:
+            value = values.get(function_index, self.default)
+        if callable(value):
+            return value(*args)
+        return value
+
+    def set_function_value(self, key, value):
+        """ Set the result of a function index or (function_index, *args) tuple and record the change. """
+        self.function_values[key] = value
+        self._record_change(key)
+
+    def _record_change(self, key):
+        self.version += 1
+        self.value_versions[key] = self.version
+        for listener in self.listeners:
+            listener(key)
+
+    def tracks_calls(self, calls):
+        """ True if the results of all `calls` ((function_index, *args) tuples) can only change through
+        `set_function_value`. """
+        values = self.function_values
+        for call in calls:
+            if call[0] is None or call[0] in VOLATILE_FUNCTIONS or (len(call) == 2 and call[1] is None):
+                return False
+            if callable(values.get(call if len(call) > 1 else call[0], values.get(call[0]))):
+                return False
+        return True
+
+    def inputs_changed(self, calls, version):
+        """ True if the result of any of `calls` has been changed since `version`. """
+        if self.version == version:
+            return False
+        versions = self.value_versions
+        for call in calls:
+            if versions.get(call[0], 0) > version or versions.get(call, 0) > version:
+                return True
+        return False
+
+    def run_command(self, command_index, args):
+        handler = self.command_handlers.get(command_index)
+        if handler is not None:
+            handler(*args)
+        if self.log_commands:
+            self.command_log.append((command_index, args))
+
+    def set_event_state(self, event_flag_id, state=1, *_):
+        if self.event_flags is not None:
+            self.event_flags.set(int(event_flag_id), state)
+        else:
+            self.set_function_value((64, event_flag_id), 1 if state else 0)
+
+    def _event_flag_changed(self, event_flag_id):
+        self._record_change((64, event_flag_id))
+
+    def close(self):
+        """ Stop listening to the shared event flag store. """
+        if self.event_flags is not None and self._event_flag_changed in self.event_flags.listeners:
+            self.event_flags.listeners.remove(self._event_flag_changed)
+
+
+@lru_cache(maxsize=None)
+def _expression_calls(expression):
+    return frozenset(expression_calls(expression))
+
+
+def condition_calls(conditions):
+    """ Function calls read by `conditions` and their subconditions. """
+    calls = set()
+    stack = list(conditions)
+    while stack:
+        condition = stack.pop()
+        calls |= _expression_calls(bytes(condition.expression))
+        stack += condition.subconditions
+    return frozenset(calls)
+
+
+@lru_cache(maxsize=None)
+def _expression_timers(expression):
+    timers = expression_timers(expression)
+    return None if timers is None else tuple(timers)
+
+
+def condition_timers(conditions):
+    """ Elapsed time comparisons of `conditions` and their subconditions (see `ezstate_parser.expression_timers`), or
+    None if any condition uses elapsed time in another way. """
+    timers = set()
+    stack = list(conditions)
+    while stack:
+        condition = stack.pop()
+        expression_timers_ = _expression_timers(bytes(condition.expression))
+        if expression_timers_ is None:
+            return None
+        timers.update(expression_timers_)
+        stack += condition.subconditions
+    return tuple(timers)
+
+
+def timer_wake_frame(timers, elapsed_frames, frame_rate):
+    """ First frame after `elapsed_frames` at which any of `timers` changes its result, or `inf` if none will. """
+    wake_frame = inf
+    for function_index, opcode, constant, timer_on_left in timers:
+        scale = frame_rate if function_index == 66 else 1
+        compare = comparison_lookup[opcode]
+
+        def result(frames):
+            value = frames / frame_rate if function_index == 66 else frames
+            return compare(value, constant) if timer_on_left else compare(constant, value)
+
+        if not isfinite(constant):
+            continue
+        # Results only change next to the threshold frame, so only those frames need checking.
+        threshold = floor(constant * scale)
+        current = result(elapsed_frames)
+        for frames in range(max(threshold - 1, elapsed_frames + 1), threshold + 3):
+            if result(frames) != current:
+                wake_frame = min(wake_frame, frames)
+                break
+    return wake_frame
+
+
+def evaluate_conditions(conditions, call, registers):
+    """ Reference evaluation of a condition list. Returns the tuple of fired conditions. """
+    for condition in conditions:
+        if ezevaluate(condition.expression, call, registers):
+            if condition.subconditions:
+                return (condition,) + evaluate_conditions(condition.subconditions, call, registers)
+            return condition,
+    return ()
+
+
+class EzStateSimulator(object):
+    """ Simulates one instance of an EzState. """
+
+    def __init__(self, ezstate, environment=None, compiled=True, differential=False, entry_state_index=0,
+                 profiler=None, tracer=None, incremental=False):
+        self.ezstate = ezstate
+        self.environment = EzEnvironment() if environment is None else environment
+        self.tracer = tracer
+        self.call = self.environment.call if tracer is None else tracer.traced_call(self.environment.call)
+        self.compiled = compiled
+        self.differential = differential
+        self.profiler = profiler
+        self.states = {(state.active, state.index): state for state in ezstate.passive_states + ezstate.active_states}
+        if profiler is not None:
+            # Profiled conditions always use the profiler's instrumented compiled functions.
+            self.compiled = True
+            self.state_functions = profiler.state_functions
+        else:
+            self.state_functions = get_compiled_states(ezstate) if compiled or differential else None
+        self.entry_state_index = entry_state_index
+        self.incremental = incremental
+        self._state_calls = {}  # {(active, index): calls read by the state's conditions}
+        self._idle_state = None  # State in which nothing fired at `_idle_version`, while its inputs are unchanged.
+        self._idle_version = 0
+        self.wake_frame = inf  # Elapsed frames at which the idle state must be evaluated again.
+        self.state = None
+        self.registers = [0] * 8  # Registers from the last evaluation of the current state.
+        self.tick_count = 0
+        self.elapsed_frames = 0
+        self.reset()
+
+    def reset(self):
+        """ Return to the entry state (or the first state, if there is no state with the entry index) and run its
+        enter commands. """
+        entry_key = (False, self.entry_state_index)
+        self.state = self.states[entry_key] if entry_key in self.states else self.ezstate.passive_states[0]
+        self.tick_count = 0
+        self.elapsed_frames = 0
+        self._idle_state = None
+        if self.profiler is not None:
+            self.profiler.record_visit(self.state)
+        if self.tracer is not None:
+            self.tracer.begin_tick(0, self.state, 0)
+        self.run_commands(self.state.enter_commands)
+
+    def evaluate_arg(self, arg):
+        if self.compiled:
+            return compile_expression(arg)(self.call, [0] * 8)
+        return ezevaluate(arg, self.call, [0] * 8)
+
+    def run_commands(self, commands):
+        run_command = self.environment.run_command
+        if self.profiler is not None:
+            self.profiler.record_commands(commands)
+        for command in commands:
+            args = [self.evaluate_arg(arg) for arg in command.args]
+            if self.tracer is not None:
+                self.tracer.record_command(command.index, args)
+            run_command(command.index, args)
+
+    def evaluate_state(self, state):
+        """ Fired conditions of `state` for the current environment. """
+        call = self.call
+        if self.differential:
+            compiled_registers = self.registers = [0] * 8
+            reference_registers = [0] * 8
+            fired = self.state_functions[(state.active, state.index)](call, compiled_registers)
+            reference_fired = evaluate_conditions(state.conditions, call, reference_registers)
+            if (len(fired) != len(reference_fired) or any(a is not b for a, b in zip(fired, reference_fired))
+                    or compiled_registers != reference_registers):
+                raise RuntimeError(
+                    'Compiled conditions of state {} disagree with reference evaluation at tick {}: fired {} vs {}, '
+                    'registers {} vs {}.'.format(state.index, self.tick_count,
+                                                 [c.next_state_index for c in fired],
+                                                 [c.next_state_index for c in reference_fired],
+                                                 compiled_registers, reference_registers))
+            return fired
+        registers = self.registers = [0] * 8
+        if self.compiled:
+            return self.state_functions[(state.active, state.index)](call, registers)
+        return evaluate_conditions(state.conditions, call, registers)
+
+    def tick(self):
+        """ Evaluate the current state once. Returns the new state if it changed, or None. """
+        if self.profiler is not None:
+            return self.profiler.profile_tick(self)
+        return self.step()
+
+    def step(self):
+        """ Unprofiled tick. """
+        self.environment.elapsed_frames = self.elapsed_frames
+        if self.tracer is not None:
+            self.tracer.begin_tick(self.tick_count, self.state, self.elapsed_frames)
+        if self._idle_state is self.state:
+            environment = self.environment
+            key = (self.state.active, self.state.index)
+            if (self.elapsed_frames < self.wake_frame
+                    and not environment.inputs_changed(self._state_calls[key][0], self._idle_version)):
+                self._idle_version = environment.version
+                self.tick_count += 1
+                self.elapsed_frames += 1
+                return None
+        self._idle_state = None
+        fired = self.evaluate_state(self.state)
+        self.tick_count += 1
+        next_condition = None
+        for condition in fired:
+            self.run_commands(condition.commands)
+            if condition.next_state_index != -1:
+                next_condition = condition
+        if next_condition is None:
+            self.elapsed_frames += 1
+            if not fired and self.incremental:
+                self._try_idle()
+            return None
+        self.run_commands(self.state.exit_commands)
+        self.state = self.states[(next_condition.active, next_condition.next_state_index)]
+        self.elapsed_frames = 0
+        if self.tracer is not None:
+            self.tracer.record_transition(self.state)
+        self.run_commands(self.state.enter_commands)
+        return self.state
+
+    def _try_idle(self):
+        """ Skip evaluating the current state until its inputs change, if they can be tracked. """
+        key = (self.state.active, self.state.index)
+        try:
+            tracked = self._state_calls[key]
+        except KeyError:
+            calls = condition_calls(self.state.conditions)
+            timers = ()
+            if any(call[0] in VOLATILE_FUNCTIONS for call in calls):
+                timers = condition_timers(self.state.conditions)
+                calls = frozenset(call for call in calls if call[0] not in VOLATILE_FUNCTIONS)
+            if timers is None or any(call[0] is None or call[-1] is None for call in calls):
+                tracked = None  # Never trackable.
+            else:
+                tracked = (calls, timers)
+            self._state_calls[key] = tracked
+        if tracked is not None and self.environment.tracks_calls(tracked[0]):
+            calls, timers = tracked
+            # The state was evaluated at the previous frame count.
+            self.wake_frame = timer_wake_frame(timers, self.elapsed_frames - 1, self.environment.frame_rate)
+            self._idle_state = self.state
+            self._idle_version = self.environment.version
+
+    @property
+    def idle(self):
+        """ True if the next tick will not evaluate the current state unless its inputs change. """
+        return self._idle_state is self.state and self.elapsed_frames < self.wake_frame
+
+    def skip(self, ticks):
+        """ Advance an idle simulator by `ticks` ticks without evaluating it. The caller must ensure that it stays
+        idle (its inputs do not change and `wake_frame` is not reached). """
+        if self.profiler is not None:
+            self.profiler.state_ticks[self.profiler.state_slots[(self.state.active, self.state.index)]] += ticks
+        self.tick_count += ticks
+        self.elapsed_frames += ticks
+
+    def run(self, ticks):
+        """ Run `ticks` ticks. Returns the number of state changes. """
+        changes = 0
+        tick = self.tick
+        for _ in range(ticks):
+            if tick() is not None:
+                changes += 1
+        return changes
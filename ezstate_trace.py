@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+"""
+Compact binary traces of simulated EzState runs, with fast seeking.
+
+An `EzStateTracer` passed to `EzStateSimulator(tracer=...)` appends fixed-width 16-byte records to a log file:
+
+    type (B), flags (B), small (H), tick (I), payload (8 bytes)
+
+    KEYFRAME    flags = active, payload = (state index, elapsed frames) as two int32. Written at the first traced
+                tick of every `keyframe_interval` ticks (ticks skipped by an idle simulator are not traced),
+                followed by an INPUT snapshot record for every input seen so far.
+    TRANSITION  flags = active, payload = (new state index, 0). The new state applies from the next tick.
+    COMMAND     small = command index, flags = arg count; followed by that many ARG records.
+    ARG         flags = value kind, payload = value.
+    INPUT       small = function index, flags = value kind | (arg count << 2) | (snapshot << 7), payload = value;
+                followed by ARG records for the function arguments. Only written when a function result changes.
+
+Value kinds are int (int64), float (float64) and string (int64 index into the string table). Strings are kept in a
+small append-only sidecar file ('<log path>.strings', one JSON string per line). Elapsed time functions (65 and 66) are
+not recorded, as they follow from the state transitions.
+
+Every record carries its tick, and ticks never decrease, so `EzStateTrace` (which reads the log through a memory map)
+can find any tick by binary search and replay from the keyframe before it, without re-simulating.
+"""
+
+import json
+from mmap import ACCESS_READ, mmap
+import os
+import struct
+
+TRACE_MAGIC = b'EZTR'
+TRACE_HEADER = struct.Struct('<4sHHI')  # magic, version, record size, keyframe interval
+RECORD_INT = struct.Struct('<BBHIq')
+RECORD_FLOAT = struct.Struct('<BBHId')
+RECORD_PAIR = struct.Struct('<BBHIii')
+RECORD_SIZE = RECORD_INT.size
+
+KEYFRAME, TRANSITION, COMMAND, ARG, INPUT = range(5)
+VALUE_INT, VALUE_FLOAT, VALUE_STRING = range(3)
+SNAPSHOT_FLAG = 0x80
+UNTRACED_FUNCTIONS = (65, 66)
+
+
+class EzStateTracer(object):
+    """ Writes a trace log. Use as a context manager, or call `close()`, to flush it. """
+
+    def __init__(self, output_path, keyframe_interval=1024, buffer_records=4096):
+        self.output_path = output_path
+        self.keyframe_interval = keyframe_interval
+        self.buffer_records = buffer_records
+        self.tick = 0
+        self._next_keyframe_tick = 0
+        self._inputs = {}  # {(function_index, *args): value}
+        self._strings = {}
+        self._buffer = bytearray()
+        self._file = open(output_path, 'wb')
+        self._strings_file = open(output_path + '.strings', 'w', encoding='utf-8')
+        self._file.write(TRACE_HEADER.pack(TRACE_MAGIC, 1, RECORD_SIZE, keyframe_interval))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._file is None:
+            return
+        self.flush()
+        self._file.close()
+        self._strings_file.close()
+        self._file = None
+
+    def flush(self):
+        self._file.write(self._buffer)
+        self._buffer = bytearray()
+        self._file.flush()
+        self._strings_file.flush()
+
+    def _append(self, record):
+        self._buffer += record
+        if len(self._buffer) >= self.buffer_records * RECORD_SIZE:
+            self._file.write(self._buffer)
+            self._buffer = bytearray()
+
+    def _value_record(self, record_type, flags, small, value):
+        if isinstance(value, float):
+            return RECORD_FLOAT.pack(record_type, flags | VALUE_FLOAT, small, self.tick, value)
+        if isinstance(value, str):
+            string_index = self._strings.get(value)
+            if string_index is None:
+                string_index = self._strings[value] = len(self._strings)
+                self._strings_file.write(json.dumps(value) + '\n')
+            return RECORD_INT.pack(record_type, flags | VALUE_STRING, small, self.tick, string_index)
+        return RECORD_INT.pack(record_type, flags | VALUE_INT, small, self.tick, int(value))
+
+    def begin_tick(self, tick, state, elapsed_frames):
+        """ Called by the simulator before each evaluated tick. Writes a keyframe if one is due. """
+        self.tick = tick
+        if tick >= self._next_keyframe_tick:
+            self._next_keyframe_tick = (tick // self.keyframe_interval + 1) * self.keyframe_interval
+            self._append(RECORD_PAIR.pack(KEYFRAME, 1 if state.active else 0, 0, tick, state.index, elapsed_frames))
+            for key, value in self._inputs.items():
+                self._write_input(key, value, SNAPSHOT_FLAG)
+
+    def record_transition(self, state):
+        self._append(RECORD_PAIR.pack(TRANSITION, 1 if state.active else 0, 0, self.tick, state.index, 0))
+
+    def record_command(self, command_index, args):
+        self._append(RECORD_INT.pack(COMMAND, len(args), command_index, self.tick, 0))
+        for arg in args:
+            self._append(self._value_record(ARG, 0, 0, arg))
+
+    def _write_input(self, key, value, snapshot=0):
+        self._append(self._value_record(INPUT, (len(key) - 1) << 2 | snapshot, key[0], value))
+        for arg in key[1:]:
+            self._append(self._value_record(ARG, 0, 0, arg))
+
+    def traced_call(self, call):
+        """ Wrap an environment's `call` so that changed function results are recorded. """
+        inputs = self._inputs
+        missing = object()
+
+        def traced(function_index, *args):
+            value = call(function_index, *args)
+            if function_index not in UNTRACED_FUNCTIONS:
+                key = (function_index,) + args
+                if inputs.get(key, missing) != value:
+                    inputs[key] = value
+                    self._write_input(key, value)
+            return value
+
+        return traced
+
+
+class TraceSnapshot(object):
+    """ Simulation state at the start of a tick, with the latest recorded input values up to and including it. """
+
+    def __init__(self, tick, state_index, active, elapsed_frames, inputs):
+        self.tick = tick
+        self.state_index = state_index
+        self.active = active
+        self.elapsed_frames = elapsed_frames
+        self.inputs = inputs  # {(function_index, *args): value}
+
+    def __repr__(self):
+        return 'TraceSnapshot(tick={}, state_index={}, active={}, elapsed_frames={}, {} inputs)'.format(
+            self.tick, self.state_index, self.active, self.elapsed_frames, len(self.inputs))
+
+
+class EzStateTrace(object):
+    """ Memory-mapped reader of a trace log written by `EzStateTracer`. """
+
+    def __init__(self, trace_path):
+        self.trace_path = trace_path
+        with open(trace_path, 'rb') as file:
+            magic, version, record_size, self.keyframe_interval = TRACE_HEADER.unpack(file.read(TRACE_HEADER.size))
+            if magic != TRACE_MAGIC or record_size != RECORD_SIZE:
+                raise ValueError('{} is not an EzState trace log.'.format(trace_path))
+            self._map = mmap(file.fileno(), 0, access=ACCESS_READ)
+        self.record_count = (len(self._map) - TRACE_HEADER.size) // RECORD_SIZE
+        self.strings = []
+        strings_path = trace_path + '.strings'
+        if os.path.isfile(strings_path):
+            with open(strings_path, encoding='utf-8') as strings_file:
+                self.strings = [json.loads(line) for line in strings_file]
+
+    def __len__(self):
+        return self.record_count
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _offset(self, record_index):
+        return TRACE_HEADER.size + record_index * RECORD_SIZE
+
+    def record_tick(self, record_index):
+        return RECORD_INT.unpack_from(self._map, self._offset(record_index))[3]
+
+    @property
+    def last_tick(self):
+        return self.record_tick(self.record_count - 1) if self.record_count else 0
+
+    def _value(self, record_index):
+        record_type, flags, small, tick, value = RECORD_INT.unpack_from(self._map, self._offset(record_index))
+        kind = flags & 3
+        if kind == VALUE_FLOAT:
+            return RECORD_FLOAT.unpack_from(self._map, self._offset(record_index))[4]
+        if kind == VALUE_STRING:
+            return self.strings[value]
+        return value
+
+    def find_tick(self, tick):
+        """ Index of the first record with a tick greater than `tick` (binary search). """
+        low, high = 0, self.record_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record_tick(middle) <= tick:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_keyframe(self, tick):
+        """ Index of the last keyframe at or before `tick`. """
+        i = self.find_tick(tick) - 1
+        while i >= 0:
+            if self._map[self._offset(i)] == KEYFRAME:
+                return i
+            i -= 1
+        raise ValueError('No keyframe at or before tick {}.'.format(tick))
+
+    def events(self, start_record=0, end_record=None):
+        """ Decode records into events:
+            ('keyframe', tick, state_index, active, elapsed_frames)
+            ('transition', tick, state_index, active)
+            ('command', tick, command_index, args)
+            ('input', tick, function_index, args, value, is_snapshot)
+        """
+        end_record = self.record_count if end_record is None else end_record
+        i = start_record
+        while i < end_record:
+            record_type, flags, small, tick, _ = RECORD_INT.unpack_from(self._map, self._offset(i))
+            if record_type == KEYFRAME or record_type == TRANSITION:
+                state_index, elapsed_frames = RECORD_PAIR.unpack_from(self._map, self._offset(i))[4:]
+                if record_type == KEYFRAME:
+                    yield 'keyframe', tick, state_index, bool(flags), elapsed_frames
+                else:
+                    yield 'transition', tick, state_index, bool(flags)
+                i += 1
+            elif record_type == COMMAND:
+                args = [self._value(i + 1 + a) for a in range(flags)]
+                yield 'command', tick, small, args
+                i += 1 + flags
+            elif record_type == INPUT:
+                arg_count = (flags >> 2) & 0x1f
+                value = self._value(i)
+                args = tuple(self._value(i + 1 + a) for a in range(arg_count))
+                yield 'input', tick, small, args, value, bool(flags & SNAPSHOT_FLAG)
+                i += 1 + arg_count
+            else:
+                raise ValueError('Unexpected trace record type {} at record {}.'.format(record_type, i))
+
+    def replay(self, start_tick=0, end_tick=None):
+        """ Events from the start of `start_tick` to the end of `end_tick` (inclusive), excluding keyframes and
+        input snapshots. """
+        start_record = self.find_tick(start_tick - 1) if start_tick > 0 else 0
+        end_record = None if end_tick is None else self.find_tick(end_tick)
+        for event in self.events(start_record, end_record):
+            if event[0] == 'keyframe' or (event[0] == 'input' and event[5]):
+                continue
+            yield event
+
+    def seek(self, tick):
+        """ `TraceSnapshot` at the start of `tick`, replayed from the nearest earlier keyframe. """
+        keyframe_record = self._find_keyframe(tick)
+        state_index = active = entered_tick = None
+        inputs = {}
+        for event in self.events(keyframe_record, self.find_tick(tick)):
+            if event[0] == 'keyframe':
+                _, keyframe_tick, state_index, active, elapsed_frames = event
+                entered_tick = keyframe_tick - elapsed_frames
+            elif event[0] == 'transition' and event[1] < tick:
+                _, transition_tick, state_index, active = event
+                entered_tick = transition_tick + 1
+            elif event[0] == 'input':
+                inputs[(event[2],) + event[3]] = event[4]
+        return TraceSnapshot(tick, state_index, active, tick - entered_tick, inputs)
+
+    def transitions(self):
+        return [event for event in self.replay() if event[0] == 'transition']
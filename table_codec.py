@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative binary table layouts shared by the ESD (`unpack_esd.EzStruct`) and DRB (`unpack_drb.TABLE_FORMATS`) code.
+
+A `TableSchema` lists the named fields of one row with their `struct` formats. A field can hold several values (such as
+'iii' or '5i'), which are unpacked as a tuple. The whole row is compiled once into a single `struct.Struct`, and whole
+tables are decoded with `Struct.iter_unpack`, so decoding costs one C call per row rather than one per field.
+
+Fields that hold byte offsets of rows in other tables are declared in `references` ({field name: table name}).
+`resolve_offsets` maps a whole column of such offsets to row indices of the target table at once.
+
+If NumPy is installed, `TableSchema.view` gives a zero-copy structured array over table data.
+"""
+
+from struct import Struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class TableSchema(object):
+
+    def __init__(self, fields, references=None, byte_order='<'):
+        """ `fields` is a sequence of (name, struct format) pairs. """
+        self.fields = tuple(fields)
+        self.names = tuple(name for name, _ in self.fields)
+        self.formats = tuple(fmt for _, fmt in self.fields)
+        self.references = dict(references or {})
+        for name in self.references:
+            if name not in self.names:
+                raise ValueError('Reference field {} is not a field of this schema.'.format(name))
+        self.byte_order = byte_order
+        self.struct = Struct(byte_order + ''.join(self.formats))
+        self.size = self.struct.size
+        # Number of values of each field, and whether any field holds more than one (which needs regrouping).
+        self.value_counts = tuple(len(Struct(byte_order + fmt).unpack(bytes(Struct(byte_order + fmt).size)))
+                                  for fmt in self.formats)
+        self.flat = all(count == 1 for count in self.value_counts)
+        self._slices = []
+        start = 0
+        for count in self.value_counts:
+            self._slices.append((start, start + count))
+            start += count
+
+    @classmethod
+    def from_format(cls, fmt, names=(), references=None):
+        """ Schema of an existing row format string with one field per value (as in 'DRB' table formats), named from
+        `names` and then 'field_{i}'. `references` may use field positions instead of names. """
+        byte_order = fmt[0] if fmt and fmt[0] in '<>=!@' else ''
+        row_struct = Struct(fmt)
+        value_count = len(row_struct.unpack(bytes(row_struct.size)))
+        field_names = [names[i] if i < len(names) else 'field_{}'.format(i) for i in range(value_count)]
+        formats = _split_format(fmt[len(byte_order):])
+        if len(formats) != value_count:
+            raise ValueError('Cannot split format {} into one field per value.'.format(fmt))
+        references = {field_names[field] if isinstance(field, int) else field: table
+                      for field, table in (references or {}).items()}
+        return cls(zip(field_names, formats), references, byte_order)
+
+    def _group(self, values):
+        return tuple(values[start] if end - start == 1 else values[start:end] for start, end in self._slices)
+
+    def iter_rows(self, data, count=None, offset=0):
+        """ Yield each row as a tuple of field values (tuples for multi-value fields). """
+        if count is None:
+            count = (len(data) - offset) // self.size
+        rows = self.struct.iter_unpack(memoryview(data)[offset:offset + count * self.size])
+        if self.flat:
+            return rows
+        return (self._group(row) for row in rows)
+
+    def unpack_from(self, data, offset=0):
+        values = self.struct.unpack_from(data, offset)
+        return values if self.flat else self._group(values)
+
+    def unpack_rows(self, data, count=None, offset=0, first_key=0):
+        """ {key: {field name: value}} for `count` rows, where keys are row byte offsets starting at `first_key`. """
+        names = self.names
+        size = self.size
+        return {first_key + i * size: dict(zip(names, row))
+                for i, row in enumerate(self.iter_rows(data, count, offset))}
+
+    def columns(self, data, count=None, offset=0):
+        """ List of one list per field. """
+        columns = [list(column) for column in zip(*self.iter_rows(data, count, offset))]
+        return columns or [[] for _ in self.names]
+
+    def pack_row(self, row):
+        """ Pack one row, given as a sequence of field values or a dictionary of them. """
+        if isinstance(row, dict):
+            if set(row) != set(self.names):
+                raise ValueError('Dictionary keys must match schema fields {}, not {}.'.format(
+                    self.names, tuple(row)))
+            row = [row[name] for name in self.names]
+        if len(row) != len(self.names):
+            raise ValueError('Row must have {} fields, not {}: {}'.format(len(self.names), len(row), row))
+        if self.flat:
+            return self.struct.pack(*row)
+        values = []
+        for value in row:
+            if isinstance(value, (tuple, list)):
+                values.extend(value)
+            else:
+                values.append(value)
+        return self.struct.pack(*values)
+
+    def pack(self, rows):
+        return b''.join(self.pack_row(row) for row in rows)
+
+    def dtype(self):
+        """ NumPy structured dtype of a row (requires NumPy). """
+        if numpy is None:
+            raise ImportError('NumPy is required for dtype views of binary tables.')
+        order = '>' if self.byte_order in '>!' else '<'
+        dtype_fields = []
+        for name, fmt, count in zip(self.names, self.formats, self.value_counts):
+            code = fmt.lstrip('0123456789')
+            if code[-1] == 's':
+                dtype_fields.append((name, 'S{}'.format(Struct(fmt).size)))
+            elif count == 1:
+                dtype_fields.append((name, order + code))
+            else:
+                dtype_fields.append((name, order + code[0], (count,)))
+        return numpy.dtype(dtype_fields)
+
+    def view(self, data, count=None, offset=0):
+        """ Zero-copy NumPy structured array of `count` rows of `data` (requires NumPy). """
+        dtype = self.dtype()
+        if count is None:
+            count = (len(data) - offset) // self.size
+        return numpy.frombuffer(data, dtype=dtype, count=count, offset=offset)
+
+
+def _split_format(fmt):
+    """ Split a format like '10i12h' into one format per value ('i', 'i', ..., 'h'). Strings ('4s') stay whole. """
+    formats = []
+    repeat = ''
+    for character in fmt:
+        if character.isdigit():
+            repeat += character
+        elif character == 's':
+            formats.append(repeat + 's')
+            repeat = ''
+        else:
+            formats += [character] * int(repeat or 1)
+            repeat = ''
+    return formats
+
+
+def resolve_offsets(offsets, row_offsets, allow_null=False):
+    """ Row indices of a whole column of byte `offsets` into a table whose rows start at `row_offsets` (a `range` for
+    fixed-size rows, or any sequence). Offsets of -1 give None if `allow_null` is True. Raises KeyError with the first
+    offset that is not the start of a row. """
+    if isinstance(row_offsets, range):
+        start, step, stop = row_offsets.start, row_offsets.step, row_offsets.stop
+        indices = []
+        for offset in offsets:
+            if offset == -1 and allow_null:
+                indices.append(None)
+            elif start <= offset < stop and not (offset - start) % step:
+                indices.append((offset - start) // step)
+            else:
+                raise KeyError(offset)
+        return indices
+    index = {offset: i for i, offset in enumerate(row_offsets)}
+    if allow_null:
+        return [None if offset == -1 else index[offset] for offset in offsets]
+    return [index[offset] for offset in offsets]
@@ -1,55 +1,13 @@
-
+import argparse
 from collections import OrderedDict
+import csv
+from io import BytesIO
+import json
+import os
 import struct
+import sys
 
-FILE = None
-MASTER_OFFSET = 0
-
-
-def read_integers(n, update_master=True):
-    """ Read n integers from an open bytes file. """
-    global FILE, MASTER_OFFSET
-    fmt = '<{n}i'.format(n=n)
-    if update_master:
-        MASTER_OFFSET += struct.calcsize(fmt)
-    return struct.unpack(fmt, FILE.read(struct.calcsize(fmt)))
-
-
-def read_utf16_string():
-    global FILE, MASTER_OFFSET
-    string = ''
-    hex_chr = FILE.read(2)
-    MASTER_OFFSET += 2
-    while hex_chr != b'\x00\x00':
-        string += hex_chr.decode('utf-16le')
-        hex_chr = FILE.read(2)
-        MASTER_OFFSET += 2
-    return string
-
-
-def read_format(fmt, update_master=True):
-    global FILE, MASTER_OFFSET
-    if fmt == 's':
-        return read_utf16_string()
-    if update_master:
-        MASTER_OFFSET += struct.calcsize(fmt)
-    return struct.unpack(fmt, FILE.read(struct.calcsize(fmt)))
-
-
-def forward_to(target_offset):
-    global MASTER_OFFSET
-    if MASTER_OFFSET == target_offset:
-        return
-    if MASTER_OFFSET > target_offset:
-        raise ValueError("Master offset {} is already ahead of target offset {}.".format(MASTER_OFFSET, target_offset))
-    read_format('{}c'.format(target_offset - MASTER_OFFSET))
-
-
-def read_bytes(number_bytes):
-    global MASTER_OFFSET
-    MASTER_OFFSET += number_bytes
-    return FILE.read(number_bytes)
-
+from table_codec import resolve_offsets, TableSchema
 
 TABLE_FORMATS = {
     'STR': {'fmt': 's'},
@@ -98,134 +56,473 @@ TABLE_FORMATS = {
 }
 
 
-def read_drb_table(drb, read=True):
-    """ `drb` should be a dictionary. It will be modified in place. """
-    name, size, count, _ = read_format('<4s3i')
-    name = name.decode().strip('\x00')
-    if name == 'END':
-        return name, size, count
-    drb[name] = OrderedDict()
-    row_size = size // count
-    start_offset = MASTER_OFFSET
+# Row schemas of the fixed-size tables. Arguments naming another table are offsets of its rows.
+TABLE_SCHEMAS = {
+    name: TableSchema.from_format(table_format['fmt'], table_format.get('names', ()),
+                                  references={i: arg for i, arg in enumerate(table_format['args'])
+                                              if arg in TABLE_FORMATS})
+    for name, table_format in TABLE_FORMATS.items() if table_format['fmt'] not in (None, 's')}
+SHAP_STRUCTS = {shap_type: struct.Struct(func['fmt']) for shap_type, func in TABLE_FORMATS['SHAP']['funcs'].items()}
+TABLE_STRUCTS = {name: schema.struct for name, schema in TABLE_SCHEMAS.items()}
+CTPR_STRUCT = struct.Struct('<i')
+SCDP_STRUCT = struct.Struct('<2i')
+
+
+class DrbTable(object):
+    """ Columnar DRB table. Rows are keyed by their byte offset from the start of the table, like the old dicts. """
+
+    def __init__(self, name, offsets, columns, scalar=False):
+        self.name = name
+        self.offsets = offsets
+        self.columns = columns
+        self.scalar = scalar  # Rows are single values (strings or packed data) rather than tuples.
+        if isinstance(offsets, range):
+            self._index = None
+        else:
+            self._index = {offset: i for i, offset in enumerate(offsets)}
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __contains__(self, offset):
+        try:
+            self.row_index(offset)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, offset):
+        return self.row(self.row_index(offset))
+
+    def row_index(self, offset):
+        if self._index is not None:
+            return self._index[offset]
+        if offset in self.offsets:
+            return (offset - self.offsets.start) // self.offsets.step
+        raise KeyError(offset)
+
+    def row_indices(self, offsets):
+        """ Map a whole column of offsets to row indices in one pass. """
+        if self._index is not None:
+            index = self._index
+            return [index[offset] for offset in offsets]
+        return resolve_offsets(offsets, self.offsets)
+
+    def row(self, i):
+        if self.scalar:
+            return self.columns[0][i]
+        return tuple(column[i] for column in self.columns)
+
+    def keys(self):
+        return list(self.offsets)
+
+    def values(self):
+        if self.scalar:
+            return list(self.columns[0])
+        return list(zip(*self.columns))
+
+    def items(self):
+        return list(zip(self.offsets, self.values()))
+
+
+def decode_drb_table(name, data, count, start_offset=0):
+    """ Decode all rows of a table in one pass into columns. `start_offset` is the table offset of the first row in
+    `data`, for decoding fixed-size tables in chunks. """
     fmt = TABLE_FORMATS[name]['fmt']
-    if read and count != 1:
-        for i in range(count):
-            o = MASTER_OFFSET - start_offset
-            drb[name][o] = read_format(fmt)
-    else:
-        for i in range(count):
-            o = MASTER_OFFSET - start_offset
-            drb[name][o] = read_bytes(row_size)
-    forward_to(start_offset + size)
-    return name, size, count
-
-
-def read_shpr(shpr_data, shap_type, offset):
-    # Read packed SHPR data. Size is calculated from offset gap.
-    data = shpr_data[offset:offset + struct.calcsize(TABLE_FORMATS['SHAP']['funcs'][shap_type]['fmt'])]
-    if shap_type in TABLE_FORMATS['SHAP']['funcs']:
-        data = struct.unpack(TABLE_FORMATS['SHAP']['funcs'][shap_type]['fmt'], data)
-        if 'names' in TABLE_FORMATS['SHAP']['funcs'][shap_type]:
-            names = TABLE_FORMATS['SHAP']['funcs'][shap_type]['names']
+    if fmt == 's':
+        # Null-terminated UTF-16LE strings, keyed by their byte offset. Only the first `count` strings are decoded, so
+        # padding after them (which may be an odd number of bytes) is ignored.
+        strings = []
+        offsets = []
+        o = 0
+        while len(strings) < count and o < len(data):
+            end = data.find(b'\x00\x00', o)
+            while end != -1 and (end - o) % 2:
+                end = data.find(b'\x00\x00', end + 1)
+            if end == -1:
+                end = len(data) - (len(data) - o) % 2  # Unterminated last string.
+            offsets.append(o)
+            strings.append(data[o:end].decode('utf-16le'))
+            o = end + 2
+        return DrbTable(name, offsets, [strings], scalar=True)
+    if fmt is None:
+        # Packed data table, referenced by other tables via byte offsets.
+        return DrbTable(name, range(0, 1), [[data]], scalar=True)
+    schema = TABLE_SCHEMAS[name]
+    columns = schema.columns(data, count)
+    return DrbTable(name, range(start_offset, start_offset + count * schema.size, schema.size), columns)
+
+
+def read_shpr(shpr_data, shap_type, offset, size=None, labels=True):
+    """ Read packed SHPR data. Size of unknown types is calculated from offset gap. """
+    shap_struct = SHAP_STRUCTS.get(shap_type)
+    if shap_struct is not None:
+        data = shap_struct.unpack_from(shpr_data, offset)
+        names = TABLE_FORMATS['SHAP']['funcs'][shap_type].get('names', ())
+        if names and labels:
             data = tuple(['{}={}'.format(names[i], data[i]) for i in range(len(names))]) + data[len(names):]
-    else:
-        data = struct.unpack('<{}h'.format(len(data) // 2), data[:2 * (len(data) // 2)])
-    return data
+        return data
+    if size is None:
+        size = len(shpr_data) - offset
+    data = shpr_data[offset:offset + size]
+    return struct.unpack('<{}h'.format(len(data) // 2), data[:2 * (len(data) // 2)])
+
+
+def shpr_boundaries(offsets, shpr_size):
+    """ {SHPR offset: next SHPR offset (or `shpr_size`)} for a whole column of SHAP offsets. Unknown shapes have no
+    struct, so their size is the gap to the next offset. """
+    ends = sorted(set(offsets)) + [shpr_size]
+    return {o: ends[i + 1] for i, o in enumerate(ends[:-1])}
+
+
+def _read_shpr_column(shpr_data, shap_types, offsets, labels=True, next_offset=None):
+    if next_offset is None:
+        next_offset = shpr_boundaries(offsets, len(shpr_data))
+    return [read_shpr(shpr_data, t, o, next_offset[o] - o, labels) for t, o in zip(shap_types, offsets)]
+
+
+def _join_column(name, arg, column, target):
+    """ Resolve a column of offsets into rows of `target` as a single offset -> row join. """
+    try:
+        indices = target.row_indices(column)
+    except KeyError as e:
+        raise KeyError('{} row references missing {} offset {}.'.format(name, arg, e.args[0]))
+    if target.scalar:
+        target_column = target.columns[0]
+        return [target_column[j] for j in indices]
+    target_columns = target.columns
+    return [tuple(c[j] for c in target_columns) for j in indices]
+
+
+def resolve_column(name, i, table, drb, out_drb, labels=True, shpr_next_offset=None):
+    """ Resolve column `i` of `table` against other tables, returning a list of values. Only SHPR shapes (and any
+    tables in `out_drb`) carry field labels. `shpr_next_offset` (from `shpr_boundaries`) sizes unknown shapes when
+    `table` is only part of its table. """
+    schema = TABLE_SCHEMAS[name]
+    arg = schema.references.get(schema.names[i])
+    column = table.columns[i]
+    if arg not in drb:
+        return list(column)
+    if arg == 'SHPR':
+        return _read_shpr_column(drb[arg].columns[0][0], table.columns[0], column, labels, shpr_next_offset)
+    if arg == 'CTPR':
+        # Read a packed int.
+        data = drb[arg].columns[0][0]
+        return [CTPR_STRUCT.unpack_from(data, o)[0] for o in column]
+    if arg == 'SCDP':
+        data = drb[arg].columns[0][0]
+        return [SCDP_STRUCT.unpack_from(data, o)[0] for o in column]
+    target = out_drb.get(arg, drb[arg])
+    if name == 'ANIO' and i == 2:
+        # Rows with a zero final field have no ANIK reference.
+        has_reference = [value != 0 for value in table.columns[3]]
+        joined = iter(_join_column(name, arg, [o for o, h in zip(column, has_reference) if h], target))
+        return [next(joined) if h else 'X' for h in has_reference]
+    return _join_column(name, arg, column, target)
+
+
+def process_drb_table(name, table, drb, out_drb, labels=True, shpr_next_offset=None):
+    """ Resolve all references in one table. `out_drb` holds processed tables that should be referenced instead of
+    their raw rows. Fields are shown as 'name=value' strings unless `labels` is False. """
+    args = TABLE_FORMATS[name]['args']
+    names = TABLE_FORMATS[name].get('names', ())
+    out_columns = []
+    for i, arg in enumerate(args):
+        values = resolve_column(name, i, table, drb, out_drb, labels, shpr_next_offset)
+        if labels and i < len(names) and arg not in ('SHPR', 'CTPR', 'SCDP') and not (name == 'ANIO' and i == 2):
+            label = names[i] + '='
+            values = [label + str(value) for value in values]
+        out_columns.append(values)
+    return DrbTable(name, table.offsets, out_columns)
+
+
+def is_processed_table(name):
+    # String table and packed data tables are only ever referenced, not processed.
+    return name not in 'STR' and TABLE_FORMATS[name]['fmt'] is not None
 
 
 def process_drb(drb):
     """ Convert string offsets and show other table indices. """
     out_drb = {}
     for name, table in drb.items():
-        if name in 'STR' or TABLE_FORMATS[name]['fmt'] is None:
-            # Don't process string table or any packed data tables.
+        if not is_processed_table(name):
             continue
-        fmt = TABLE_FORMATS[name]['args']
-        out_table = {}
-        offsets = list(table.keys())
-        rows = list(table.values())
-        names = TABLE_FORMATS[name].get('names', ())
-        for r, row in enumerate(rows):
-            out_row = []
-            for i, arg in enumerate(fmt):
-                if arg in drb.keys():
-                    # Arg is an offset into another table.
-                    if arg == 'SHPR':
-                        data = read_shpr(drb[arg][0], shap_type=row[0], offset=row[1])
-                        out_row.append(data)
-                    elif arg == 'CTPR':
-                        # Read a packed int.
-                        data = drb['CTPR'][0][row[1]:row[1] + 4]
-                        out_row.append(struct.unpack('<i', data)[0])
-                    elif arg == 'SCDP':
-                        data = drb[arg][0][row[1]:row[1] + 8]
-                        out_row.append(struct.unpack('<2i', data)[0])
-                    elif name == 'ANIO' and i == 2 and row[3] == 0:
-                        out_row.append('X')
-                    else:
-                        try:
-                            try:
-                                out_row.append('{}={}'.format(names[i], out_drb[arg][row[i]]))
-                            except IndexError:
-                                out_row.append(out_drb[arg][row[i]])
-                        except KeyError:
-                            try:
-                                try:
-                                    out_row.append('{}={}'.format(names[i], drb[arg][row[i]]))
-                                except IndexError:
-                                    out_row.append(drb[arg][row[i]])
-                            except KeyError:
-                                print(name, arg, row, i)
-                                raise
-                else:
-                    try:
-                        out_row.append('{}={}'.format(names[i], row[i]))
-                    except IndexError:
-                        out_row.append(row[i])
-            out_table[offsets[r]] = tuple(out_row)
-        out_drb[name] = out_table
+        out_drb[name] = process_drb_table(name, table, drb, out_drb)
     return out_drb
 
 
-def unpack_drb(filename, print_tables=True, print_processed=True):
-
-    global FILE, MASTER_OFFSET
-    MASTER_OFFSET = 0
-
-    drb = {}
-
-    with open(filename, 'rb') as FILE:
-
-        read_format('<4s3i')  # Header
-
-        table_name = ''
-        while table_name != 'END':
-            table_name, size, count = read_drb_table(drb, True)
-            if table_name == 'END':
-                print('\nFinished.')
-                break
-            print('\n{} loaded. (ends at {} offset with {} entries, {} size.)'.format(
-                table_name, MASTER_OFFSET, count, size))
-            if print_tables and TABLE_FORMATS[table_name] is not None:
-                [print('{}: {}'.format(offset, row)) for offset, row in list(drb[table_name].items())[:5]]
-                print('...')
-                [print('{}: {}'.format(offset, row)) for offset, row in list(drb[table_name].items())[-5:]]
-
-        processed_drb = process_drb(drb)
-
-        with open('menu.drb.txt', 'w', encoding='utf-16le') as out_file:
+class DrbFile(object):
+    """ Table directory of a DRB file.
+
+    Only the table headers (name, size, count) are read on creation. Each table is decoded the first time it is
+    requested, and processed (with its references resolved) only when `processed()` is called for it or for a table
+    that references it. Tables can be accessed by name like the `drb` dictionary returned by `unpack_drb`.
+    """
+
+    HEADER = struct.Struct('<4s3i')
+
+    def __init__(self, drb_source):
+        if isinstance(drb_source, (bytes, bytearray, memoryview)):
+            self.path = None
+            self._data = drb_source
+        else:
+            self.path = drb_source
+            self._data = None
+        self.directory = OrderedDict()  # {name: (data_offset, size, count)}
+        self._tables = {}
+        self._processed = {True: {}, False: {}}  # Labelled and unlabelled processed tables.
+
+        with self._open() as file:
+            file.read(self.HEADER.size)  # File header
+            offset = self.HEADER.size
+            while True:
+                name, size, count, _ = self.HEADER.unpack(file.read(self.HEADER.size))
+                offset += self.HEADER.size
+                name = name.decode().strip('\x00')
+                if name == 'END':
+                    break
+                self.directory[name] = (offset, size, count)
+                offset += size
+                file.seek(offset)
+
+    def _open(self):
+        if self._data is not None:
+            return BytesIO(self._data)
+        return open(self.path, 'rb')
+
+    def __contains__(self, name):
+        return name in self.directory
+
+    def __iter__(self):
+        return iter(self.directory)
+
+    def __len__(self):
+        return len(self.directory)
+
+    def __getitem__(self, name):
+        return self.table(name)
+
+    def keys(self):
+        return list(self.directory)
+
+    def items(self):
+        return [(name, self.table(name)) for name in self.directory]
+
+    def read_table_data(self, name, start=0, size=None):
+        """ Read the raw bytes of one table, or `size` bytes of it from table offset `start`. """
+        offset, table_size, _ = self.directory[name]
+        offset += start
+        size = table_size - start if size is None else min(size, table_size - start)
+        if self._data is not None:
+            return bytes(self._data[offset:offset + size])
+        with open(self.path, 'rb') as file:
+            file.seek(offset)
+            return file.read(size)
+
+    def table(self, name):
+        """ Decoded (but unprocessed) table. """
+        try:
+            return self._tables[name]
+        except KeyError:
+            _, _, count = self.directory[name]
+            table = self._tables[name] = decode_drb_table(name, self.read_table_data(name), count)
+            return table
+
+    def processed(self, name, labels=True):
+        """ Table with references into other tables resolved, as written by `unpack_drb`. """
+        try:
+            return self._processed[labels][name]
+        except KeyError:
+            pass
+        table = self._processed[labels][name] = process_drb_table(
+            name, self.table(name), self, self.referenced_tables(name, labels), labels)
+        return table
+
+    def referenced_tables(self, name, labels=True):
+        """ Processed tables referenced by `name`. """
+        if not is_processed_table(name):
+            raise ValueError('Table {} is only referenced by other tables and cannot be processed.'.format(name))
+        # Referenced tables that come earlier in the file are shown processed, as `process_drb` does.
+        position = list(self.directory).index(name)
+        out_drb = {}
+        for arg in TABLE_FORMATS[name]['args']:
+            if (arg in self.directory and arg not in out_drb and is_processed_table(arg)
+                    and list(self.directory).index(arg) < position):
+                out_drb[arg] = self.processed(arg, labels)
+        return out_drb
+
+
+def unpack_drb(filename, print_tables=True, print_processed=True, output_path='menu.drb.txt'):
+    """ Decode and process every table in a DRB file, optionally writing all processed tables to `output_path`. Use
+    `DrbFile` directly to load only some tables. """
+
+    drb_file = DrbFile(filename)
+    drb = OrderedDict()
+
+    for table_name, (offset, size, count) in drb_file.directory.items():
+        drb[table_name] = drb_file.table(table_name)
+        print('\n{} loaded. (ends at {} offset with {} entries, {} size.)'.format(
+            table_name, offset + size, count, size))
+        if print_tables and TABLE_FORMATS[table_name] is not None:
+            [print('{}: {}'.format(offset, row)) for offset, row in list(drb[table_name].items())[:5]]
+            print('...')
+            [print('{}: {}'.format(offset, row)) for offset, row in list(drb[table_name].items())[-5:]]
+    print('\nFinished.')
+
+    processed_drb = OrderedDict(
+        (name, drb_file.processed(name)) for name in drb_file.directory if is_processed_table(name))
+
+    if output_path is not None:
+        with open(output_path, 'w', encoding='utf-16le') as out_file:
             for name, table in processed_drb.items():
                 out_file.write('\n\n{}:'.format(name))
                 [out_file.write('\n  {}'.format(row)) for row in table.values()]
 
-        if print_processed:
-            for name, table in processed_drb.items():
-                print('{}:'.format(name))
-                [print('{}: {}'.format(o, r)) for o, r in table.items()]
-        return drb
+    if print_processed:
+        for name, table in processed_drb.items():
+            print('{}:'.format(name))
+            [print('{}: {}'.format(o, r)) for o, r in table.items()]
+    return drb
+
+
+def drb_field_names(name):
+    """ Field names used when exporting rows of table `name`. """
+    names = TABLE_FORMATS[name].get('names', ())
+    if TABLE_FORMATS[name]['fmt'] == 's':
+        return ('string',)
+    fields = []
+    for i, arg in enumerate(TABLE_FORMATS[name]['args']):
+        if i < len(names):
+            fields.append(names[i])
+        elif arg in TABLE_FORMATS:
+            fields.append(arg.lower())
+        else:
+            fields.append('field_{}'.format(i))
+    return tuple(fields)
+
+
+def iter_drb_rows(drb_file, name, chunk_rows=4096):
+    """ Yield `(offset, row)` for each row of table `name` with references resolved (unlabelled).
+
+    Fixed-size tables are read and resolved `chunk_rows` rows at a time, so only one chunk of the table is held in
+    memory alongside the (small) tables it references.
+    """
+    if TABLE_FORMATS[name]['fmt'] == 's':
+        yield from drb_file.table(name).items()
+        return
+    if not is_processed_table(name):
+        raise ValueError('Table {} holds packed data and cannot be exported by row.'.format(name))
+    out_drb = drb_file.referenced_tables(name, labels=False)
+    row_size = TABLE_STRUCTS[name].size
+    _, _, count = drb_file.directory[name]
+
+    def chunks():
+        for first_row in range(0, count, chunk_rows):
+            chunk_count = min(chunk_rows, count - first_row)
+            data = drb_file.read_table_data(name, first_row * row_size, chunk_count * row_size)
+            yield decode_drb_table(name, data, chunk_count, start_offset=first_row * row_size)
+
+    # Shapes of unknown types are sized by the next SHPR offset in the whole table, not just in their own chunk.
+    shpr_next_offset = None
+    schema = TABLE_SCHEMAS[name]
+    shpr_columns = [i for i, field in enumerate(schema.names) if schema.references.get(field) == 'SHPR']
+    if shpr_columns and 'SHPR' in drb_file:
+        offsets = set()
+        for chunk in chunks():
+            for i in shpr_columns:
+                offsets.update(chunk.columns[i])
+        shpr_next_offset = shpr_boundaries(offsets, len(drb_file['SHPR'].columns[0][0]))
+
+    for chunk in chunks():
+        yield from process_drb_table(name, chunk, drb_file, out_drb, False, shpr_next_offset).items()
+
+
+def _jsonable(value):
+    if isinstance(value, tuple):
+        return [_jsonable(v) for v in value]
+    return value
+
+
+def export_drb_table(drb_file, name, output, fmt='jsonl', chunk_rows=4096):
+    """ Stream one table to text stream `output` as JSON Lines or CSV. Returns the number of rows written.
+
+    Each JSON line is an object with 'table', 'offset' and one key per field. CSV output has a header row of 'offset'
+    and field names. Referenced rows are nested as JSON arrays (JSON-encoded in CSV cells).
+    """
+    fields = drb_field_names(name)
+    rows_written = 0
+    if fmt == 'jsonl':
+        for offset, row in iter_drb_rows(drb_file, name, chunk_rows):
+            if not isinstance(row, tuple):
+                row = (row,)
+            record = {'table': name, 'offset': offset}
+            record.update(zip(fields, _jsonable(row)))
+            output.write(json.dumps(record, ensure_ascii=False) + '\n')
+            rows_written += 1
+    elif fmt == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(('offset',) + fields)
+        for offset, row in iter_drb_rows(drb_file, name, chunk_rows):
+            if not isinstance(row, tuple):
+                row = (row,)
+            writer.writerow([offset] + [json.dumps(_jsonable(v), ensure_ascii=False) if isinstance(v, tuple) else v
+                                        for v in row])
+            rows_written += 1
+    else:
+        raise ValueError('Unknown export format: {}'.format(fmt))
+    return rows_written
+
+
+def export_drb(drb_source, output, fmt='jsonl', tables=None, chunk_rows=4096, verbose=False):
+    """ Stream the rows of `tables` (default: all exportable tables) of a DRB file.
+
+    JSON Lines output goes to one text stream or file path, with every table in it. CSV output needs one file per
+    table, so `output` is then a directory (one '<table>.csv' per table), or a text stream if only one table is
+    exported. Nothing is printed unless `verbose` is True, in which case progress goes to stderr.
+    """
+    drb_file = drb_source if isinstance(drb_source, DrbFile) else DrbFile(drb_source)
+    if tables is None:
+        tables = [name for name in drb_file.directory
+                  if is_processed_table(name) or TABLE_FORMATS[name]['fmt'] == 's']
+
+    if fmt == 'csv' and not hasattr(output, 'write'):
+        os.makedirs(output, exist_ok=True)
+        for name in tables:
+            with open(os.path.join(output, name + '.csv'), 'w', encoding='utf-8', newline='') as table_output:
+                rows = export_drb_table(drb_file, name, table_output, fmt, chunk_rows)
+            if verbose:
+                print('{}: {} rows exported.'.format(name, rows), file=sys.stderr)
+        return
+
+    if fmt == 'csv' and len(tables) != 1:
+        raise ValueError('CSV export to a single stream requires exactly one table.')
+    if not hasattr(output, 'write'):
+        with open(output, 'w', encoding='utf-8', newline='') as output_file:
+            return export_drb(drb_file, output_file, fmt, tables, chunk_rows, verbose)
+    for name in tables:
+        rows = export_drb_table(drb_file, name, output, fmt, chunk_rows)
+        if verbose:
+            print('{}: {} rows exported.'.format(name, rows), file=sys.stderr)
 
 
 if __name__ == '__main__':
 
-    in_filename = 'menu.drb'  # not tested with other .drb files
-    unpack_drb(in_filename, print_tables=False, print_processed=False)
+    parser = argparse.ArgumentParser(description='Unpack or export the tables of a .drb file.')
+    parser.add_argument('drb_path', nargs='?', default='menu.drb', help='not tested with files other than menu.drb')
+    parser.add_argument('--format', choices=('text', 'jsonl', 'csv'), default='text',
+                        help="'text' writes the old processed dump to menu.drb.txt")
+    parser.add_argument('--output', '-o', default='-',
+                        help="output file ('-' for stdout), or directory for CSV with several tables")
+    parser.add_argument('--tables', nargs='+', default=None, help='tables to export (default: all)')
+    parser.add_argument('--verbose', '-v', action='store_true')
+    parsed_args = parser.parse_args()
+    if parsed_args.format == 'csv' and parsed_args.output == '-' and (
+            parsed_args.tables is None or len(parsed_args.tables) != 1):
+        parser.error('CSV output to stdout needs exactly one table (--tables NAME); use --output DIR to write one '
+                     'CSV file per table.')
+
+    if parsed_args.format == 'text':
+        unpack_drb(parsed_args.drb_path, print_tables=False, print_processed=False)
+    else:
+        export_drb(parsed_args.drb_path, sys.stdout if parsed_args.output == '-' else parsed_args.output,
+                   parsed_args.format, parsed_args.tables, verbose=parsed_args.verbose)
@@ -8,64 +8,45 @@ TODO: Support for repacking double tables (enemyCommon.esd).
 from collections import OrderedDict
 from contextlib import redirect_stdout
 from io import BytesIO
-from struct import calcsize, pack, unpack
+import json
+from mmap import mmap
+import os
+import warnings
 from command_names import COMMAND_NAMES
-from ezstate_parser import ezparse, reset_registers
+from ezstate_optimizer import optimize_ezstate_expressions
+from ezstate_parser import (expression_calls, expression_literals, ezparse, function_lookup, reset_registers,
+                            validate_expression)
+from table_codec import resolve_offsets, TableSchema
 
 
 class EzStruct(OrderedDict):
+    """ Layout of an ESD table row ({field name: struct format}), compiled into a `table_codec.TableSchema`. Fields
+    holding offsets of rows in other tables are given in `references` ({field name: table name}). """
+
+    def __init__(self, references=None, **fields):
+        super().__init__(**fields)
+        self.schema = TableSchema(self.items(), references)
 
     def unpack(self, buffer, count=1, header_size=27 * 4):
-        if isinstance(buffer, bytes):
+        """ {offset: row dictionary} of `count` rows read from `buffer`. Offsets are relative to `header_size`. """
+        if isinstance(buffer, (bytes, bytearray, memoryview)):
             buffer = BytesIO(buffer)
-        outputs = {}
-        for i in range(count):
-            output = {}
-            offset = buffer.tell() - header_size
-            for field_name, field_fmt in self.items():
-                unpacked = unpack(field_fmt, buffer.read(calcsize(field_fmt)))
-                if len(unpacked) == 1:
-                    # Expand tuple automatically for single value.
-                    output[field_name] = unpacked[0]
-                else:
-                    output[field_name] = unpacked
-            outputs[offset] = output
-        return outputs
+        first_offset = buffer.tell() - header_size
+        data = buffer.read(count * self.size)
+        if len(data) < count * self.size:
+            raise ValueError('Expected {} rows of {} bytes at offset {}, but data ends after {} bytes.'.format(
+                count, self.size, first_offset, len(data)))
+        return self.schema.unpack_rows(data, count, first_key=first_offset)
 
     def pack(self, sequences):
+        """ Pack rows given as lists/tuples of field values or as dictionaries (or a single dictionary). """
         if not isinstance(sequences, (list, tuple)):
             sequences = (sequences,)
-        output = b''
-        for sequence in sequences:
-            if isinstance(sequence, (list, tuple)):
-                # Check number of entries matches number of fields in struct.
-                if len(sequence) != len(self.keys()):
-                    print('EzStruct keys:', self.keys())
-                    print('Sequence values ({}):'.format(len(sequence)), sequence)
-                    raise ValueError('List/tuple must have correct number of fields.')
-                for i, field_fmt in enumerate(self.values()):
-                    field = sequence[i]
-                    if not isinstance(field, (tuple, list)):
-                        field = (field,)
-                    # print(pack(field_fmt, *field))
-                    output += pack(field_fmt, *field)
-            elif isinstance(sequence, dict):
-                # Check keys match.
-                if set(self.keys()) != set(sequence.keys()):
-                    print('EzStruct keys:', self.keys())
-                    print('Dictionary keys:', sequence.keys())
-                    raise ValueError('Dictionary keys must match fields in EzStruct.')
-                for field_name, field_fmt in self.items():
-                    field = sequence[field_name]
-                    if not isinstance(field, (tuple, list)):
-                        field = (field,)
-                    # print(pack(field_fmt, *field))
-                    output += pack(field_fmt, *field)
-        return output
+        return self.schema.pack(sequences)
 
     @property
     def size(self):
-        return calcsize(''.join(fmt for fmt in self.values()))
+        return self.schema.size
 
 
 HEADER = EzStruct(
@@ -130,6 +111,8 @@ DOUBLE_STATE_HEADER = EzStruct(
 
 
 STATE = EzStruct(
+    references={'condition_pointers_offset': 'condition_pointer', 'enter_commands_offset': 'command',
+                'exit_commands_offset': 'command', 'unknown_commands_offset': 'command'},
     index='i',
     condition_pointers_offset='i',
     condition_pointers_count='i',
@@ -143,6 +126,8 @@ STATE = EzStruct(
 
 
 CONDITION = EzStruct(
+    references={'next_state_offset': 'state', 'commands_offset': 'command',
+                'subcondition_pointers_offset': 'condition_pointer'},
     next_state_offset='i',
     commands_offset='i',
     commands_count='i',
@@ -154,6 +139,7 @@ CONDITION = EzStruct(
 
 
 COMMAND = EzStruct(
+    references={'args_offset': 'command_arg'},
     unknown='i',  # Always 1
     index='i',
     args_offset='i',
@@ -168,6 +154,7 @@ COMMAND_ARG = EzStruct(
 
 
 CONDITION_POINTER = EzStruct(
+    references={'condition_offset': 'condition'},
     condition_offset='i',
 )
 
@@ -185,9 +172,11 @@ class State(object):
     def __eq__(self, other_state):
         return self.__dict__ == other_state.__dict__
 
-    def __str__(self):
+    def __str__(self, annotate=None, state_link=None):
 
         s = state_title_bar(self.index)
+        if annotate is not None:
+            s += annotate(self)
 
         fmt = '<br><div style="font-size:20px;font-weight:bold;margin-left:10px">{}</div>'
 
@@ -200,7 +189,7 @@ class State(object):
             s += fmt.format('State Change Conditions:')
             reset_registers()
             for condition in self.conditions:
-                s += str(condition)
+                s += condition.__str__(annotate=annotate, state_link=state_link)
 
         if self.exit_commands:
             s += fmt.format('(EXIT) Commands:')
@@ -217,12 +206,14 @@ class State(object):
 
 class Condition(object):
 
-    def __init__(self, next_state_index, expression, commands=(), subconditions=(), active=False, print_indent=0):
+    def __init__(self, next_state_index, expression, commands=(), subconditions=(), active=False, print_indent=0,
+                 offset=None):
         self.next_state_index = next_state_index
         self.expression = expression
         self.commands = commands
         self.subconditions = subconditions
         self.active = active
+        self.offset = offset  # Offset in the condition table this was loaded from (None for new conditions).
         self.__indent = print_indent
 
     def __eq__(self, other_condition):
@@ -235,7 +226,8 @@ class Condition(object):
     def __hash__(self):
         return hash((self.next_state_index, self.expression, tuple(self.commands), tuple(self.subconditions)))
 
-    def __str__(self, raw=False, full_brackets=False):
+    def __str__(self, raw=False, full_brackets=False, annotate=None, state_link=None):
+        """ `state_link(index)` gives the link target of a next state (default '#ezstate_{index}'). """
 
         state_fmt = '<br><div style="color:black;line-height:0.5;margin-left:{}px;">{}</div>'
         expression_fmt = ('<br><div style="color:black;line-height:1;margin-left:{}px;font-family:sans-serif">IF: '
@@ -243,13 +235,17 @@ class Condition(object):
         command_fmt = '<br><div style="color:black;font-weight:bold;line-height:0.5;margin-left:{}px;">{}</div>'
         string = ''
 
+        if annotate is not None:
+            string += annotate(self)
         if raw:
             string += expression_fmt.format(30 * (2 + self.__indent), ''.join(str(self.expression.hex())))
         string += expression_fmt.format(20 * (2 + self.__indent), ezparse(self.expression, full_brackets))
 
         if self.next_state_index != -1:
-            string += state_fmt.format(20 * (3 + self.__indent), '---> <a href="#ezstate_{index}">State {index}'
-                                                                 '</a>:'.format(index=self.next_state_index))
+            link = ('#ezstate_{}'.format(self.next_state_index) if state_link is None
+                    else state_link(self.next_state_index))
+            string += state_fmt.format(20 * (3 + self.__indent), '---> <a href="{link}">State {index}</a>:'.format(
+                link=link, index=self.next_state_index))
 
         if self.commands:
             string += command_fmt.format(20 * (2 + self.__indent), 'Commands:')
@@ -257,16 +253,17 @@ class Condition(object):
                 string += str(command)
         if self.subconditions:
             for condition in self.subconditions:
-                string += str(condition)
+                string += condition.__str__(raw, full_brackets, annotate, state_link)
         return string
 
 
 class Command(object):
 
-    def __init__(self, unknown, index, command_args=(), indent=0):
+    def __init__(self, unknown, index, command_args=(), indent=0, offset=None):
         self.unknown = unknown
         self.index = index
         self.args = command_args
+        self.offset = offset  # Offset in the command table this was loaded from (None for new commands).
         self.__indent = indent
 
     def __eq__(self, other_command):
@@ -297,13 +294,40 @@ class Command(object):
 
 class EzState(object):
 
-    def __init__(self, input_path, print_input_tables=False):
-
-        self.input_path = input_path
+    def __init__(self, esd_source, print_input_tables=False, validate=True, intern_pool=None, slim=False,
+                 strict=False):
+        """ `esd_source` can be a file path, a bytes-like object (`bytes`, `bytearray`, `memoryview`, `mmap`) or a
+        binary stream positioned at the start of the ESD data. If `intern_pool` (an `ezstate_intern.EzInternPool`) is
+        given, identical expressions, commands and conditions are shared with other EzStates loaded with it.
+
+        If `slim` is True, the raw tables, packed expression data and expression dictionaries are released once the
+        state graph is built (see `release_tables`), so that only the graph is kept.
+
+        Unless `validate` is False, expressions and table offsets are checked once loaded. Problems (such as unknown
+        opcodes) are listed in `problems` and reported with a warning, or raised as a ValueError if `strict` is True.
+        A table offset that does not point at a row still raises a ValueError if a state reaches it, as the state graph
+        cannot then be built. """
+
+        if isinstance(esd_source, (str, os.PathLike)):
+            self.input_path = esd_source
+            file_context = open(esd_source, 'rb')
+        elif isinstance(esd_source, (bytes, bytearray, memoryview, mmap)):
+            self.input_path = None
+            file_context = BytesIO(esd_source)
+        elif hasattr(esd_source, 'read'):
+            # Table offsets are relative to the start of the ESD, so the rest of the stream is read into memory.
+            self.input_path = None
+            file_context = BytesIO(esd_source.read())
+        else:
+            raise TypeError('EzState source must be a path, bytes-like object, or binary stream, not {}.'.format(
+                type(esd_source).__name__))
         self.passive_states = []
         self.active_states = []
+        self.intern_pool = intern_pool
+        self.unpacked_expressions = {}
+        self.problems = []
 
-        with open(input_path, 'rb') as file:
+        with file_context as file:
 
             self.header = HEADER.unpack(file)[-27 * 4]
 
@@ -351,27 +375,161 @@ class EzState(object):
                 self.esd_name = None
                 self.file_tail = self.packed_expressions[self.header['esd_name_2_offset']:]
 
-            # Unpack and parse expressions for inspection (indexed with offset).
-            self.unpacked_expressions = {}
-            self.parsed_expressions = {}
-            for condition in self.condition_table.values():
-                start = condition['packed_expression_offset'] - self.packed_offset
-                end = condition['packed_expression_offset'] + condition['packed_expression_size'] - self.packed_offset
-                expression = self.packed_expressions[start:end]
-                self.unpacked_expressions[condition['packed_expression_offset']] = expression
-                self.parsed_expressions[condition['packed_expression_offset']] = ezparse(expression)
-            for arg in self.command_arg_table.values():
-                start = arg['packed_expression_offset'] - self.packed_offset
-                end = arg['packed_expression_offset'] + arg['packed_expression_size'] - self.packed_offset
-                expression = self.packed_expressions[start:end]
-                self.unpacked_expressions[arg['packed_expression_offset']] = expression
-                self.parsed_expressions[arg['packed_expression_offset']] = ezparse(expression)
-
-            self.build()
+            table_problems = []
+            if validate:
+                self.problems += self.validate_expression_regions(raise_errors=strict)
+                table_problems = self.validate_table_references(raise_errors=strict)
+                self.problems += table_problems
+
+            # Unpack expressions for inspection (indexed with offset). They are parsed on first use. Each distinct
+            # expression is copied once, and the same object is used by every condition and command that has it.
+            self._parsed_expressions = None
+            distinct_expressions = {}
+            for row in list(self.condition_table.values()) + list(self.command_arg_table.values()):
+                start = row['packed_expression_offset'] - self.packed_offset
+                expression = self.packed_expressions[start:start + row['packed_expression_size']]
+                if intern_pool is not None:
+                    expression = intern_pool.expression(expression)
+                else:
+                    expression = distinct_expressions.setdefault(expression, expression)
+                self.unpacked_expressions[row['packed_expression_offset']] = expression
+
+            try:
+                self.build()
+            except KeyError:
+                if not table_problems:
+                    raise
+                # A bad offset is reached from a state, so the state graph cannot be built.
+                raise ValueError('Invalid EzState table offsets:\n' + '\n'.join(table_problems)) from None
+
+            if validate:
+                self.problems += self.validate(raise_errors=strict)
+                if self.problems:
+                    warnings.warn('{} has {} validation problem(s), the first being: {}'.format(
+                        self.input_path or 'EzState', len(self.problems), self.problems[0]))
+
+        if slim:
+            self.release_tables()
+
+    def release_tables(self):
+        """ Drop the raw tables, packed expression data and expression dictionaries, which are not needed once the
+        state graph is built. Packing and HTML output only use the graph, but `print_tables`, `print_expressions`,
+        `parsed_expressions`, `get_packed_expression` and the table validation methods can no longer be used. """
+        self.state_table = self.condition_table = self.command_table = None
+        self.command_arg_table = self.condition_pointer_table = None
+        self.packed_expressions = None
+        self.unpacked_expressions = None
+        self._parsed_expressions = None
+
+    @classmethod
+    def from_graph(cls, header, state_header, passive_states, active_states, esd_name, file_tail):
+        """ EzState made from a state graph built elsewhere (such as one imported by `ezstate_json`), with no raw
+        tables, as if `release_tables` had been called. `header` and `state_header` are the header dictionaries of the
+        file it came from; packing recomputes their offset and size fields. """
+        ezstate = cls.__new__(cls)
+        ezstate.input_path = None
+        ezstate.intern_pool = None
+        ezstate.header = header
+        ezstate.state_header = state_header
+        ezstate.state_table_count = header['state_table_count']
+        ezstate.passive_states = list(passive_states)
+        ezstate.active_states = list(active_states)
+        ezstate.esd_name = esd_name
+        ezstate.file_tail = file_tail
+        ezstate.packed_offset = None
+        ezstate.release_tables()
+        return ezstate
+
+    @property
+    def parsed_expressions(self):
+        """ Rendered expressions (indexed with offset), parsed when first needed. """
+        if self._parsed_expressions is None:
+            self._parsed_expressions = {offset: ezparse(expression)
+                                        for offset, expression in self.unpacked_expressions.items()}
+        return self._parsed_expressions
 
     def get_packed_expression(self, offset, size):
+        expression = self.unpacked_expressions.get(offset)
+        if expression is not None and len(expression) == size:
+            return expression  # Shared copy.
         return self.packed_expressions[offset - self.packed_offset:offset - self.packed_offset + size]
 
+    def validate_expression_regions(self, raise_errors=True):
+        """ Check that every condition and command arg expression lies inside the packed expression data. Returns a
+        list of problems, and raises a ValueError listing them if `raise_errors` is True. """
+        region_start = self.packed_offset
+        region_end = self.packed_offset + len(self.packed_expressions)
+        errors = []
+        for table_name, table in (('Condition', self.condition_table), ('Command arg', self.command_arg_table)):
+            for row_offset, row in table.items():
+                start = row['packed_expression_offset']
+                size = row['packed_expression_size']
+                if size <= 0 or start < region_start or start + size > region_end:
+                    errors.append('{} at offset {} has expression (offset {}, size {}) outside packed data '
+                                  '({} to {}).'.format(table_name, row_offset, start, size, region_start, region_end))
+        if errors and raise_errors:
+            raise ValueError('Invalid EzState expression offsets:\n' + '\n'.join(errors))
+        return errors
+
+    def validate_table_references(self, raise_errors=True):
+        """ Check that every offset field declared in the `references` of the table layouts points at the start of a
+        row of its table. Offsets of -1, and offsets paired with a count of zero, are not checked. Returns a list of
+        problems, and raises a ValueError listing them if `raise_errors` is True. """
+        tables = {'state': (STATE, self.state_table), 'condition': (CONDITION, self.condition_table),
+                  'command': (COMMAND, self.command_table), 'command_arg': (COMMAND_ARG, self.command_arg_table),
+                  'condition_pointer': (CONDITION_POINTER, self.condition_pointer_table)}
+        errors = []
+        for table_name, (ez_struct, table) in tables.items():
+            rows = list(table.items())
+            for field, target_name in ez_struct.schema.references.items():
+                target_struct, target_table = tables[target_name]
+                first = min(target_table, default=0)
+                row_offsets = range(first, first + len(target_table) * target_struct.size, target_struct.size)
+                count_field = field[:-len('offset')] + 'count'
+                checked = [(offset, row[field]) for offset, row in rows if row.get(count_field, 1) != 0]
+                try:
+                    resolve_offsets([value for _, value in checked], row_offsets, allow_null=True)
+                except KeyError as e:
+                    row_offset = next(offset for offset, value in checked if value == e.args[0])
+                    errors.append('{} row at offset {} has {} {}, which is not a {} row.'.format(
+                        table_name.capitalize(), row_offset, field, e.args[0], target_name.replace('_', ' ')))
+        if errors and raise_errors:
+            raise ValueError('Invalid EzState table offsets:\n' + '\n'.join(errors))
+        return errors
+
+    def validate(self, raise_errors=True):
+        """ Check every condition and command expression in the state graph. Registers must be stored by an earlier
+        condition of the same state before they are loaded. Returns a list of problems, and raises a ValueError listing
+        them if `raise_errors` is True. """
+        errors = []
+
+        def validate_commands(state, commands):
+            for command in commands:
+                for arg in command.args:
+                    try:
+                        validate_expression(arg)
+                    except ValueError as e:
+                        errors.append('State {} command {}: {}'.format(state.index, command.index, e))
+
+        def validate_conditions(state, conditions, registers):
+            for condition in conditions:
+                try:
+                    validate_expression(condition.expression, registers)
+                except ValueError as e:
+                    errors.append('State {} condition: {}'.format(state.index, e))
+                validate_commands(state, condition.commands)
+                validate_conditions(state, condition.subconditions, registers)
+
+        for state in self.passive_states + self.active_states:
+            validate_commands(state, state.enter_commands)
+            validate_commands(state, state.exit_commands)
+            validate_commands(state, state.unknown_commands)
+            validate_conditions(state, state.conditions, set())
+
+        if errors and raise_errors:
+            raise ValueError('Invalid EzState expressions:\n' + '\n'.join(errors))
+        return errors
+
     def build(self):
 
         self.passive_states = []
@@ -422,9 +580,14 @@ class EzState(object):
 
             active = self.state_table_count == 2 and next_state_offset >= self.state_header['second_state_table_offset']
 
+            if self.intern_pool is not None:
+                conditions.append(self.intern_pool.condition(
+                    next_state_index, self.intern_pool.expression(condition_expression), commands, subconditions,
+                    active, print_indent, condition_offset))
+                continue
             conditions.append(
                 Condition(next_state_index, condition_expression, commands, subconditions, active=active,
-                          print_indent=print_indent)
+                          print_indent=print_indent, offset=condition_offset)
             )
         return conditions
 
@@ -433,18 +596,31 @@ class EzState(object):
         if commands_offset == -1:
             return []
         commands = []
+        intern_pool = self.intern_pool
         for i in range(commands_count):
-            command = self.command_table[commands_offset + COMMAND.size * i]
+            command_offset = commands_offset + COMMAND.size * i
+            command = self.command_table[command_offset]
             if command['args_offset'] == -1:
                 # Command has no arguments.
-                commands.append(Command(command['unknown'], command['index'], indent=print_indent))
+                if intern_pool is not None:
+                    commands.append(intern_pool.command(command['unknown'], command['index'], indent=print_indent,
+                                                        offset=command_offset))
+                    continue
+                commands.append(Command(command['unknown'], command['index'], indent=print_indent,
+                                        offset=command_offset))
             else:
                 command_args = []
                 for j in range(command['args_count']):
                     command_arg = self.command_arg_table[command['args_offset'] + COMMAND_ARG.size * j]
                     command_args.append(self.get_packed_expression(command_arg['packed_expression_offset'],
                                                                    command_arg['packed_expression_size']))
-                commands.append(Command(command['unknown'], command['index'], command_args, indent=print_indent))
+                if intern_pool is not None:
+                    command_args = [intern_pool.expression(arg) for arg in command_args]
+                    commands.append(intern_pool.command(command['unknown'], command['index'], command_args,
+                                                        indent=print_indent, offset=command_offset))
+                    continue
+                commands.append(Command(command['unknown'], command['index'], command_args, indent=print_indent,
+                                        offset=command_offset))
         return commands
 
     @staticmethod
@@ -459,8 +635,10 @@ class EzState(object):
             else:
                 command_args_offset = -1
             for arg in command.args:
-                tables['command_arg_table'].append([len(tables['packed_arg_expressions']), len(arg)])
-                tables['packed_arg_expressions'] += arg
+                packed_arg = tables['optimized_args'].get(arg, arg)
+                tables['optimization']['arg_bytes_saved'] += len(arg) - len(packed_arg)
+                tables['command_arg_table'].append([len(tables['packed_arg_expressions']), len(packed_arg)])
+                tables['packed_arg_expressions'] += packed_arg
             tables['command_table'].append(
                 [command.unknown, command.index, command_args_offset, len(command.args)]
             )
@@ -475,40 +653,80 @@ class EzState(object):
         offset = len(tables['condition_pointer_table']) * CONDITION_POINTER.size
         count = len(conditions)
 
-        for condition in conditions:
+        # Reserve this list's pointers first, so subcondition pointers packed below don't interleave with them.
+        first_pointer = len(tables['condition_pointer_table'])
+        tables['condition_pointer_table'].extend([None] * count)
+
+        for i, condition in enumerate(conditions):
             try:
-                tables['condition_pointer_table'].append(tables['existing_conditions'][condition].copy())
+                tables['condition_pointer_table'][first_pointer + i] = tables['existing_conditions'][condition].copy()
             except KeyError:
 
-                condition_offset = len(tables['condition_table']) * CONDITION.size
+                # Reserve this condition's row before packing its subconditions after it.
+                condition_index = len(tables['condition_table'])
+                condition_offset = condition_index * CONDITION.size
+                tables['condition_table'].append(None)
+                tables['condition_is_active'].append(bool(condition.active))
 
                 condition_commands_offset, condition_commands_count = self.pack_commands(tables, condition.commands)
                 subconditions_offset, subconditions_count = self.pack_conditions(tables, condition.subconditions)
 
-                tables['condition_table'].append(
-                    [
-                        condition.next_state_index,  # will be replaced by state offset in final sweep
-                        condition_commands_offset,
-                        condition_commands_count,
-                        subconditions_offset,
-                        subconditions_count,
-                        len(tables['packed_condition_expressions']),
-                        len(condition.expression),
-                    ]
-                )
-                tables['packed_condition_expressions'] += condition.expression
+                expression = tables['optimized_conditions'].get(condition.expression, condition.expression)
+                tables['optimization']['condition_bytes_saved'] += len(condition.expression) - len(expression)
+                next_state_index = condition.next_state_index
+                if next_state_index != -1:
+                    next_state_index = tables['state_index_map'].get(
+                        (bool(condition.active), next_state_index), next_state_index)
+                tables['condition_table'][condition_index] = [
+                    next_state_index,  # will be replaced by state offset in final sweep
+                    condition_commands_offset,
+                    condition_commands_count,
+                    subconditions_offset,
+                    subconditions_count,
+                    len(tables['packed_condition_expressions']),
+                    len(expression),
+                ]
+                tables['packed_condition_expressions'] += expression
                 tables['existing_conditions'][condition] = [condition_offset]
-                tables['condition_pointer_table'].append([condition_offset])
-                if condition.active:
-                    tables['condition_is_active'].append(True)
-                else:
-                    tables['condition_is_active'].append(False)
+                tables['condition_pointer_table'][first_pointer + i] = [condition_offset]
 
         return offset, count
 
-    def pack_esd(self, print_repacked_tables=False):
-
-        """ Packs tables and computes new byte offsets for them. """
+    def reachable_states(self):
+        """ Set of (active, index) keys of states that can be reached from the entry state of each state table (index
+        0, or the first state if there is no state 0) through condition and subcondition next states. """
+        states = {(state.active, state.index): state for state in self.passive_states + self.active_states}
+        stack = []
+        for table in (self.passive_states, self.active_states):
+            if table:
+                entry = next((state for state in table if state.index == 0), table[0])
+                stack.append((entry.active, entry.index))
+        reachable = set()
+        while stack:
+            key = stack.pop()
+            if key in reachable or key not in states:
+                continue
+            reachable.add(key)
+            conditions = list(states[key].conditions)
+            while conditions:
+                condition = conditions.pop()
+                if condition.next_state_index != -1:
+                    stack.append((bool(condition.active), condition.next_state_index))
+                conditions += condition.subconditions
+        return reachable
+
+    def pack_esd(self, print_repacked_tables=False, optimize=False, remove_unreachable=False, renumber_states=False):
+
+        """ Packs tables and computes new byte offsets for them. If `optimize` is True, expressions are shortened by
+        `ezstate_optimizer`, and tables['optimization'] gives the condition and arg expression bytes saved.
+
+        If `remove_unreachable` is True, states that `reachable_states()` does not include are left out, along with
+        their conditions and commands. If `renumber_states` is True, the packed states of each table are renumbered
+        0, 1, 2... in order of their old indices, and next states are updated to match. tables['removed_states'] lists
+        the (active, index) keys left out, and tables['state_index_map'] maps (active, old index) to new indices. Only
+        the packed tables change; this EzState is not modified. Commands that refer to states by index in their
+        arguments (if there are any) are not updated.
+        """
 
         # TODO: is 'existing commands' a thing for enemyCommon.esd? Probably, but only for efficiency.
 
@@ -527,18 +745,38 @@ class EzState(object):
             'existing_conditions': {},  # {condition: condition_table_offset}
             'state_is_active': [],
             'condition_is_active': [],
+            'optimized_conditions': {},  # {condition expression: optimized expression}
+            'optimized_args': {},  # {arg expression: optimized expression}
+            'optimization': {'condition_bytes_saved': 0, 'arg_bytes_saved': 0},
+            'removed_states': [],  # [(active, index)]
+            'state_index_map': {},  # {(active, old index): new index}
         }
+        if optimize:
+            tables['optimized_conditions'], tables['optimized_args'] = optimize_ezstate_expressions(self)
+
+        passive_states, active_states = self.passive_states, self.active_states
+        if remove_unreachable:
+            reachable = self.reachable_states()
+            tables['removed_states'] = [(state.active, state.index) for state in passive_states + active_states
+                                        if (state.active, state.index) not in reachable]
+            passive_states = [state for state in passive_states if (state.active, state.index) in reachable]
+            active_states = [state for state in active_states if (state.active, state.index) in reachable]
+        if renumber_states:
+            for table in (passive_states, active_states):
+                for new_index, state in enumerate(sorted(table, key=lambda s: s.index)):
+                    tables['state_index_map'][(state.active, state.index)] = new_index
+        state_index_map = tables['state_index_map']
 
         active_state_table_offset = None
 
-        for state in self.passive_states:
+        for state in passive_states:
 
             enter_commands_offset, enter_commands_count = self.pack_commands(tables, state.enter_commands)
             exit_commands_offset, exit_commands_count = self.pack_commands(tables, state.exit_commands)
             unknown_commands_offset, unknown_commands_count = self.pack_commands(tables, state.unknown_commands)
             condition_pointers_offset, condition_pointers_count = self.pack_conditions(tables, state.conditions)
             tables['state_table'].append(
-                [state.index,
+                [state_index_map.get((state.active, state.index), state.index),
                  condition_pointers_offset, condition_pointers_count,
                  enter_commands_offset, enter_commands_count,
                  exit_commands_offset, exit_commands_count,
@@ -549,13 +787,13 @@ class EzState(object):
         if self.state_table_count == 2:
             active_state_table_offset = DOUBLE_STATE_HEADER.size + len(tables['state_table']) * STATE.size
 
-            for state in self.active_states:
+            for state in active_states:
                 enter_commands_offset, enter_commands_count = self.pack_commands(tables, state.enter_commands)
                 exit_commands_offset, exit_commands_count = self.pack_commands(tables, state.exit_commands)
                 unknown_commands_offset, unknown_commands_count = self.pack_commands(tables, state.unknown_commands)
                 condition_pointers_offset, condition_pointers_count = self.pack_conditions(tables, state.conditions)
                 tables['state_table'].append(
-                    [state.index,
+                    [state_index_map.get((state.active, state.index), state.index),
                      condition_pointers_offset, condition_pointers_count,
                      enter_commands_offset, enter_commands_count,
                      exit_commands_offset, exit_commands_count,
@@ -611,12 +849,12 @@ class EzState(object):
                     if condition[0] == state[0] and tables['condition_is_active'][i] == tables['state_is_active'][j]:
                         condition[0] = state_table_offset + j * STATE.size
                         break
-                if condition[1] != -1:
-                    condition[1] += command_table_offset
-                if condition[3] != -1:
-                    condition[3] += condition_table_offset
-                if condition[5] != -1:  # should never be -1
-                    condition[5] += packed_condition_expressions_offset
+            if condition[1] != -1:
+                condition[1] += command_table_offset
+            if condition[3] != -1:
+                condition[3] += condition_pointer_table_offset  # subcondition pointers
+            if condition[5] != -1:  # should never be -1
+                condition[5] += packed_condition_expressions_offset
 
         for command in tables['command_table']:
             if command[2] != -1:
@@ -683,7 +921,7 @@ class EzState(object):
                 zeroes=self.state_header['zeroes'],  # (0, 0)
                 first_state_table_index=self.state_header['first_state_table_index'],  # 0
                 first_state_table_offset=state_table_offset,
-                first_state_table_size=len(self.passive_states) - 1,  # number of states (no 0 repeat)
+                first_state_table_size=len(passive_states) - 1,  # number of states (no 0 repeat)
                 first_state_table_offset_2=state_table_offset,  # duplicate
             )
         elif self.state_table_count == 2:
@@ -696,11 +934,11 @@ class EzState(object):
                 zeroes=self.state_header['zeroes'],  # (0, 0)
                 first_state_table_index=self.state_header['first_state_table_index'],  # 0
                 first_state_table_offset=state_table_offset,
-                first_state_table_size=len(self.passive_states) - 1,  # number of states (no 0 repeat)
+                first_state_table_size=len(passive_states) - 1,  # number of states (no 0 repeat)
                 first_state_table_offset_2=state_table_offset,  # duplicate
                 second_state_table_index=self.state_header['second_state_table_index'],  # 0
                 second_state_table_offset=active_state_table_offset,
-                second_state_table_size=len(self.active_states) - 1,  # number of states in table 2
+                second_state_table_size=len(active_states) - 1,  # number of states in table 2
                 second_state_table_offset_2=active_state_table_offset,  # duplicate
             )
         else:
@@ -708,26 +946,50 @@ class EzState(object):
 
         return tables
 
-    def write(self, file_name, tables=None, print_repacked_tables=False):
+    def to_bytes(self, tables=None, print_repacked_tables=False, validate=True, optimize=False,
+                 remove_unreachable=False, renumber_states=False, strict=False):
+        """ Pack into a new `bytes` object, exactly as `write()` would write it. Unless `validate` is False, the packed
+        tables are checked, and if `strict` is True, so are the expressions of the state graph. """
 
         if tables is None:
-            tables = self.pack_esd(print_repacked_tables=print_repacked_tables)
-
-        with open(file_name, 'wb') as file:
-            file.write(HEADER.pack(tables['header']))
-            if tables['header']['state_table_count'] == 1:
-                file.write(SINGLE_STATE_HEADER.pack(tables['state_header']))
-            elif tables['header']['state_table_count'] == 2:
-                file.write(DOUBLE_STATE_HEADER.pack(tables['state_header']))
-            file.write(STATE.pack(tables['state_table']))
-            file.write(CONDITION.pack(tables['condition_table']))
-            file.write(COMMAND.pack(tables['command_table']))
-            file.write(COMMAND_ARG.pack(tables['command_arg_table']))
-            file.write(CONDITION_POINTER.pack(tables['condition_pointer_table']))
-            file.write(tables['packed_condition_expressions'])
-            file.write(tables['packed_arg_expressions'])
-            file.write(tables['esd_name'])
-            file.write(tables['file_tail'])
+            if validate and strict:
+                self.validate()
+            tables = self.pack_esd(print_repacked_tables=print_repacked_tables, optimize=optimize,
+                                   remove_unreachable=remove_unreachable, renumber_states=renumber_states)
+        if validate:
+            validate_packed_tables(tables)
+
+        if tables['header']['state_table_count'] == 1:
+            state_header = SINGLE_STATE_HEADER.pack(tables['state_header'])
+        elif tables['header']['state_table_count'] == 2:
+            state_header = DOUBLE_STATE_HEADER.pack(tables['state_header'])
+        else:
+            state_header = b''
+        return b''.join((
+            HEADER.pack(tables['header']),
+            state_header,
+            STATE.pack(tables['state_table']),
+            CONDITION.pack(tables['condition_table']),
+            COMMAND.pack(tables['command_table']),
+            COMMAND_ARG.pack(tables['command_arg_table']),
+            CONDITION_POINTER.pack(tables['condition_pointer_table']),
+            tables['packed_condition_expressions'],
+            tables['packed_arg_expressions'],
+            tables['esd_name'],
+            tables['file_tail'],
+        ))
+
+    def write(self, file_name, tables=None, print_repacked_tables=False, validate=True, optimize=False,
+              remove_unreachable=False, renumber_states=False, strict=False):
+        """ Pack and write to `file_name`, which can also be a writable binary stream. See `pack_esd` for the
+        `optimize`, `remove_unreachable` and `renumber_states` options, and `to_bytes` for `validate` and `strict`. """
+        data = self.to_bytes(tables, print_repacked_tables=print_repacked_tables, validate=validate, optimize=optimize,
+                             remove_unreachable=remove_unreachable, renumber_states=renumber_states, strict=strict)
+        if hasattr(file_name, 'write'):
+            file_name.write(data)
+        else:
+            with open(file_name, 'wb') as file:
+                file.write(data)
 
     def print_tables(self):
         print('\nState table:')
@@ -747,34 +1009,178 @@ class EzState(object):
             print('{}: {}'.format(key, self.parsed_expressions[key]))
 
     def __str__(self):
+        return self.to_html()
 
-        s = ("<html><head></head><body>"
-             "<meta charset=\"shift-jis\"><br>"
-             "NOTES:<br>"
-             "  - Including all logic grouping brackets is ugly, so I have disabled them by default. It is<br> "
-             "    generally safe to assume that logical operations evaluate from left to right when they are all<br>"
-             "    one type, and that later OR operations are evaluated before earlier AND operations. Set<br>"
-             "    `full_brackets=True` for explicit order.<br>"
-             "  - &: values that have been previously computed in the current condition evaluation for this state<br>"
-             "    and loaded from registers.<br>"
-             "  - ^: interpreter should continue even if the previous value is false.<br>"
-             "  - !: interpreter should stop if the previous value is false. (Yes, this is not logically consistent<br>"
-             "    with the above, but I'm not certain exactly what makes the interpreter halt during a line. It may<br>"
-             "    halt whenever a zero value is not saved to a register, hence why this 'null register' is used.)<br>")
+    def to_html(self, annotate=None):
+        """ HTML page of all (passive) states. `annotate(state_or_condition)` can return extra HTML to insert after
+        each state's title bar and before each condition. """
+
+        s = "<html><head></head><body>" + HTML_NOTES
 
         for state in self.passive_states:
-            s += str(state)
+            s += state.__str__(annotate)
 
         s += '</body></html>'
 
         return s
 
-    def unpack_to_html_file(self, output_path=None):
+    def unpack_to_html_file(self, output_path=None, annotate=None):
         if output_path is None:
-            output_path = self.input_path + '.html'
+            if self.input_path is None:
+                raise ValueError('An output path is required for an EzState that was not loaded from a file.')
+            output_path = str(self.input_path) + '.html'
         with open(output_path, 'w', encoding='shift-jis') as output_file:
             with redirect_stdout(output_file):
-                print(self)
+                print(self.to_html(annotate))
+
+    def unpack_to_html_pages(self, output_dir=None, states_per_page=1, annotate=None):
+        """ Write (passive) states to 'states_{first}-{last}.html' pages of `states_per_page` states each, with
+        next state links that point across pages, plus 'index.html' and a search index of function names, command
+        names and literals ('search_index.json', and 'search_index.js' for the index page). `output_dir` defaults to
+        '[input_path].html_pages'. Returns the path of the index page. """
+        if output_dir is None:
+            if self.input_path is None:
+                raise ValueError('An output path is required for an EzState that was not loaded from a file.')
+            output_dir = str(self.input_path) + '.html_pages'
+        os.makedirs(output_dir, exist_ok=True)
+
+        pages = []  # (page name, states)
+        state_pages = {}  # {state index: page name}
+        for first in range(0, len(self.passive_states), states_per_page):
+            states = self.passive_states[first:first + states_per_page]
+            page_name = 'states_{}-{}.html'.format(states[0].index, states[-1].index)
+            pages.append((page_name, states))
+            for state in states:
+                state_pages[state.index] = page_name
+
+        def state_link(index):
+            return '{}#ezstate_{}'.format(state_pages.get(index, ''), index)
+
+        navigation = '<div><a href="index.html">Index</a></div>'
+        for page_name, states in pages:
+            with open(os.path.join(output_dir, page_name), 'w', encoding='shift-jis') as page_file:
+                page_file.write('<html><head><meta charset="shift-jis"></head><body>' + navigation)
+                for state in states:
+                    page_file.write(state.__str__(annotate, state_link))
+                page_file.write(navigation + '</body></html>\n')
+
+        search_index = {
+            'states': [{'index': state.index, 'page': state_pages[state.index]} for state in self.passive_states],
+            'terms': {},  # {term: [positions in 'states']}
+        }
+        for position, state in enumerate(self.passive_states):
+            for term in sorted(search_terms(state)):
+                search_index['terms'].setdefault(term, []).append(position)
+        with open(os.path.join(output_dir, 'search_index.json'), 'w', encoding='utf-8') as index_file:
+            json.dump(search_index, index_file, ensure_ascii=False)
+        with open(os.path.join(output_dir, 'search_index.js'), 'w', encoding='utf-8') as index_file:
+            # Loaded with a script tag, since browsers do not let pages fetch local JSON files.
+            index_file.write('var SEARCH_INDEX = ')
+            json.dump(search_index, index_file, ensure_ascii=False)
+            index_file.write(';\n')
+
+        index_path = os.path.join(output_dir, 'index.html')
+        with open(index_path, 'w', encoding='shift-jis') as index_file:
+            index_file.write('<html><head><meta charset="shift-jis"></head><body>' + HTML_NOTES)
+            index_file.write(HTML_SEARCH)
+            index_file.write('<br><div style="font-size:20px;font-weight:bold">States:</div>')
+            for state in self.passive_states:
+                index_file.write('<a href="{}">State {}</a> '.format(state_link(state.index), state.index))
+            index_file.write('</body></html>\n')
+        return index_path
+
+
+def validate_packed_tables(tables):
+    """ Check that packed condition and command arg rows point inside their packed expression data. """
+    condition_expressions_offset = (tables['header']['condition_pointers_offset']
+                                    + len(tables['condition_pointer_table']) * CONDITION_POINTER.size)
+    arg_expressions_offset = condition_expressions_offset + len(tables['packed_condition_expressions'])
+    arg_expressions_end = arg_expressions_offset + len(tables['packed_arg_expressions'])
+    errors = []
+    for i, condition in enumerate(tables['condition_table']):
+        if condition[6] <= 0 or not (condition_expressions_offset <= condition[5]
+                                     and condition[5] + condition[6] <= arg_expressions_offset):
+            errors.append('Packed condition {} has expression (offset {}, size {}) outside condition expressions '
+                          '({} to {}).'.format(i, condition[5], condition[6], condition_expressions_offset,
+                                               arg_expressions_offset))
+    for i, command_arg in enumerate(tables['command_arg_table']):
+        if command_arg[1] <= 0 or not (arg_expressions_offset <= command_arg[0]
+                                       and command_arg[0] + command_arg[1] <= arg_expressions_end):
+            errors.append('Packed command arg {} has expression (offset {}, size {}) outside arg expressions '
+                          '({} to {}).'.format(i, command_arg[0], command_arg[1], arg_expressions_offset,
+                                               arg_expressions_end))
+    if errors:
+        raise ValueError('Invalid packed EzState tables:\n' + '\n'.join(errors))
+
+
+def search_terms(state):
+    """ Function names, command names and literals (as strings) used anywhere in `state`. """
+    terms = set()
+
+    def add_expression(expression):
+        try:
+            calls = expression_calls(expression)
+            literals = expression_literals(expression)
+        except ValueError:
+            return  # Unknown opcode.
+        for call in calls:
+            if isinstance(call[0], int):
+                terms.add(function_lookup.get(call[0], 'method_{}'.format(call[0])))
+        terms.update(str(literal) for literal in literals)
+
+    def add_commands(commands):
+        for command in commands:
+            names = COMMAND_NAMES.get(command.index)
+            terms.add(names[0] if names else 'function_{}'.format(command.index))
+            for arg in command.args:
+                add_expression(arg)
+
+    add_commands(list(state.enter_commands) + list(state.exit_commands) + list(state.unknown_commands))
+    conditions = list(state.conditions)
+    while conditions:
+        condition = conditions.pop()
+        add_expression(condition.expression)
+        add_commands(condition.commands)
+        conditions += condition.subconditions
+    return terms
+
+
+HTML_NOTES = (
+    "<meta charset=\"shift-jis\"><br>"
+    "NOTES:<br>"
+    "  - Including all logic grouping brackets is ugly, so I have disabled them by default. It is<br> "
+    "    generally safe to assume that logical operations evaluate from left to right when they are all<br>"
+    "    one type, and that later OR operations are evaluated before earlier AND operations. Set<br>"
+    "    `full_brackets=True` for explicit order.<br>"
+    "  - &: values that have been previously computed in the current condition evaluation for this state<br>"
+    "    and loaded from registers.<br>"
+    "  - ^: interpreter should continue even if the previous value is false.<br>"
+    "  - !: interpreter should stop if the previous value is false. (Yes, this is not logically consistent<br>"
+    "    with the above, but I'm not certain exactly what makes the interpreter halt during a line. It may<br>"
+    "    halt whenever a zero value is not saved to a register, hence why this 'null register' is used.)<br>")
+
+# Search box of the paginated index page, using 'search_index.js'.
+HTML_SEARCH = """<br><div style="font-size:20px;font-weight:bold">Search:</div>
+<input id="search" size="40" placeholder="function, command or value" oninput="search()"><div id="results"></div>
+<script src="search_index.js" charset="utf-8"></script>
+<script>
+function search() {
+    var query = document.getElementById('search').value.toLowerCase();
+    var found = {};
+    if (query) {
+        for (var term in SEARCH_INDEX.terms) {
+            if (term.toLowerCase().indexOf(query) !== -1) {
+                SEARCH_INDEX.terms[term].forEach(function (position) { found[position] = true; });
+            }
+        }
+    }
+    document.getElementById('results').innerHTML = Object.keys(found).map(function (position) {
+        var state = SEARCH_INDEX.states[position];
+        return '<a href="' + state.page + '#ezstate_' + state.index + '">State ' + state.index + '</a>';
+    }).join(' ');
+}
+</script>
+"""
 
 
 def state_title_bar(index):
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+Validate the packed expressions of many .esd files at once.
+
+Usage: python validate_esd.py [path ...]   (files or directories, searched recursively for .esd files)
+"""
+
+import os
+import sys
+from multiprocessing import Pool
+import warnings
+from unpack_esd import EzState
+
+
+def find_esd_files(paths):
+    """ Expand directories into the .esd files they contain. """
+    esd_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, file_names in os.walk(path):
+                esd_paths += [os.path.join(root, name) for name in sorted(file_names) if name.endswith('.esd')]
+        else:
+            esd_paths.append(path)
+    return esd_paths
+
+
+def validate_esd_file(esd_path):
+    """ Returns (path, list of problems). A file that fails to load has one problem describing why. """
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')  # The problems are returned instead.
+            return esd_path, EzState(esd_path).problems
+    except Exception as e:
+        return esd_path, ['{}: {}'.format(type(e).__name__, e)]
+
+
+def validate_esd_files(paths, processes=None):
+    """ Validate every .esd file in `paths` in parallel. Returns {path: list of problems} for invalid files only. """
+    esd_paths = find_esd_files(paths)
+    with Pool(processes) as pool:
+        results = pool.map(validate_esd_file, esd_paths, chunksize=max(1, len(esd_paths) // 64))
+    return {esd_path: errors for esd_path, errors in results if errors}
+
+
+if __name__ == '__main__':
+
+    input_paths = sys.argv[1:] or ['.']
+    invalid = validate_esd_files(input_paths)
+    for invalid_path, problems in invalid.items():
+        print('{}:'.format(invalid_path))
+        for problem in problems:
+            print('  {}'.format(problem))
+    print('{} invalid file(s).'.format(len(invalid)))
+    sys.exit(1 if invalid else 0)